@@ -0,0 +1,355 @@
+"""
+Replays historical (or synthetic) rates through the tariff pipeline for candidate break/pricing configurations
+and reports the quantisation error: how far the band prices the Powerwall sees are from the real slot prices.
+
+    python benchmarks/backtest_tariff.py --import-rates import.jsonl [--export-rates export.jsonl] [--configs configs.json]
+    python benchmarks/backtest_tariff.py --synthetic-days 365
+
+Rates files are JSON lines, one rate per line in time order, with either start/end/value_inc_vat
+(as in the Octopus Energy integration events) or valid_from/valid_to/value_inc_vat (as in the Octopus API).
+Configurations use the same keys as the app configuration, e.g.
+
+    [{"name": "numeric", "import_tariff_breaks": [0.1, 0.2, 0.3], "import_tariff_pricing": ["average", "average", "maximum", "maximum"]}]
+
+For each day the tariff is built as it would be once the next day's rates are published,
+so errors are reported both for the rest of the day ("today") and for how the next day is seen ("tomorrow").
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import datetime as dt
+import json
+import math
+import os
+import sys
+import time
+import zoneinfo
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCHMARK_DIR, "..", "src", "modules"))
+
+import powerwall_tariff as tariff
+import synthetic_rates as synthetic
+
+
+DEFAULT_CHUNK_DAYS = 28
+HORIZONS = ["today", "tomorrow"]
+
+DEFAULT_CONFIGS = [
+    {"name": "individual", "import_tariff_breaks": "individual", "import_tariff_pricing": "average"},
+    {"name": "numeric", "import_tariff_breaks": [0.1, 0.2, 0.3], "import_tariff_pricing": ["average", "average", "maximum", "maximum"]},
+    {"name": "jenks", "import_tariff_breaks": "jenks", "import_tariff_pricing": "average"},
+    {"name": "computed", "import_tariff_breaks": ["lowest(4)", 0.2, "highest(3)"], "import_tariff_pricing": ["minimum", "average", "average", "maximum"]},
+    {"name": "optimize", "import_tariff_breaks": "optimize", "import_tariff_pricing": "optimize", "export_tariff_breaks": "optimize", "export_tariff_pricing": "optimize"},
+]
+
+
+class QuantisationError:
+    """
+    Running totals of the difference between the price the Powerwall sees and the real price.
+    """
+    def __init__(self):
+        self.count = 0
+        self.uncovered = 0
+        self.total = 0.0
+        self.total_abs = 0.0
+        self.total_sq = 0.0
+        self.max_abs = 0.0
+
+    def add(self, real_price, seen_price):
+        if seen_price is None:
+            self.uncovered += 1
+            return
+        error = seen_price - real_price
+        self.count += 1
+        self.total += error
+        self.total_abs += abs(error)
+        self.total_sq += error*error
+        self.max_abs = max(self.max_abs, abs(error))
+
+    def merge(self, other):
+        self.count += other.count
+        self.uncovered += other.uncovered
+        self.total += other.total
+        self.total_abs += other.total_abs
+        self.total_sq += other.total_sq
+        self.max_abs = max(self.max_abs, other.max_abs)
+
+    def to_dict(self):
+        n = max(self.count, 1)
+        return {
+            "slots": self.count,
+            "uncovered": self.uncovered,
+            "bias": self.total/n,
+            "mae": self.total_abs/n,
+            "rmse": math.sqrt(self.total_sq/n),
+            "max": self.max_abs
+        }
+
+
+def _parse_time(v):
+    return v if isinstance(v, dt.datetime) else dt.datetime.fromisoformat(v.replace("Z", "+00:00"))
+
+
+def read_rates(path):
+    """
+    Streams rates from a JSON lines file.
+    """
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            r = json.loads(line)
+            yield {
+                "start": _parse_time(r.get("start", r.get("valid_from"))).astimezone(dt.timezone.utc),
+                "end": _parse_time(r.get("end", r.get("valid_to"))).astimezone(dt.timezone.utc),
+                tariff.PRICE_KEY: r[tariff.PRICE_KEY],
+                "is_capped": r.get("is_capped", False)
+            }
+
+
+def iter_days(rates, tz):
+    """
+    Groups time ordered rates into local days.
+    """
+    day_date = None
+    day_rates = []
+    for rate in rates:
+        rate_date = rate["start"].astimezone(tz).date()
+        if rate_date != day_date:
+            if day_rates:
+                yield day_date, day_rates
+            day_date = rate_date
+            day_rates = []
+        day_rates.append(rate)
+    if day_rates:
+        yield day_date, day_rates
+
+
+def iter_chunks(import_days, export_days, chunk_days):
+    """
+    Yields chunks of consecutive days to evaluate, each with the rates of the days either side that they depend on,
+    holding only a chunk's worth of rates in memory.
+    """
+    import_chunk = {}
+    export_chunk = {}
+    for day_date, day_rates in import_days:
+        import_chunk[day_date] = day_rates
+        if export_days is not None:
+            for export_date, export_rates in export_days:
+                export_chunk[export_date] = export_rates
+                if export_date >= day_date:
+                    break
+        # two extra days as each day is evaluated against the next, which itself needs its next day
+        if len(import_chunk) >= chunk_days + 3:
+            dates = sorted(import_chunk)
+            yield {"dates": dates[1:-2], "import": dict(import_chunk), "export": dict(export_chunk)}
+            for d in dates[:-3]:
+                import_chunk.pop(d)
+                export_chunk.pop(d, None)
+    dates = sorted(import_chunk)
+    if len(dates) > 3:
+        yield {"dates": dates[1:-2], "import": import_chunk, "export": export_chunk}
+
+
+def to_rates(days, day_date):
+    rates = tariff.Rates()
+    rates.update_previous_day("BACKTEST", days.get(day_date - tariff.ONE_DAY_INCREMENT, []))
+    rates.update_current_day("BACKTEST", days.get(day_date, []))
+    rates.update_next_day("BACKTEST", days.get(day_date + tariff.ONE_DAY_INCREMENT, []))
+    return rates
+
+
+def get_seen_price(tariff_data, t, tz, export=False):
+    """
+    The price the tariff gives for the given time, as the Powerwall would see it.
+    """
+    tariff_part = tariff_data["sell_tariff"] if export else tariff_data
+    if not tariff_part["seasons"]:
+        return None
+    local_t = t.astimezone(tz)
+    weekday = local_t.weekday()
+    minutes = local_t.hour*60 + local_t.minute
+    for charge_name, periods in tariff_part["seasons"]["Summer"]["tou_periods"].items():
+        for period in periods:
+            if period["fromDayOfWeek"] <= weekday <= period["toDayOfWeek"]:
+                start = period["fromHour"]*60 + period["fromMinute"]
+                end = period["toHour"]*60 + period["toMinute"]
+                if end <= start:
+                    # ends at midnight
+                    end += 24*60
+                if start <= minutes < end:
+                    return tariff_part["energy_charges"]["Summer"][charge_name]
+    return None
+
+
+def _get_day_schedules(config, import_rates, export_rates, day_date, break_histories):
+    import_day_rates = import_rates.cover_day(day_date)
+    if not import_day_rates:
+        return None, None
+    import_schedules = tariff.get_import_schedules(
+        config.get("import_tariff_breaks", tariff.DEFAULT_BREAKS),
+        config.get("import_tariff_pricing", tariff.DEFAULT_PRICING),
+        config.get("import_tariff_pricing_names"),
+        config.get("plunge_pricing_tariff_breaks"),
+        config.get("plunge_pricing_tariff_pricing"),
+        config.get("plunge_pricing_tariff_pricing_names"),
+        day_date, import_day_rates, window=tariff.RateWindow(import_rates, day_date, break_history=break_histories["import"])
+    )
+    export_day_rates = export_rates.cover_day(day_date)
+    if export_day_rates:
+        export_schedules = tariff.get_export_schedules(
+            config.get("export_tariff_breaks", tariff.DEFAULT_BREAKS),
+            config.get("export_tariff_pricing", tariff.DEFAULT_PRICING),
+            config.get("export_tariff_pricing_names", config.get("import_tariff_pricing_names")),
+            day_date, export_day_rates, window=tariff.RateWindow(export_rates, day_date, break_history=break_histories["export"])
+        )
+    else:
+        export_schedules = None
+    return import_schedules, export_schedules
+
+
+def evaluate_day(config, chunk, day_date, tz, errors, break_histories):
+    week_schedules = tariff.WeekSchedules()
+    horizon_dates = []
+    for d in (day_date, day_date + tariff.ONE_DAY_INCREMENT):
+        import_schedules, export_schedules = _get_day_schedules(config, to_rates(chunk["import"], d), to_rates(chunk["export"], d), d, break_histories)
+        if import_schedules is None:
+            break
+        week_schedules.update(d.weekday(), import_schedules, export_schedules)
+        horizon_dates.append(d)
+    if not horizon_dates:
+        return
+
+    tariff_data = tariff.to_tariff_data(
+        "Backtest",
+        "Import", 0, config.get("import_schedule_type", "week"),
+        "Export", 0, config.get("export_schedule_type", "week"),
+        week_schedules, day_date, tz=tz
+    )
+    for horizon, d in zip(HORIZONS, horizon_dates):
+        for rate in chunk["import"].get(d, []):
+            errors[horizon]["import"].add(rate[tariff.PRICE_KEY], get_seen_price(tariff_data, rate["start"], tz))
+        if chunk["export"].get(d):
+            for rate in chunk["export"][d]:
+                errors[horizon]["export"].add(rate[tariff.PRICE_KEY], get_seen_price(tariff_data, rate["start"], tz, export=True))
+
+
+def _new_errors():
+    return {horizon: {"import": QuantisationError(), "export": QuantisationError()} for horizon in HORIZONS}
+
+
+def evaluate_chunk(chunk, configs, tz_name):
+    """
+    Quantisation errors of each configuration over the days of the chunk.
+    Runs in a worker process.
+    """
+    tz = zoneinfo.ZoneInfo(tz_name)
+    results = {}
+    for config in configs:
+        errors = _new_errors()
+        failures = 0
+        # days are evaluated in order, so optimized breaks follow on from the previous day's as they would live
+        break_histories = {"import": tariff.BreakHistory(), "export": tariff.BreakHistory()}
+        for day_date in chunk["dates"]:
+            try:
+                evaluate_day(config, chunk, day_date, tz, errors, break_histories)
+            except Exception:
+                failures += 1
+        results[config["name"]] = (errors, failures, len(chunk["dates"]))
+    return results
+
+
+def _init_worker(tz_name):
+    # day bounds are computed in local time
+    os.environ["TZ"] = tz_name
+    time.tzset()
+
+
+def run(chunks, configs, tz_name, workers):
+    totals = {config["name"]: (_new_errors(), 0, 0) for config in configs}
+
+    def merge(results):
+        for name, (errors, failures, days) in results.items():
+            total_errors, total_failures, total_days = totals[name]
+            for horizon in HORIZONS:
+                for direction in ("import", "export"):
+                    total_errors[horizon][direction].merge(errors[horizon][direction])
+            totals[name] = (total_errors, total_failures + failures, total_days + days)
+
+    if workers <= 1:
+        _init_worker(tz_name)
+        for chunk in chunks:
+            merge(evaluate_chunk(chunk, configs, tz_name))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(tz_name,)) as pool:
+            # bound the chunks in flight so that the input is streamed rather than read up front
+            pending = []
+            for chunk in chunks:
+                pending.append(pool.submit(evaluate_chunk, chunk, configs, tz_name))
+                if len(pending) >= 2*workers:
+                    merge(pending.pop(0).result())
+            for future in pending:
+                merge(future.result())
+    return totals
+
+
+def to_report(totals):
+    report = {}
+    for name, (errors, failures, days) in totals.items():
+        report[name] = {"days": days, "failed_days": failures}
+        for horizon in HORIZONS:
+            for direction in ("import", "export"):
+                if errors[horizon][direction].count or errors[horizon][direction].uncovered:
+                    report[name][f"{horizon}_{direction}"] = errors[horizon][direction].to_dict()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backtest break and pricing configurations against historical rates")
+    parser.add_argument("--import-rates", help="JSON lines file of import rates")
+    parser.add_argument("--export-rates", help="JSON lines file of export rates")
+    parser.add_argument("--synthetic-days", type=int, help="use this many days of synthetic Agile rates instead of files")
+    parser.add_argument("--configs", help="JSON file with a list of configurations (default a few examples)")
+    parser.add_argument("--tz", default="Europe/London", help="local time zone of the tariff")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--chunk-days", type=int, default=DEFAULT_CHUNK_DAYS, help="days evaluated per task")
+    parser.add_argument("--json", action="store_true", help="output the report as JSON")
+    args = parser.parse_args(argv)
+
+    tz = zoneinfo.ZoneInfo(args.tz)
+    if args.configs:
+        with open(args.configs, "r") as f:
+            configs = json.load(f)
+    else:
+        configs = DEFAULT_CONFIGS
+
+    if args.synthetic_days:
+        start_date = dt.date.today() - dt.timedelta(days=args.synthetic_days + 1)
+        import_rates = synthetic.generate_import_rates(start_date, args.synthetic_days + 3, seed=1, tz=tz)
+        export_rates = synthetic.generate_export_rates(import_rates, seed=2)
+        import_days = iter_days(iter(import_rates), tz)
+        export_days = iter_days(iter(export_rates), tz)
+    elif args.import_rates:
+        import_days = iter_days(read_rates(args.import_rates), tz)
+        export_days = iter_days(read_rates(args.export_rates), tz) if args.export_rates else None
+    else:
+        parser.error("either --import-rates or --synthetic-days is required")
+
+    chunks = iter_chunks(import_days, export_days, args.chunk_days)
+    report = to_report(run(chunks, configs, args.tz, args.workers))
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        for name, result in report.items():
+            print(f"{name}: {result['days']} days ({result['failed_days']} failed)")
+            for key, errors in result.items():
+                if isinstance(errors, dict):
+                    print(f"    {key:16} mae {errors['mae']:.4f}  rmse {errors['rmse']:.4f}  bias {errors['bias']:+.4f}  max {errors['max']:.4f}  ({errors['slots']} slots, {errors['uncovered']} uncovered)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+"""
+End-to-end benchmark of tariff updates through the Tesla API wrappers, against the local stand-in API (mock_tesla_api.py).
+
+    python benchmarks/bench_api.py [--sites 1 4] [--updates 20] [--latency 0.2] [--error-rate 0.05] [--transport executor async]
+
+Each update reads every site's tariff and writes a new one to those that differ, as the app does.
+Reports the update latency and the number of API requests (and retries) per update.
+"""
+import argparse
+import asyncio
+import builtins
+from concurrent.futures import ThreadPoolExecutor
+import datetime as dt
+import os
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCHMARK_DIR, "..", "src", "modules"))
+
+# outside pyscript, the wrappers' decorators have nothing to do
+builtins.pyscript_compile = lambda f: f
+builtins.pyscript_executor = lambda f: f
+
+import bench_tariff
+import mock_tesla_api as mock
+import powerwall_metrics as metrics
+import powerwall_tariff as tariff
+import synthetic_rates as synthetic
+import teslapy_async_wrapper as async_api_wrapper
+import teslapy_wrapper as api_wrapper
+
+
+DEFAULT_SITES = [1, 4]
+DEFAULT_TRANSPORTS = ["executor", "async"]
+
+
+def create_tariffs(num_days):
+    """
+    A day's tariff per update, so that every update has something to write.
+    """
+    import_rates, export_rates, _ = bench_tariff.create_scenarios(num_days)["agile"]
+    import_days = synthetic.split_days(import_rates)
+    export_days = synthetic.split_days(export_rates)
+    week_schedules = tariff.WeekSchedules()
+    tariffs = []
+    for d in range(num_days):
+        day_date = bench_tariff.START_DATE + dt.timedelta(days=d)
+        import_day_rates = bench_tariff.to_rates(import_days, day_date).cover_day(day_date)
+        export_day_rates = bench_tariff.to_rates(export_days, day_date).cover_day(day_date)
+        import_schedules = tariff.get_import_schedules("individual", "average", None, None, None, None, day_date, import_day_rates)
+        export_schedules = tariff.get_export_schedules("individual", "average", None, day_date, export_day_rates)
+        week_schedules.update(day_date.weekday(), import_schedules, export_schedules)
+        tariffs.append(tariff.to_tariff_data("Synthetic", "Import", 0.5, "week", "Export", 0, "week", week_schedules, day_date, tz=synthetic.UK))
+    return tariffs
+
+
+def _sites_to_update(sites, results, tariff_data):
+    return [site for site, result in zip(sites, results) if result["error"] is not None or result["value"] != tariff_data]
+
+
+def _set_tariff(site, tariff_data):
+    """
+    Writes the tariff to the site as the app's upload worker does, returning whether it failed.
+    """
+    try:
+        api_wrapper.set_powerwall_tariff(site["email"], site["refresh_token"], tariff_data, site_id=site["energy_site_id"])
+        return False
+    except Exception:
+        return True
+
+
+async def _async_set_tariff(site, tariff_data):
+    try:
+        await async_api_wrapper.set_powerwall_tariff(site["email"], site["refresh_token"], tariff_data, site_id=site["energy_site_id"])
+        return False
+    except Exception:
+        return True
+
+
+def run_executor(sites, tariffs, max_workers):
+    durations = []
+    errors = 0
+    # each site has its own upload worker in the app
+    with ThreadPoolExecutor(max_workers=len(sites)) as pool:
+        for tariff_data in tariffs:
+            start = time.perf_counter()
+            results = api_wrapper.get_site_tariffs(sites, max_workers)
+            changed = _sites_to_update(sites, results, tariff_data)
+            errors += sum(pool.map(lambda site: _set_tariff(site, tariff_data), changed))
+            durations.append(time.perf_counter() - start)
+    return durations, errors
+
+
+async def run_async(sites, tariffs, max_workers):
+    durations = []
+    errors = 0
+    try:
+        for tariff_data in tariffs:
+            start = time.perf_counter()
+            results = await async_api_wrapper.get_site_tariffs(sites, max_workers)
+            changed = _sites_to_update(sites, results, tariff_data)
+            errors += sum(await asyncio.gather(*[_async_set_tariff(site, tariff_data) for site in changed]))
+            durations.append(time.perf_counter() - start)
+    finally:
+        if async_api_wrapper.HTTP_SESSION is not None:
+            await async_api_wrapper.HTTP_SESSION.close()
+    return durations, errors
+
+
+def run(num_sites, transport, tariffs, args):
+    api = mock.MockTeslaAPI(num_sites, latency=args.latency, jitter=args.jitter, seed=args.seed).start()
+    try:
+        mock.configure_teslapy(api.base_url)
+        # each site on its own account, as is the worst case for logging in
+        sites = [{"name": f"site{i}", "email": f"site{i}@example.com", "refresh_token": "refresh", "energy_site_id": site_id} for i, site_id in enumerate(api.site_ids)]
+        # start afresh: tokens cached from the previous run are for another server, and its failures don't count
+        for site in sites:
+            api_wrapper.invalidate_session(site["email"])
+        api_wrapper.set_cache_file(None)
+        api_wrapper.BREAKER.update({"state": api_wrapper.CLOSED, "failures": 0, "opened_at": None, "rejected": 0})
+        # log in up front, as the app does when it loads
+        api_wrapper.warm_sessions(sites)
+        api.reset_log()
+        if args.error_rate > 0:
+            api.inject(args.error_status, probability=args.error_rate, retry_after=args.retry_after)
+        retries = api_wrapper.get_api_stats()["api_retries"]
+        if transport == "async":
+            durations, errors = asyncio.run(run_async(sites, tariffs, args.max_workers))
+        else:
+            durations, errors = run_executor(sites, tariffs, args.max_workers)
+        stats = api.get_stats()
+        retries = api_wrapper.get_api_stats()["api_retries"] - retries
+    finally:
+        api.stop()
+    return durations, errors, retries, stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark tariff updates against a local stand-in for the Tesla API")
+    parser.add_argument("--sites", type=int, nargs="+", default=DEFAULT_SITES, help="numbers of energy sites to benchmark")
+    parser.add_argument("--transport", nargs="+", choices=DEFAULT_TRANSPORTS, default=DEFAULT_TRANSPORTS)
+    parser.add_argument("--updates", type=int, default=20, help="number of tariff updates")
+    parser.add_argument("--max-workers", type=int, default=api_wrapper.DEFAULT_MAX_WORKERS, help="sites read at the same time")
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds each API response is delayed by")
+    parser.add_argument("--jitter", type=float, default=0.05, help="up to this many seconds more delay")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of failing each API request")
+    parser.add_argument("--error-status", type=int, default=503, help="status of failed requests")
+    parser.add_argument("--retry-after", type=int, default=0, help="Retry-After of failed requests")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    if "async" in args.transport and not async_api_wrapper.is_available():
+        print("aiohttp is not installed, skipping the async transport")
+        args.transport = [transport for transport in args.transport if transport != "async"]
+    tariffs = create_tariffs(args.updates)
+    for num_sites in args.sites:
+        for transport in args.transport:
+            durations, errors, retries, stats = run(num_sites, transport, tariffs, args)
+            prefix = f"{transport}/{num_sites} sites"
+            print(f"{prefix:24} update p50 {1000.0*metrics.percentile(durations, 50):8.1f} ms, p95 {1000.0*metrics.percentile(durations, 95):8.1f} ms,"
+                  f" {stats['requests']/len(durations):5.1f} requests/update, {retries} retries, {errors} failed writes")
+            for endpoint, endpoint_stats in sorted(stats["endpoints"].items()):
+                statuses = ", ".join(f"{status}: {n}" for status, n in sorted(endpoint_stats["statuses"].items()))
+                print(f"{'':24} {endpoint:24} {endpoint_stats['requests']:6} ({statuses})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+"""
+Offline benchmarks for the tariff pipeline using synthetic rates.
+
+    python benchmarks/bench_tariff.py [--days 1 30 365] [--save]
+
+Timings are per day in microseconds and are compared against the stored baseline,
+exiting with a non-zero status if any stage is slower than the tolerance allows.
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCHMARK_DIR, "..", "src", "modules"))
+
+import powerwall_tariff as tariff
+import synthetic_rates as synthetic
+
+
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIR, "baselines", "tariff.json")
+DEFAULT_DAYS = [1, 30, 365]
+DEFAULT_TOLERANCE = 2.0
+# differences smaller than this are noise
+MIN_REGRESSION_US = 5.0
+# short horizons are repeated more to get a stable best time
+MIN_DAYS_TIMED = 100
+START_DATE = dt.date(2024, 1, 1)
+
+STAGES = ["rates_update", "cover_day", "get_tariff_assigners", "get_import_schedules", "get_export_schedules", "schedules_to_tariff", "to_tariff_data"]
+
+BREAK_STYLES = {
+    "numeric": ([0.1, 0.2, 0.3], ["average", "average", "maximum", "maximum"]),
+    "individual": ("individual", "average"),
+    "jenks": ("jenks", "average"),
+    "computed": (["lowest(4)", 0.2, "highest(3)"], ["minimum", "average", "average", "maximum"]),
+    "optimize": ("optimize", "optimize"),
+}
+
+
+def create_scenarios(num_days):
+    # an extra day either side so every day has previous and next day rates
+    start_date = START_DATE - dt.timedelta(days=1)
+    agile_import = synthetic.generate_import_rates(start_date, num_days + 2, seed=1)
+    free_sessions = synthetic.generate_free_sessions(start_date, num_days + 2, seed=2)
+    sparse_import = synthetic.generate_import_rates(start_date, num_days + 2, seed=3, missing_slot_probability=0.02)
+    return {
+        "agile": (agile_import, synthetic.generate_export_rates(agile_import, seed=4), free_sessions),
+        "sparse_flat_export": (sparse_import, synthetic.generate_flat_export_rates(start_date, num_days + 2), []),
+    }
+
+
+class Timer:
+    def __init__(self):
+        self.totals = dict.fromkeys(STAGES, 0.0)
+
+    def time(self, stage, func, *args, **kwargs):
+        t0 = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.totals[stage] += time.perf_counter() - t0
+        return result
+
+
+def to_rates(days, day_date):
+    rates = tariff.Rates()
+    rates.update_previous_day("SYNTHETIC", days.get(day_date - dt.timedelta(days=1), []))
+    rates.update_current_day("SYNTHETIC", days.get(day_date, []))
+    rates.update_next_day("SYNTHETIC", days.get(day_date + dt.timedelta(days=1), []))
+    return rates
+
+
+def run_pipeline(scenario, break_style, num_days):
+    import_rates, export_rates, free_sessions = scenario
+    breaks, pricing = BREAK_STYLES[break_style]
+    # every repeat runs the same days, which would otherwise all be memoised after the first
+    tariff.JENKS_CACHE.clear()
+    import_days = synthetic.split_days(import_rates)
+    export_days = synthetic.split_days(export_rates)
+    timer = Timer()
+    week_schedules = tariff.WeekSchedules()
+    overlays = tariff.PriceOverlays()
+    break_history = tariff.BreakHistory()
+    for event in free_sessions:
+        overlays.add(tariff.FREE_SESSION, event["start"], event["end"], price=0.0)
+    for d in range(num_days):
+        day_date = START_DATE + dt.timedelta(days=d)
+        import_day = timer.time("rates_update", to_rates, import_days, day_date)
+        export_day = timer.time("rates_update", to_rates, export_days, day_date)
+        import_day_rates = timer.time("cover_day", import_day.cover_day, day_date)
+        export_day_rates = timer.time("cover_day", export_day.cover_day, day_date)
+        overlays.apply(import_day_rates)
+        window = tariff.RateWindow(import_day, day_date, break_history=break_history)
+        timer.time("get_tariff_assigners", tariff.get_tariff_assigners, breaks, import_day_rates, window=window)
+        import_schedules = timer.time("get_import_schedules", tariff.get_import_schedules, breaks, pricing, None, None, None, None, day_date, import_day_rates, window=window)
+        export_schedules = timer.time("get_export_schedules", tariff.get_export_schedules, breaks, pricing, None, day_date, export_day_rates)
+        week_schedules.update(day_date.weekday(), import_schedules, export_schedules)
+        timer.time("schedules_to_tariff", tariff.schedules_to_tariff, week_schedules, "week", day_date.weekday(), tz=synthetic.UK)
+        timer.time("to_tariff_data", tariff.to_tariff_data, "Synthetic", "Import", 0.5, "week", "Export", 0, "week", week_schedules, day_date, tz=synthetic.UK)
+    return timer.totals
+
+
+def run(days_list, repeat):
+    best = {}
+    errors = {}
+    scenarios_by_days = {num_days: create_scenarios(num_days) for num_days in days_list}
+    # interleave the repeats so that drift in machine load affects all configurations alike
+    for i in range(max(repeat, MIN_DAYS_TIMED // min(days_list))):
+        for num_days, scenarios in scenarios_by_days.items():
+            if i >= max(repeat, MIN_DAYS_TIMED // num_days):
+                continue
+            for scenario_name, scenario in scenarios.items():
+                for break_style in BREAK_STYLES:
+                    prefix = f"{scenario_name}/{break_style}/{num_days}d"
+                    if prefix in errors:
+                        continue
+                    try:
+                        totals = run_pipeline(scenario, break_style, num_days)
+                    except Exception as err:
+                        errors[prefix] = f"{type(err).__name__}: {err}"
+                        continue
+                    for stage in STAGES:
+                        key = f"{prefix}/{stage}"
+                        us_per_day = 1e6*totals[stage]/num_days
+                        best[key] = min(best.get(key, us_per_day), us_per_day)
+    results = {key: round(v, 1) for key, v in best.items()}
+    return results, errors
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, value in results.items():
+        baseline_value = baseline.get(key)
+        if baseline_value and value > tolerance*baseline_value and value - baseline_value > MIN_REGRESSION_US:
+            regressions.append((key, baseline_value, value))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the tariff pipeline with synthetic rates")
+    parser.add_argument("--days", type=int, nargs="+", default=DEFAULT_DAYS, help="horizons (in days) to benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="best of this many runs is reported")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline JSON file")
+    parser.add_argument("--save", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="slowdown factor reported as a regression")
+    parser.add_argument("--tz", default="Europe/London", help="local time zone, so that DST days are exercised")
+    args = parser.parse_args(argv)
+
+    # day bounds are computed in local time
+    os.environ["TZ"] = args.tz
+    time.tzset()
+
+    results, errors = run(args.days, args.repeat)
+    for key, value in results.items():
+        print(f"{key:64} {value:12.1f} us/day")
+    for key, err in errors.items():
+        print(f"{key:64} {err}")
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": results
+            }, f, indent=1, sort_keys=True)
+            f.write("\n")
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for key, baseline_value, value in regressions:
+            print(f"REGRESSION {key}: {baseline_value:.1f} -> {value:.1f} us/day")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,366 @@
+"""
+Local stand-in for the Tesla energy site API, for exercising teslapy_wrapper and teslapy_async_wrapper offline.
+
+    python benchmarks/mock_tesla_api.py [--port 8080] [--sites 2] [--latency 0.2] [--error-rate 0.05]
+
+It serves the endpoints teslapy uses for logging in, listing batteries, site info, reading and writing the tariff,
+backup reserve, operation mode and grid import/export, with configurable latency, injected errors
+(e.g. 503, 504 and 429 with Retry-After, and expired access tokens) and accounting of every request.
+Use configure_teslapy(api.base_url) to point teslapy (and so both wrappers) at it.
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCHMARK_DIR, "..", "src", "modules"))
+
+import powerwall_metrics as metrics
+
+
+TOKEN = "TOKEN"
+STATS = "STATS"
+
+# endpoint name (as in teslapy's endpoints.json) -> (method, path pattern)
+ROUTES = {
+    TOKEN: ("POST", re.compile(r"oauth2/v3/token")),
+    "PRODUCT_LIST": ("GET", re.compile(r"api/1/products")),
+    "SITE_CONFIG": ("GET", re.compile(r"api/1/energy_sites/(\d+)/site_info")),
+    "SITE_TARIFF": ("GET", re.compile(r"api/1/energy_sites/(\d+)/tariff_rate")),
+    "TIME_OF_USE_SETTINGS": ("POST", re.compile(r"api/1/energy_sites/(\d+)/time_of_use_settings")),
+    "OPERATION_MODE": ("POST", re.compile(r"api/1/energy_sites/(\d+)/operation")),
+    "BACKUP_RESERVE": ("POST", re.compile(r"api/1/energy_sites/(\d+)/backup")),
+    "ENERGY_SITE_IMPORT_EXPORT_CONFIG": ("POST", re.compile(r"api/1/energy_sites/(\d+)/grid_import_export")),
+    STATS: ("GET", re.compile(r"_mock/stats")),
+}
+
+DEFAULT_TOKEN_LIFETIME = 8*3600
+FIRST_SITE_ID = 1000
+
+REASONS = {
+    401: "invalid bearer token",
+    404: "not found",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+    504: "Gateway Timeout",
+}
+
+
+def create_site(site_id):
+    return {
+        "energy_site_id": site_id,
+        "site_name": f"Site {site_id}",
+        "backup_reserve_percent": 20,
+        "default_real_mode": "autonomous",
+        "components": {
+            "disallow_charge_from_grid_with_solar_installed": False,
+            "customer_preferred_export_rule": "pv_only",
+        },
+        "tariff_content": {},
+    }
+
+
+def configure_teslapy(base_url):
+    """
+    Points teslapy at base_url for both the API and logging in, which it otherwise only allows over https.
+    """
+    import teslapy
+    os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
+    teslapy.BASE_URL = base_url
+    teslapy.SSO_BASE_URL = base_url
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive, as with the real API
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.api.handle(self)
+
+    def do_POST(self):
+        self.server.api.handle(self)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockTeslaAPI:
+    """
+    Energy sites, issued tokens, injected faults and a log of the requests served, shared by the server threads.
+    """
+    def __init__(self, num_sites=1, latency=0.0, jitter=0.0, token_lifetime=DEFAULT_TOKEN_LIFETIME, seed=None):
+        self.sites = {}
+        for i in range(num_sites):
+            site_id = FIRST_SITE_ID + i
+            self.sites[site_id] = create_site(site_id)
+        self.latency = latency
+        self.jitter = jitter
+        # endpoint name -> (latency, jitter)
+        self.endpoint_latency = {}
+        self.token_lifetime = token_lifetime
+        self.rng = random.Random(seed)
+        # access token -> time.time() it expires
+        self.tokens = {}
+        self.tokens_issued = 0
+        self.faults = []
+        self.log = []
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    def start(self, host="127.0.0.1", port=0):
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.api = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    @property
+    def site_ids(self):
+        return list(self.sites)
+
+    def set_latency(self, latency, jitter=0.0, endpoint=None):
+        """
+        Delays responses by latency seconds plus up to jitter more, for the given endpoint or (by default) all of them.
+        """
+        with self.lock:
+            if endpoint is None:
+                self.latency = latency
+                self.jitter = jitter
+            else:
+                self.endpoint_latency[endpoint] = (latency, jitter)
+
+    def inject(self, status, endpoint=None, count=1, probability=None, retry_after=None):
+        """
+        Fails the next count requests to the endpoint (by default, any but logging in) with status,
+        or each such request with the given probability instead.
+        A 401 is what the API returns for an expired access token.
+        """
+        with self.lock:
+            self.faults.append({"status": status, "endpoint": endpoint, "count": count, "probability": probability, "retry_after": retry_after})
+
+    def clear_faults(self):
+        with self.lock:
+            self.faults = []
+
+    def expire_tokens(self):
+        """
+        Expires every access token issued so far, before the clients expect it.
+        """
+        with self.lock:
+            for token in self.tokens:
+                self.tokens[token] = 0
+
+    def reset_log(self):
+        with self.lock:
+            self.log = []
+
+    def count(self, endpoint=None, status=None):
+        """
+        The number of requests served to the endpoint and/or with the status.
+        """
+        with self.lock:
+            n = 0
+            for entry in self.log:
+                if (endpoint is None or entry["endpoint"] == endpoint) and (status is None or entry["status"] == status):
+                    n += 1
+            return n
+
+    def get_stats(self):
+        with self.lock:
+            log = list(self.log)
+        endpoints = {}
+        for entry in log:
+            stats = endpoints.get(entry["endpoint"])
+            if stats is None:
+                stats = {"requests": 0, "statuses": {}, "durations": []}
+                endpoints[entry["endpoint"]] = stats
+            stats["requests"] += 1
+            status = str(entry["status"])
+            stats["statuses"][status] = stats["statuses"].get(status, 0) + 1
+            stats["durations"].append(entry["duration"])
+        for stats in endpoints.values():
+            durations = stats.pop("durations")
+            stats["p50_ms"] = round(1000.0*metrics.percentile(durations, 50), 1)
+            stats["p95_ms"] = round(1000.0*metrics.percentile(durations, 95), 1)
+        return {
+            "requests": len(log),
+            "request_bytes": sum(entry["request_bytes"] for entry in log),
+            "response_bytes": sum(entry["response_bytes"] for entry in log),
+            "tokens_issued": self.tokens_issued,
+            "endpoints": endpoints,
+        }
+
+    def _route(self, method, path):
+        for name, (route_method, pattern) in ROUTES.items():
+            match = pattern.fullmatch(path)
+            if match and route_method == method:
+                site_id = int(match.group(1)) if match.groups() else None
+                return name, site_id
+        return None, None
+
+    def _take_fault(self, endpoint):
+        with self.lock:
+            for fault in self.faults:
+                if fault["endpoint"] != endpoint and (fault["endpoint"] is not None or endpoint == TOKEN):
+                    continue
+                if fault["probability"] is not None:
+                    if self.rng.random() < fault["probability"]:
+                        return fault
+                elif fault["count"] > 0:
+                    fault["count"] -= 1
+                    return fault
+        return None
+
+    def _get_delay(self, endpoint):
+        with self.lock:
+            latency, jitter = self.endpoint_latency.get(endpoint, (self.latency, self.jitter))
+            return latency + (self.rng.uniform(0, jitter) if jitter else 0.0)
+
+    def _is_authorized(self, authorization):
+        if not authorization or not authorization.startswith("Bearer "):
+            return False
+        with self.lock:
+            return self.tokens.get(authorization[len("Bearer "):], 0) > time.time()
+
+    def _issue_token(self, form):
+        if form.get("grant_type") != ["refresh_token"] or not form.get("refresh_token", [""])[0]:
+            return 400, {"error": "invalid_grant"}
+        with self.lock:
+            self.tokens_issued += 1
+            n = self.tokens_issued
+            access_token = f"mock-access-{n}"
+            self.tokens[access_token] = time.time() + self.token_lifetime
+        return 200, {
+            "access_token": access_token,
+            "refresh_token": f"mock-refresh-{n}",
+            "id_token": f"mock-id-{n}",
+            "expires_in": self.token_lifetime,
+            "token_type": "Bearer",
+        }
+
+    def _serve(self, endpoint, site_id, body):
+        """
+        The status and JSON response of a request that has not been failed.
+        """
+        if endpoint == TOKEN:
+            return self._issue_token(parse_qs(body.decode("utf-8")))
+        if endpoint == STATS:
+            return 200, self.get_stats()
+        if endpoint == "PRODUCT_LIST":
+            with self.lock:
+                products = [{"energy_site_id": site["energy_site_id"], "resource_type": "battery", "site_name": site["site_name"]} for site in self.sites.values()]
+            return 200, {"response": products, "count": len(products)}
+
+        site = self.sites.get(site_id)
+        if site is None:
+            return 404, {"error": REASONS[404]}
+        data = json.loads(body) if body else {}
+        with self.lock:
+            if endpoint == "SITE_CONFIG":
+                return 200, {"response": json.loads(json.dumps(site))}
+            if endpoint == "SITE_TARIFF":
+                return 200, {"response": json.loads(json.dumps(site["tariff_content"]))}
+            if endpoint == "TIME_OF_USE_SETTINGS":
+                site["tariff_content"] = data["tou_settings"]["tariff_content"]
+            elif endpoint == "OPERATION_MODE":
+                site["default_real_mode"] = data["default_real_mode"]
+            elif endpoint == "BACKUP_RESERVE":
+                site["backup_reserve_percent"] = data["backup_reserve_percent"]
+            elif endpoint == "ENERGY_SITE_IMPORT_EXPORT_CONFIG":
+                site["components"].update(data)
+                # unlike the other writes, this has no result code
+                return 200, {"response": {}}
+        return 200, {"response": {"code": 201, "message": "Updated"}}
+
+    def handle(self, handler):
+        start = time.perf_counter()
+        body = handler.rfile.read(int(handler.headers.get("Content-Length") or 0))
+        endpoint, site_id = self._route(handler.command, urlsplit(handler.path).path.lstrip("/"))
+        headers = {}
+        if endpoint is None:
+            status, response = 404, {"error": REASONS[404]}
+        else:
+            delay = self._get_delay(endpoint) if endpoint != STATS else 0.0
+            if delay > 0:
+                time.sleep(delay)
+            fault = self._take_fault(endpoint)
+            if fault is not None:
+                status = fault["status"]
+                response = {"error": REASONS.get(status, "Injected error")}
+                if fault["retry_after"] is not None:
+                    headers["Retry-After"] = str(fault["retry_after"])
+            elif endpoint not in (TOKEN, STATS) and not self._is_authorized(handler.headers.get("Authorization")):
+                status, response = 401, {"error": REASONS[401]}
+            else:
+                status, response = self._serve(endpoint, site_id, body)
+        content = json.dumps(response).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(content)))
+        for key, value in headers.items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(content)
+        if endpoint != STATS:
+            with self.lock:
+                self.log.append({
+                    "endpoint": endpoint,
+                    "method": handler.command,
+                    "site_id": site_id,
+                    "status": status,
+                    "request_bytes": len(body),
+                    "response_bytes": len(content),
+                    "duration": time.perf_counter() - start,
+                })
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the Tesla energy site API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--sites", type=int, default=1, help="number of energy sites")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds each response is delayed by")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many seconds more delay")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of failing each request")
+    parser.add_argument("--error-status", type=int, default=503, help="status of failed requests")
+    parser.add_argument("--retry-after", type=int, help="Retry-After of failed requests")
+    parser.add_argument("--token-lifetime", type=int, default=DEFAULT_TOKEN_LIFETIME, help="seconds for which access tokens are valid")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+
+    api = MockTeslaAPI(args.sites, latency=args.latency, jitter=args.jitter, token_lifetime=args.token_lifetime, seed=args.seed)
+    if args.error_rate > 0:
+        api.inject(args.error_status, probability=args.error_rate, retry_after=args.retry_after)
+    api.start(args.host, args.port)
+    print(f"Serving energy sites {api.site_ids} at {api.base_url} (request stats at {api.base_url}_mock/stats)")
+    try:
+        api.thread.join()
+    except KeyboardInterrupt:
+        pass
+    api.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
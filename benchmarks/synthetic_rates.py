@@ -0,0 +1,128 @@
+"""
+Synthetic Octopus Agile style rates, in the same shape as the Octopus Energy integration events.
+"""
+import datetime as dt
+import math
+import random
+import zoneinfo
+
+
+UTC = dt.timezone.utc
+UK = zoneinfo.ZoneInfo("Europe/London")
+
+SLOT_TIME_INCREMENT = dt.timedelta(minutes=30)
+ONE_DAY_INCREMENT = dt.timedelta(days=1)
+
+PRICE_CAP = 1.00
+
+
+def get_local_day_bounds(day_date, tz=UK):
+    day_start = dt.datetime.combine(day_date, dt.time.min, tzinfo=tz).astimezone(UTC)
+    day_end = dt.datetime.combine(day_date + ONE_DAY_INCREMENT, dt.time.min, tzinfo=tz).astimezone(UTC)
+    return day_start, day_end
+
+
+def get_slots(day_date, tz=UK):
+    """
+    Slot start/end times covering a local day, i.e. 46 or 50 slots on DST change days.
+    """
+    day_start, day_end = get_local_day_bounds(day_date, tz)
+    slots = []
+    start = day_start
+    while start < day_end:
+        slots.append((start, start + SLOT_TIME_INCREMENT))
+        start += SLOT_TIME_INCREMENT
+    return slots
+
+
+def _import_price(local_start, rng, day_level):
+    hour = local_start.hour + local_start.minute/60.0
+    # overnight trough, gentle daytime hump, evening peak
+    price = day_level + 0.04*math.sin((hour - 9.0)*math.pi/12.0)
+    if hour < 6.0:
+        price -= 0.06
+    if 16.0 <= hour < 19.0:
+        price = price*1.6 + 0.08
+    price += rng.gauss(0.0, 0.012)
+    return price
+
+
+def _to_rate(start, end, price):
+    is_capped = price > PRICE_CAP
+    if is_capped:
+        price = PRICE_CAP
+    return {"start": start, "end": end, "value_inc_vat": round(price, 5), "is_capped": is_capped}
+
+
+def generate_import_rates(start_date, num_days, seed=0, plunge_probability=0.15, missing_slot_probability=0.0, tz=UK):
+    """
+    Import rates for consecutive days.
+    Some days have a run of negative (plunge) prices and some slots may be missing.
+    """
+    rng = random.Random(seed)
+    rates = []
+    for d in range(num_days):
+        day_date = start_date + d*ONE_DAY_INCREMENT
+        day_level = 0.18 + rng.gauss(0.0, 0.04)
+        slots = get_slots(day_date, tz)
+        plunge_start = plunge_end = -1
+        if rng.random() < plunge_probability:
+            plunge_start = rng.randrange(0, len(slots) - 12)
+            plunge_end = plunge_start + rng.randrange(4, 12)
+        for i, (start, end) in enumerate(slots):
+            if rng.random() < missing_slot_probability:
+                continue
+            price = _import_price(start.astimezone(tz), rng, day_level)
+            if plunge_start <= i < plunge_end:
+                price = -abs(rng.gauss(0.03, 0.03))
+            rates.append(_to_rate(start, end, price))
+    return rates
+
+
+def generate_export_rates(import_rates, seed=0):
+    """
+    Agile Outgoing style export rates that track the import rates.
+    """
+    rng = random.Random(seed)
+    rates = []
+    for rate in import_rates:
+        price = max(rate["value_inc_vat"], 0.0)*0.55 + 0.02 + rng.gauss(0.0, 0.005)
+        rates.append(_to_rate(rate["start"], rate["end"], price))
+    return rates
+
+
+def generate_flat_export_rates(start_date, num_days, price=0.15, tz=UK):
+    """
+    Fixed export rates published as a single slot per day.
+    """
+    rates = []
+    for d in range(num_days):
+        day_start, day_end = get_local_day_bounds(start_date + d*ONE_DAY_INCREMENT, tz)
+        rates.append(_to_rate(day_start, day_end, price))
+    return rates
+
+
+def generate_free_sessions(start_date, num_days, seed=0, probability=0.05, tz=UK):
+    """
+    Octoplus free electricity session events starting on slot boundaries.
+    """
+    rng = random.Random(seed)
+    events = []
+    for d in range(num_days):
+        if rng.random() < probability:
+            day_date = start_date + d*ONE_DAY_INCREMENT
+            hour = rng.choice([7, 11, 13, 15, 20])
+            start = dt.datetime.combine(day_date, dt.time(hour), tzinfo=tz).astimezone(UTC)
+            duration = rng.choice([30, 60, 90, 120])
+            events.append({"start": start, "end": start + dt.timedelta(minutes=duration), "duration_in_minutes": duration})
+    return events
+
+
+def split_days(rates, tz=UK):
+    """
+    Groups rates by local day, as published by the integration.
+    """
+    days = {}
+    for rate in rates:
+        days.setdefault(rate["start"].astimezone(tz).date(), []).append(rate)
+    return days
@@ -1,10 +1,18 @@
+import asyncio
 import datetime as dt
 import zoneinfo
-import re
+import logging
+import os
+import time
 import powerwall_tariff as tariff
-import teslapy_wrapper as api_wrapper
+import powerwall_config
+import powerwall_cache as cache
+import powerwall_metrics as metrics
+import powerwall_upload as upload
+import powerwall_update as update
+import teslapy_wrapper
+import teslapy_async_wrapper
 import json
-from jsondiff import diff
 
 
 def get_mpan(config_key, required):
@@ -16,25 +24,133 @@ def get_mpan(config_key, required):
     return v
 
 
+def get_sites():
+    config = pyscript.app_config
+    site_configs = config.get("sites")
+    if not site_configs:
+        site_configs = [config]
+    sites = []
+    for site_config in site_configs:
+        site_id = site_config.get("energy_site_id")
+        default_name = site_config["email"] if site_id is None else f"{site_config['email']}/{site_id}"
+        sites.append({
+            "name": site_config.get("name", default_name),
+            "email": site_config["email"],
+            "refresh_token": site_config["refresh_token"],
+            "energy_site_id": site_id
+        })
+    return sites
+
+
+def get_api_wrapper():
+    transport = pyscript.app_config.get("api_transport", "executor")
+    if transport == "executor":
+        return teslapy_wrapper
+    elif transport == "async":
+        if not teslapy_async_wrapper.is_available():
+            raise ValueError("api_transport async requires aiohttp")
+        return teslapy_async_wrapper
+    else:
+        raise ValueError(f"Unknown api_transport: {transport}")
+
+
+# validated on loading
+APP_CONFIG = powerwall_config.AppConfig(pyscript.app_config)
+
 IMPORT_MPAN = get_mpan("import_mpan", True)
 EXPORT_MPAN = get_mpan("export_mpan", False)
 
+SITES = get_sites()
+api_wrapper = get_api_wrapper()
+api_wrapper.set_cache_file(pyscript.app_config.get("tesla_cache_file", teslapy_wrapper.DEFAULT_CACHE_FILE))
+api_wrapper.set_call_limits(
+    read_budget=pyscript.app_config.get("api_read_timeout"),
+    write_budget=pyscript.app_config.get("api_write_timeout"),
+    breaker_threshold=pyscript.app_config.get("api_failure_threshold"),
+    breaker_reset_timeout=pyscript.app_config.get("api_retry_interval")
+)
+MAX_CONCURRENT_REQUESTS = pyscript.app_config.get("max_concurrent_requests", api_wrapper.DEFAULT_MAX_WORKERS)
+
 IMPORT_RATES = tariff.Rates()
 EXPORT_RATES = tariff.Rates()
+# breaks used for each day with optimize, to keep the next day's close to them
+IMPORT_BREAK_HISTORY = tariff.BreakHistory()
+EXPORT_BREAK_HISTORY = tariff.BreakHistory()
 
-FREE_SESSIONS = {}
+PRICE_OVERLAYS = tariff.PriceOverlays()
+# points awarded per kWh for saving sessions are worth this much each
+OCTOPOINT_VALUE = 1.0/800.0
 
 WEEK_SCHEDULES = tariff.WeekSchedules()
 
-TARIFF_CACHE = (0, None)
+DEFAULT_CACHE_TTL = 300
+
+# per site
+TARIFF_CACHES = {}
+SETTINGS_CACHES = {}
+for site in SITES:
+    TARIFF_CACHES[site["name"]] = cache.RemoteCache(pyscript.app_config.get("cache_ttl", DEFAULT_CACHE_TTL))
+    SETTINGS_CACHES[site["name"]] = cache.RemoteCache(pyscript.app_config.get("cache_ttl", DEFAULT_CACHE_TTL))
+
+# per site fingerprint of the tariff known to be on the Powerwall
+TARIFF_FINGERPRINTS = {}
+
+UPDATE_SCHEDULER = update.UpdateScheduler()
+
+# tomorrow's schedules, prepared when its rates arrive so that only building and uploading the tariff is left for midnight
+STAGED_TARIFF = update.StagedTariff()
+
+# all writes to the Powerwalls go through the queue, sent by a worker per site
+UPLOAD_QUEUE = upload.UploadQueue()
+# per account, as Tesla limits requests per account
+UPLOAD_BUCKETS = {}
+# site name -> whether its worker is running
+UPLOAD_WORKERS = {}
+
+DEFAULT_UPDATE_DELAY = 5
+
+TIMINGS_SENSOR = "sensor.powerwall_tariff_update_timings"
+
+INSTRUMENTATION = metrics.UpdateInstrumentation()
+# the upload of the staged tariff at midnight can overlap an update, so is timed separately
+STAGED_INSTRUMENTATION = metrics.UpdateInstrumentation()
+
+METRICS = metrics.MetricsRegistry()
+METRICS.counter("events_received_total", "Events received, by event type.")
+METRICS.counter("tariff_computations_total", "Tariffs computed from rates, by day.")
+METRICS.counter("tariff_uploads_skipped_total", "Tariff uploads skipped as the Powerwall already has the tariff, by site.")
+METRICS.histogram("tariff_update_stage_seconds", "Duration of the stages of tariff updates, by stage.")
+METRICS.histogram("tariff_payload_bytes", "Size of uploaded tariffs.", buckets=metrics.BYTES_BUCKETS)
+METRICS.counter("tesla_api_calls_total", "Tesla API operations, by operation and result (ok or the error type).")
+METRICS.histogram("tesla_api_call_seconds", "Duration of Tesla API operations (including retries), by operation.")
+METRICS.counter("tesla_api_requests_total", "Tesla API requests.")
+METRICS.counter("tesla_api_retries_total", "Tesla API requests retried.")
+METRICS.counter("tesla_api_responses_total", "Tesla API responses, by HTTP status.")
+METRICS.counter("tesla_api_request_bytes_total", "Bytes sent to the Tesla API.")
+METRICS.counter("tesla_api_response_bytes_total", "Bytes received from the Tesla API.")
+METRICS.gauge("tesla_api_circuit_open", "Whether calls to the Tesla API are failing fast (1) or not (0).")
+METRICS.counter("cache_lookups_total", "Lookups of Powerwall state in the cache, by site, kind and result.")
+METRICS.gauge("upload_queue_depth", "Writes waiting to be sent.")
+METRICS.counter("uploads_total", "Writes to the Powerwalls, by outcome.")
 
 tariff.RATE_FUNCS.set_helpers(state.get, state.getattr)
 
 
+LOGGER = logging.getLogger("custom_components.pyscript.apps.powerwall")
+
+
+def is_debug():
+    return LOGGER.isEnabledFor(logging.DEBUG)
+
+
 def debug(msg):
     log.debug(msg)
 
 
+def _count_event(trigger_kwargs):
+    METRICS.inc("events_received_total", event=trigger_kwargs.get("event_type"))
+
+
 def get_rates(mpan):
     if mpan == IMPORT_MPAN:
         return IMPORT_RATES
@@ -46,38 +162,60 @@ def get_rates(mpan):
 
 @event_trigger("octopus_energy_electricity_previous_day_rates")
 def refresh_previous_day_rates(mpan, tariff_code, rates, **kwargs):
-    debug(f"Previous day rates for mpan {mpan} ({tariff_code}):\n{rates}")
+    _count_event(kwargs)
+    if is_debug():
+        debug(f"Previous day rates for mpan {mpan} ({tariff_code}):\n{rates}")
     mpan_rates = get_rates(mpan)
     if mpan_rates is not None:
         mpan_rates.update_previous_day(tariff_code, rates)
-        update_powerwall_tariff()
+        request_tariff_update()
 
 
 @event_trigger("octopus_energy_electricity_current_day_rates")
 def refresh_current_day_rates(mpan, tariff_code, rates, **kwargs):
-    debug(f"Current day rates for mpan {mpan} ({tariff_code}):\n{rates}")
+    _count_event(kwargs)
+    if is_debug():
+        debug(f"Current day rates for mpan {mpan} ({tariff_code}):\n{rates}")
     mpan_rates = get_rates(mpan)
     if mpan_rates is not None:
         mpan_rates.update_current_day(tariff_code, rates)
-        update_powerwall_tariff()
+        request_tariff_update()
 
 
 @event_trigger("octopus_energy_electricity_next_day_rates")
 def refresh_next_day_rates(mpan, tariff_code, rates, **kwargs):
-    debug(f"Next day rates for mpan {mpan} ({tariff_code}):\n{rates}")
+    _count_event(kwargs)
+    if is_debug():
+        debug(f"Next day rates for mpan {mpan} ({tariff_code}):\n{rates}")
     mpan_rates = get_rates(mpan)
     if mpan_rates is not None:
         mpan_rates.update_next_day(tariff_code, rates)
-        update_powerwall_tariff()
+        request_tariff_update()
 
 
 @event_trigger("octopus_energy_all_octoplus_free_electricity_sessions")
 def refresh_free_sessions(account_id, events, **kwargs):
-    debug(f"Free sessions for account {account_id}:\n{events}")
-    FREE_SESSIONS.clear()
+    _count_event(kwargs)
+    if is_debug():
+        debug(f"Free sessions for account {account_id}:\n{events}")
+    PRICE_OVERLAYS.clear(tariff.FREE_SESSION)
     for event in events:
-        FREE_SESSIONS[event["start"]] = event
-    update_powerwall_tariff()
+        end = event.get("end") or event["start"] + dt.timedelta(minutes=event["duration_in_minutes"])
+        PRICE_OVERLAYS.add(tariff.FREE_SESSION, event["start"], end, price=0.0)
+    request_tariff_update()
+
+
+@event_trigger("octopus_energy_all_octoplus_saving_sessions")
+def refresh_saving_sessions(account_id, joined_events, **kwargs):
+    _count_event(kwargs)
+    if is_debug():
+        debug(f"Saving sessions for account {account_id}:\n{joined_events}")
+    PRICE_OVERLAYS.clear(tariff.SAVING_SESSION)
+    value = pyscript.app_config.get("octopoint_value", OCTOPOINT_VALUE)
+    for event in joined_events:
+        # importing during a saving session also forgoes the reward
+        PRICE_OVERLAYS.add(tariff.SAVING_SESSION, event["start"], event["end"], adjustment=event["octopoints_per_kwh"]*value)
+    request_tariff_update()
 
 
 def set_status_message(value):
@@ -90,25 +228,144 @@ def set_status_message(value):
 set_status_message("Waiting for rate data...")
 
 
+def publish_timings(instrumentation=INSTRUMENTATION, prefix=""):
+    run_count = instrumentation.run_count
+    instrumentation.end_run(api_wrapper.get_api_stats())
+    if instrumentation.run_count > run_count:
+        for stage, duration in instrumentation.last.items():
+            METRICS.observe("tariff_update_stage_seconds", duration, stage=prefix + stage)
+        payload_bytes = instrumentation.last_counts.get("payload_bytes")
+        if payload_bytes is not None:
+            METRICS.observe("tariff_payload_bytes", payload_bytes)
+    attrs = INSTRUMENTATION.get_attributes()
+    if STAGED_INSTRUMENTATION.run_count:
+        for name, value in STAGED_INSTRUMENTATION.get_attributes().items():
+            attrs[f"staged_{name}"] = value
+    attrs.update(UPLOAD_QUEUE.get_stats())
+    attrs.update(api_wrapper.get_breaker_state())
+    attrs["unit_of_measurement"] = "ms"
+    attrs["friendly_name"] = "Powerwall tariff update time"
+    state.set(TIMINGS_SENSOR, value=attrs.get("total_ms"), new_attributes=attrs)
+
+    metrics_file = pyscript.app_config.get("metrics_file")
+    if metrics_file:
+        _write_metrics_file(metrics_file, get_metrics_text())
+
+
+def get_metrics_text():
+    # totals counted elsewhere are copied in when rendering
+    api_stats = api_wrapper.get_api_stats()
+    METRICS.set("tesla_api_requests_total", api_stats["api_requests"])
+    METRICS.set("tesla_api_retries_total", api_stats["api_retries"])
+    METRICS.set("tesla_api_request_bytes_total", api_stats["api_request_bytes"])
+    METRICS.set("tesla_api_response_bytes_total", api_stats["api_response_bytes"])
+    for status, count in api_wrapper.get_api_status_counts().items():
+        METRICS.set("tesla_api_responses_total", count, status=status)
+    breaker = api_wrapper.get_breaker_state()
+    METRICS.set("tesla_api_circuit_open", 0 if breaker["api_circuit"] == teslapy_wrapper.CLOSED else 1)
+    for kind, caches in (("tariff", TARIFF_CACHES), ("settings", SETTINGS_CACHES)):
+        for name, remote_cache in caches.items():
+            stats = remote_cache.get_stats()
+            METRICS.set("cache_lookups_total", stats["hits"], site=name, kind=kind, result="hit")
+            METRICS.set("cache_lookups_total", stats["stale_hits"], site=name, kind=kind, result="stale")
+            METRICS.set("cache_lookups_total", stats["misses"], site=name, kind=kind, result="miss")
+    upload_stats = UPLOAD_QUEUE.get_stats()
+    METRICS.set("upload_queue_depth", upload_stats["upload_queue_depth"])
+    for outcome in ("submitted", "superseded", "sent", "failed"):
+        METRICS.set("uploads_total", upload_stats[f"uploads_{outcome}"], outcome=outcome)
+    return METRICS.render()
+
+
+@pyscript_executor
+def _write_metrics_file(path, text):
+    # replaced atomically, so that scrapers never see a partial file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def _call_api(operation, func, **kwargs):
+    start = time.perf_counter()
+    error = None
+    try:
+        return func(**kwargs)
+    except Exception as err:
+        error = f"{type(err).__name__}: {err}"
+        raise
+    finally:
+        _record_api_call(operation, error, time.perf_counter() - start)
+
+
+def _record_api_call(operation, error, duration):
+    result = error.split(":", 1)[0] if error else "ok"
+    METRICS.inc("tesla_api_calls_total", operation=operation, result=result)
+    METRICS.observe("tesla_api_call_seconds", duration, operation=operation)
+
+
+def get_app_config():
+    global APP_CONFIG
+    # compiled afresh if the app config is reloaded
+    if APP_CONFIG is None or APP_CONFIG.config is not pyscript.app_config:
+        APP_CONFIG = powerwall_config.AppConfig(pyscript.app_config)
+    return APP_CONFIG
+
+
 def get_tariff_setting(tariff_code, config_key, default_value):
-    config = pyscript.app_config
-    for tariff_config in config.get("tariffs", []):
-        if re.match(tariff_config["tariff_code"], tariff_code):
-            if config_key in tariff_config:
-                config = tariff_config
-            break
+    return get_app_config().get(tariff_code, config_key, default_value)
+
+
+def request_tariff_update():
+    # coalesce bursts of rate events (e.g. at day rollover) into a single update
+    task.unique("powerwall_tariff_update_request")
+    task.sleep(pyscript.app_config.get("update_delay", DEFAULT_UPDATE_DELAY))
+    _schedule_tariff_run(update.UPDATE)
 
-    return config.get(config_key, default_value)
+
+def request_tariff_check():
+    # recomputes and checks the tariff straight away, with whatever rates are known
+    _schedule_tariff_run(update.CHECK)
+
+
+def _schedule_tariff_run(kind):
+    if UPDATE_SCHEDULER.request(kind):
+        task.create(run_tariff_updates)
+
+
+def run_tariff_updates():
+    # only one update runs at a time; requests made whilst it runs are picked up when it finishes
+    try:
+        kind = UPDATE_SCHEDULER.next_run()
+        while kind is not None:
+            if kind == update.UPDATE:
+                if update_powerwall_tariff():
+                    UPDATE_SCHEDULER.checked()
+            else:
+                _update_powerwall_tariff()
+            kind = UPDATE_SCHEDULER.next_run()
+    finally:
+        UPDATE_SCHEDULER.stop()
 
 
 def update_powerwall_tariff():
+    """
+    Updates the tariff from newly arrived rates, returning whether it was checked against the Powerwalls.
+    """
+    if not IMPORT_RATES.has_updates() and not EXPORT_RATES.has_updates():
+        # already used by the last update (e.g. this is a re-run for events it covered), so leave its status be
+        debug("No rate data since the last tariff update")
+        return False
+    INSTRUMENTATION.begin_run(api_wrapper.get_api_stats())
+    t = INSTRUMENTATION.start()
     try:
         IMPORT_RATES.is_valid()
     except ValueError as err:
         msg = f"Import tariffs: {err}"
         debug(msg)
         set_status_message(msg)
-        return
+        INSTRUMENTATION.record("validation", t)
+        publish_timings()
+        return False
 
     if EXPORT_MPAN:
         try:
@@ -117,7 +374,10 @@ def update_powerwall_tariff():
             msg = f"Export tariffs: {err}"
             debug(msg)
             set_status_message(msg)
-            return
+            INSTRUMENTATION.record("validation", t)
+            publish_timings()
+            return False
+    INSTRUMENTATION.record("validation", t)
 
     _update_powerwall_tariff()
 
@@ -128,6 +388,7 @@ def update_powerwall_tariff():
         WEEK_SCHEDULES.reset()
     if not get_tariff_setting(EXPORT_RATES.current_tariff, "maintain_history", False):
         WEEK_SCHEDULES.reset(export=True)
+    return True
 
 
 def get_breaks(tariff_code, config_key, default_value=None, required=True):
@@ -160,21 +421,16 @@ def get_sensor_value(tariff_code, config_key, default_value):
 
 def _update_schedules_for_day(day_date):
     # filter down to the given day
+    t = INSTRUMENTATION.start()
     import_rates = IMPORT_RATES.cover_day(day_date)
     if not import_rates:
+        INSTRUMENTATION.record("cover_day", t)
         return None, None
     export_rates = EXPORT_RATES.cover_day(day_date)
+    INSTRUMENTATION.record("cover_day", t)
 
-    event_duration = 0.0
-    for i, rate in enumerate(import_rates):
-        if event_duration <= 0.0:
-            free_event = FREE_SESSIONS.get(rate["start"])
-            if free_event:
-                event_duration = free_event["duration_in_minutes"]
-        if event_duration > 0.0:
-            # NB: treat rate object as immutable so original is golden
-            import_rates[i] = {**rate, tariff.PRICE_KEY: 0.0, "session": "free"}
-            event_duration -= 30
+    # NB: overridden in the view only, so the original rates stay golden
+    PRICE_OVERLAYS.apply(import_rates)
 
     import_breaks = get_breaks(IMPORT_RATES.current_tariff, "import_tariff_breaks", default_value=tariff.DEFAULT_BREAKS, required=True)
     plunge_pricing_breaks = get_breaks(IMPORT_RATES.current_tariff, "plunge_pricing_tariff_breaks", required=False)
@@ -183,17 +439,20 @@ def _update_schedules_for_day(day_date):
     import_pricing_names = get_pricing_names(IMPORT_RATES.current_tariff, "import_tariff_pricing_names", required=False)
     plunge_pricing_pricing_names = get_pricing_names(IMPORT_RATES.current_tariff, "plunge_pricing_tariff_pricing_names", required=False)
 
-    import_schedules = tariff.get_import_schedules(import_breaks, import_pricing, import_pricing_names, plunge_pricing_breaks, plunge_pricing_pricing, plunge_pricing_pricing_names, day_date, import_rates)
+    t = INSTRUMENTATION.start()
+    import_schedules = tariff.get_import_schedules(import_breaks, import_pricing, import_pricing_names, plunge_pricing_breaks, plunge_pricing_pricing, plunge_pricing_pricing_names, day_date, import_rates, window=tariff.RateWindow(IMPORT_RATES, day_date, PRICE_OVERLAYS, IMPORT_BREAK_HISTORY))
     if import_schedules is None:
+        INSTRUMENTATION.record("schedules", t)
         return None, None
 
     if export_rates:
         export_breaks = get_breaks(EXPORT_RATES.current_tariff, "export_tariff_breaks", default_value=tariff.DEFAULT_BREAKS, required=True)
         export_pricing = get_pricing(EXPORT_RATES.current_tariff, "export_tariff_pricing", default_value=tariff.DEFAULT_PRICING, required=True)
         export_pricing_names = get_pricing_names(EXPORT_RATES.current_tariff, "export_tariff_pricing_names", default_value=import_pricing_names, required=False)
-        export_schedules = tariff.get_export_schedules(export_breaks, export_pricing, export_pricing_names, day_date, export_rates)
+        export_schedules = tariff.get_export_schedules(export_breaks, export_pricing, export_pricing_names, day_date, export_rates, window=tariff.RateWindow(EXPORT_RATES, day_date, break_history=EXPORT_BREAK_HISTORY))
     else:
         export_schedules = None
+    INSTRUMENTATION.record("schedules", t)
 
     weekday = day_date.weekday()
     WEEK_SCHEDULES.update(weekday, import_schedules, export_schedules)
@@ -201,33 +460,219 @@ def _update_schedules_for_day(day_date):
     return import_schedules, export_schedules
 
 
-def _get_tariff_data():
-    global TARIFF_CACHE
-    config = pyscript.app_config
+def get_site(name=None):
+    if name is None:
+        return SITES[0]
+    for site in SITES:
+        if site["name"] == name:
+            return site
+    raise ValueError(f"Unknown site: {name}")
+
+
+def _revalidate(name, fetch, site):
+    task.unique(name, kill_me=True)
+    fetch(site)
+
+
+def _get_cached(remote_cache, name, fetch, site, allow_stale=False):
+    value, cache_state = remote_cache.get(allow_stale=allow_stale)
+    if is_debug():
+        debug(f"{site['name']} {name} cache {cache_state}: {remote_cache.get_stats()}")
+    if cache_state == cache.FRESH:
+        return value
+    elif cache_state == cache.STALE and allow_stale:
+        # serve the last known value and refresh it in the background
+        task.create(_revalidate, f"powerwall_{name}_revalidate_{site['name']}", fetch, site)
+        return value
+    else:
+        return fetch(site)
+
+
+def _fetch_tariff_data(site):
+    tariff_data = _call_api(
+        "get_tariff",
+        api_wrapper.get_powerwall_tariff,
+        email=site["email"],
+        refresh_token=site["refresh_token"],
+        site_id=site["energy_site_id"]
+    )
+    TARIFF_CACHES[site["name"]].put(tariff_data)
+    return tariff_data
+
+
+def _get_tariff_data(site, allow_stale=False):
+    return _get_cached(TARIFF_CACHES[site["name"]], "tariff", _fetch_tariff_data, site, allow_stale=allow_stale)
+
+
+def _tariff_data_set(site, tariff_data, fingerprint=None):
+    TARIFF_CACHES[site["name"]].put(tariff_data)
+    TARIFF_FINGERPRINTS[site["name"]] = fingerprint if fingerprint is not None else tariff.tariff_fingerprint(tariff_data)
+
 
-    cache_ts, cache_data = TARIFF_CACHE
-    ts = dt.datetime.now(dt.timezone.utc).timestamp()
-    if ts > cache_ts + 10:
-        cache_data = api_wrapper.get_powerwall_tariff(
-            email=config["email"],
-            refresh_token=config["refresh_token"],
+def _set_tariff_data(site, tariff_data):
+    result = _upload(site, upload.TARIFF, {"tariff_data": tariff_data, "fingerprint": tariff.tariff_fingerprint(tariff_data)})
+    if result["error"]:
+        raise Exception(f"Failed to update Powerwall tariff: {result['error']}")
+
+
+def _get_upload_bucket(site):
+    bucket = UPLOAD_BUCKETS.get(site["email"])
+    if bucket is None:
+        config = pyscript.app_config
+        bucket = upload.TokenBucket(
+            rate=config.get("upload_rate", upload.DEFAULT_RATE),
+            capacity=config.get("upload_burst", upload.DEFAULT_BURST)
+        )
+        UPLOAD_BUCKETS[site["email"]] = bucket
+    return bucket
+
+
+def _write(site, entry):
+    payload = entry["payload"]
+    if entry["kind"] == upload.TARIFF:
+        _call_api(
+            "set_tariff",
+            api_wrapper.set_powerwall_tariff,
+            email=site["email"],
+            refresh_token=site["refresh_token"],
+            tariff_data=payload["tariff_data"],
+            site_id=site["energy_site_id"]
+        )
+        _tariff_data_set(site, payload["tariff_data"], payload["fingerprint"])
+    elif entry["kind"] == upload.SETTINGS:
+        _call_api(
+            "set_settings",
+            api_wrapper.set_powerwall_settings,
+            email=site["email"],
+            refresh_token=site["refresh_token"],
+            reserve_percentage=payload.get("reserve_percentage"),
+            mode=payload.get("mode"),
+            allow_grid_charging=payload.get("allow_grid_charging"),
+            allow_battery_export=payload.get("allow_battery_export"),
+            site_id=site["energy_site_id"]
         )
-        TARIFF_CACHE = (ts, cache_data)
-    return cache_data
+        SETTINGS_CACHES[site["name"]].update(payload)
 
 
-def _update_powerwall_tariff():
-    config = pyscript.app_config
+def _upload_worker(site):
+    name = site["name"]
+    bucket = _get_upload_bucket(site)
+    try:
+        while UPLOAD_QUEUE.get_depth(name) > 0:
+            # writes stay in the queue whilst waiting, so that newer ones can still replace them
+            while not bucket.take():
+                task.sleep(bucket.get_wait())
+            entry = UPLOAD_QUEUE.take(name)
+            merge = entry["kind"] == upload.SETTINGS
+            start = time.perf_counter()
+            try:
+                _write(site, entry)
+                error = None
+            except Exception as err:
+                retry_after = api_wrapper.get_retry_after(err)
+                if retry_after is not None:
+                    log.warning(f"Powerwall site {name}: rate limited, retrying in {retry_after}s")
+                    bucket.block(retry_after)
+                    # if superseded meanwhile, it is completed along with the newer write
+                    UPLOAD_QUEUE.requeue(entry, merge=merge)
+                    continue
+                error = f"{type(err).__name__}: {err}"
+            result = {"name": name, "value": None, "error": error, "duration": time.perf_counter() - start}
+            for completed in UPLOAD_QUEUE.complete(entry, error):
+                completed["result"] = result
+                completed["done"].set()
+    finally:
+        UPLOAD_WORKERS[name] = False
+
+
+def _submit_upload(site, kind, payload):
+    """
+    Queues a write to the site, returning its queue entry, whose done event is set once it has been sent.
+    """
+    entry = UPLOAD_QUEUE.submit(site["name"], kind, payload, merge=(kind == upload.SETTINGS))
+    if "done" not in entry:
+        entry["done"] = asyncio.Event()
+    if not UPLOAD_WORKERS.get(site["name"]):
+        UPLOAD_WORKERS[site["name"]] = True
+        task.create(_upload_worker, site)
+    return entry
 
-    today = dt.date.today()
-    import_schedules, export_schedules = _update_schedules_for_day(today)
-    if import_schedules is None:
-        set_status_message("No schedules for today!")
-        return
 
-    tomorrow = today + tariff.ONE_DAY_INCREMENT
-    _update_schedules_for_day(tomorrow)
+def _wait_upload(entry):
+    entry["done"].wait()
+    return entry["result"]
+
 
+def _upload(site, kind, payload):
+    return _wait_upload(_submit_upload(site, kind, payload))
+
+
+def _record_site_results(site_results, results, duration_key):
+    errors = update.record_site_results(site_results, results, duration_key)
+    for name, error in errors.items():
+        log.error(f"Powerwall site {name}: {error}")
+    return errors
+
+
+def _get_site_tariffs(sites, site_results):
+    """
+    Current tariff data for each site, from the cache where possible, else fetched concurrently.
+    Sites that could not be fetched are omitted.
+    """
+    site_tariffs, sites_to_fetch = update.split_cached(sites, TARIFF_CACHES)
+    if sites_to_fetch:
+        t = INSTRUMENTATION.start()
+        results = api_wrapper.get_site_tariffs(sites_to_fetch, max_workers=MAX_CONCURRENT_REQUESTS)
+        INSTRUMENTATION.record("fetch", t)
+        for result in results:
+            _record_api_call("get_tariff", result["error"], result["duration"])
+        _record_site_results(site_results, results, "fetch_ms")
+        update.add_fetched(site_tariffs, sites_to_fetch, results, TARIFF_CACHES)
+    return site_tariffs
+
+
+def _set_site_tariffs(sites, tariff_data, fingerprint, site_results, instrumentation=INSTRUMENTATION):
+    """
+    Uploads the tariff data to the sites concurrently (through the upload queue), returning the number successfully updated.
+    """
+    t = instrumentation.start()
+    entries = []
+    for site in sites:
+        entries.append(_submit_upload(site, upload.TARIFF, {"tariff_data": tariff_data, "fingerprint": fingerprint}))
+    results = []
+    for entry in entries:
+        results.append(_wait_upload(entry))
+    instrumentation.record("upload", t)
+    errors = _record_site_results(site_results, results, "upload_ms")
+    return len(results) - len(errors)
+
+
+def _fetch_settings(site):
+    settings = _call_api(
+        "get_settings",
+        api_wrapper.get_powerwall_settings,
+        email=site["email"],
+        refresh_token=site["refresh_token"],
+        site_id=site["energy_site_id"]
+    )
+    SETTINGS_CACHES[site["name"]].put(settings)
+    return settings
+
+
+def _get_settings(site, allow_stale=False):
+    return _get_cached(SETTINGS_CACHES[site["name"]], "settings", _fetch_settings, site, allow_stale=allow_stale)
+
+
+def _update_powerwall_tariff():
+    INSTRUMENTATION.begin_run(api_wrapper.get_api_stats())
+    try:
+        _check_powerwall_tariff()
+    finally:
+        publish_timings()
+
+
+def _build_tariff_data(day_date, week_schedules=WEEK_SCHEDULES):
+    config = pyscript.app_config
     import_plan = get_tariff_setting(IMPORT_RATES.current_tariff, "tariff_name", "Import tariff")
     export_plan = get_tariff_setting(EXPORT_RATES.current_tariff, "tariff_name", "Export tariff")
     import_standing_charge = get_sensor_value(IMPORT_RATES.current_tariff, "import_standing_charge", 0)
@@ -242,25 +687,78 @@ def _update_powerwall_tariff():
     else:
         tz = None
 
-    tariff_data = tariff.to_tariff_data(
+    return tariff.to_tariff_data(
         config["tariff_provider"],
         import_plan, import_standing_charge, import_schedule_type,
         export_plan, export_standing_charge, export_schedule_type,
-        WEEK_SCHEDULES, today, tz=tz
+        week_schedules, day_date, tz=tz
     )
 
-    debug(f"Tariff data:\n{json.dumps(tariff_data)}")
 
-    current_tariff_data = _get_tariff_data()
-    tariff_change = diff(tariff_data, current_tariff_data)
-    debug(f"Tariff diff:\n{tariff_change}")
-    if tariff_change:
-        api_wrapper.set_powerwall_tariff(
-            email=config["email"],
-            refresh_token=config["refresh_token"],
-            tariff_data=tariff_data
-        )
-        debug("Powerwall updated")
+def _stage_tariff(day_date, schedules_available):
+    if not schedules_available:
+        STAGED_TARIFF.clear()
+        return
+    staged = STAGED_TARIFF.stage(
+        day_date, WEEK_SCHEDULES,
+        get_tariff_setting(IMPORT_RATES.current_tariff, "schedule_type", "week"),
+        get_tariff_setting(EXPORT_RATES.current_tariff, "schedule_type", "week")
+    )
+    if staged:
+        debug(f"Tariff schedules staged for {day_date}")
+
+
+def _check_powerwall_tariff():
+    today = dt.date.today()
+    import_schedules, export_schedules = _update_schedules_for_day(today)
+    if import_schedules is None:
+        set_status_message("No schedules for today!")
+        return
+
+    tomorrow = today + tariff.ONE_DAY_INCREMENT
+    tomorrow_import_schedules, _ = _update_schedules_for_day(tomorrow)
+
+    t = INSTRUMENTATION.start()
+    tariff_data = _build_tariff_data(today)
+    INSTRUMENTATION.record("to_tariff_data", t)
+    METRICS.inc("tariff_computations_total", day="today")
+
+    t = INSTRUMENTATION.start()
+    fingerprint = tariff.tariff_fingerprint(tariff_data)
+    INSTRUMENTATION.record("diff", t)
+    if is_debug():
+        debug(f"Tariff data ({fingerprint}):\n{json.dumps(tariff_data)}")
+
+    unchecked_sites, unchanged_sites = update.split_by_fingerprint(SITES, TARIFF_FINGERPRINTS, fingerprint)
+    for site in unchanged_sites:
+        METRICS.inc("tariff_uploads_skipped_total", site=site["name"])
+
+    site_results = {}
+    changed_sites = []
+    if unchecked_sites:
+        for site, current_tariff_data in _get_site_tariffs(unchecked_sites, site_results):
+            t = INSTRUMENTATION.start()
+            current_fingerprint = tariff.tariff_fingerprint(current_tariff_data)
+            INSTRUMENTATION.record("diff", t)
+            if is_debug():
+                debug(f"Current tariff data for {site['name']} ({current_fingerprint}):\n{json.dumps(tariff.canonical_tariff(current_tariff_data))}")
+            if current_fingerprint == fingerprint:
+                TARIFF_FINGERPRINTS[site["name"]] = fingerprint
+                METRICS.inc("tariff_uploads_skipped_total", site=site["name"])
+            else:
+                changed_sites.append(site)
+
+    update_count = 0
+    if changed_sites:
+        INSTRUMENTATION.set_value("payload_bytes", len(json.dumps(tariff_data)))
+        update_count = _set_site_tariffs(changed_sites, tariff_data, fingerprint, site_results)
+        debug(f"Powerwalls updated: {update_count}")
+    INSTRUMENTATION.set_value("sites", site_results)
+
+    # after today's upload, so as not to delay it
+    _stage_tariff(tomorrow, tomorrow_import_schedules is not None)
+
+    if update_count > 0:
         status_msg = f"Tariff data updated at {dt.datetime.now()}"
     else:
         status_msg = f"Tariff data checked at {dt.datetime.now()}"
@@ -289,14 +787,69 @@ def _update_powerwall_tariff():
                         status_msg += "|"
             sep = ", "
         status_msg += ")"
-    if FREE_SESSIONS:
-        status_msg += " (sessions: free)"
+    sessions = PRICE_OVERLAYS.get_sessions()
+    if sessions:
+        status_msg += f" (sessions: {', '.join(sessions)})"
+    if STAGED_TARIFF.day == tomorrow:
+        status_msg += " (tomorrow staged)"
+    failed_sites = update.get_failed_sites(site_results)
+    if failed_sites:
+        status_msg += f" (failed: {', '.join(failed_sites)})"
+        breaker = api_wrapper.get_breaker_state()
+        if breaker["api_circuit"] != teslapy_wrapper.CLOSED:
+            status_msg += f" (Tesla API unavailable, retrying in {breaker['api_circuit_retry_in']}s)"
     set_status_message(status_msg)
 
 
+@time_trigger("period(now, 30min)")
+def prepare_tesla_sessions(**kwargs):
+    # log in (from the cache if possible) at startup and refresh tokens before they expire, off the update path
+    errors = api_wrapper.prepare_sessions(SITES)
+    for name, error in errors.items():
+        log.warning(f"Powerwall site {name}: {error}")
+
+
+@time_trigger("once(midnight)")
+def send_staged_tariff_data(**kwargs):
+    # the schedules were prepared when the rates arrived, so there's only the tariff to build and upload at the switchover
+    today = dt.date.today()
+    week_schedules = STAGED_TARIFF.get(today)
+    if week_schedules is None:
+        return
+    STAGED_INSTRUMENTATION.begin_run(api_wrapper.get_api_stats())
+    try:
+        # built now rather than when staged, so that it has the standing charges in effect today
+        t = STAGED_INSTRUMENTATION.start()
+        tariff_data = _build_tariff_data(today, week_schedules)
+        STAGED_INSTRUMENTATION.record("to_tariff_data", t)
+        METRICS.inc("tariff_computations_total", day="tomorrow")
+
+        t = STAGED_INSTRUMENTATION.start()
+        fingerprint = tariff.tariff_fingerprint(tariff_data)
+        STAGED_INSTRUMENTATION.record("diff", t)
+        changed_sites, unchanged_sites = update.split_by_fingerprint(SITES, TARIFF_FINGERPRINTS, fingerprint)
+        for site in unchanged_sites:
+            METRICS.inc("tariff_uploads_skipped_total", site=site["name"])
+        if not changed_sites:
+            return
+        site_results = {}
+        STAGED_INSTRUMENTATION.set_value("payload_bytes", len(json.dumps(tariff_data)))
+        update_count = _set_site_tariffs(changed_sites, tariff_data, fingerprint, site_results, instrumentation=STAGED_INSTRUMENTATION)
+        STAGED_INSTRUMENTATION.set_value("sites", site_results)
+        debug(f"Powerwalls updated with staged tariff data: {update_count}")
+        status_msg = f"Staged tariff data sent at {dt.datetime.now()}"
+        failed_sites = update.get_failed_sites(site_results)
+        if failed_sites:
+            status_msg += f" (failed: {', '.join(failed_sites)})"
+        set_status_message(status_msg)
+    finally:
+        publish_timings(STAGED_INSTRUMENTATION, prefix="staged_")
+
+
 @time_trigger("once(midnight + 2 min)")
 def update_tariff_data_at_start_of_day(**kwargs):
-    _update_powerwall_tariff()
+    # recomputes with the day's rates, catching anything the staged tariff missed (e.g. a failed upload)
+    request_tariff_check()
 
 
 @service("powerwall.refresh_tariff_data")
@@ -305,39 +858,104 @@ def refresh_tariff_data():
     name: Refresh Powerwall tariff data
     description: Immediately refreshes Powerwall tariff data with the current values
     """
-    _update_powerwall_tariff()
+    # check against the Powerwalls in case they were changed elsewhere
+    TARIFF_FINGERPRINTS.clear()
+    for remote_cache in TARIFF_CACHES.values():
+        remote_cache.invalidate()
+    request_tariff_check()
+
+
+@service("powerwall.get_metrics", supports_response="only")
+def get_metrics():
+    """yaml
+    name: Get Powerwall metrics
+    description: Counters and histograms of the app's activity, in the Prometheus text exposition format
+    """
+    return {"metrics": get_metrics_text()}
 
 
 @service("powerwall.get_tariff_data", supports_response="only")
-def get_tariff_data():
+def get_tariff_data(site=None):
     """yaml
     name: Fetches Powerwall tariff data
     description: Fetches Powerwall tariff data
+    fields:
+        site:
+            description: name of the site (defaults to the first site)
     """
-    return api_wrapper.get_powerwall_tariff(
-        email=pyscript.app_config["email"],
-        refresh_token=pyscript.app_config["refresh_token"]
-    )
+    return _get_tariff_data(get_site(site), allow_stale=True)
 
 
 @service("powerwall.set_tariff_data")
-def set_tariff_data(tariff_data):
+def set_tariff_data(tariff_data, site=None):
     """yaml
     name: Set Powerwall tariff data
     description: Set Powerwall tariff data
     fields:
         tariff_data:
             required: true
+        site:
+            description: name of the site (defaults to the first site)
+    """
+    _set_tariff_data(get_site(site), tariff_data)
+
+
+def _to_utc(value):
+    if isinstance(value, str):
+        value = dt.datetime.fromisoformat(value)
+    # naive times are local
+    return value.astimezone(dt.timezone.utc)
+
+
+@service("powerwall.override_price")
+def override_price(start, end, price=None, adjustment=None):
+    """yaml
+    name: Override Powerwall tariff price
+    description: Overrides the import price for a period, taking precedence over free and saving sessions
+    fields:
+        start:
+            required: true
+            selector:
+                datetime:
+        end:
+            required: true
+            selector:
+                datetime:
+        price:
+            description: import price for the period
+        adjustment:
+            description: amount added to the import price for the period, if no price is given
     """
-    api_wrapper.set_powerwall_tariff(
-        email=pyscript.app_config["email"],
-        refresh_token=pyscript.app_config["refresh_token"],
-        tariff_data=tariff_data
+    start = _to_utc(start)
+    end = _to_utc(end)
+    if end <= start:
+        raise ValueError("The end of a price override must be after its start")
+    if price is None and adjustment is None:
+        raise ValueError("A price override requires a price or an adjustment")
+    # drop overrides that no longer affect the schedules
+    PRICE_OVERLAYS.expire(tariff.get_day_bounds(dt.date.today())[0])
+    PRICE_OVERLAYS.add(
+        tariff.MANUAL_OVERRIDE,
+        start,
+        end,
+        price=float(price) if price is not None else None,
+        adjustment=float(adjustment) if adjustment is not None else 0.0
     )
+    request_tariff_update()
+
+
+@service("powerwall.clear_price_overrides")
+def clear_price_overrides():
+    """yaml
+    name: Clear Powerwall tariff price overrides
+    description: Removes all price overrides set by powerwall.override_price
+    """
+    PRICE_OVERLAYS.clear(tariff.MANUAL_OVERRIDE)
+    request_tariff_update()
 
 
 @service("powerwall.set_settings")
-def set_settings(reserve_percentage=None, mode=None, allow_grid_charging=None, allow_battery_export=None, verify=False):
+def set_settings(reserve_percentage=None, mode=None, allow_grid_charging=None, allow_battery_export=None, verify=False, site=None):
     """yaml
     name: Set Powerwall settings
     description: Changes Powerwall settings
@@ -368,28 +986,28 @@ def set_settings(reserve_percentage=None, mode=None, allow_grid_charging=None, a
             description: verify settings have been updated
             selector:
                 boolean:
+        site:
+            description: name of the site (defaults to the first site)
     """
+    site = get_site(site)
     updated = False
     retry_count = 0
     while not updated:
         if retry_count == 3:
             raise Exception("Failed to update Powerwall settings")
 
-        api_wrapper.set_powerwall_settings(
-            email=pyscript.app_config["email"],
-            refresh_token=pyscript.app_config["refresh_token"],
-            reserve_percentage=reserve_percentage,
-            mode=mode,
-            allow_grid_charging=allow_grid_charging,
-            allow_battery_export=allow_battery_export
-        )
+        result = _upload(site, upload.SETTINGS, {
+            "reserve_percentage": reserve_percentage,
+            "mode": mode,
+            "allow_grid_charging": allow_grid_charging,
+            "allow_battery_export": allow_battery_export
+        })
+        if result["error"]:
+            raise Exception(f"Failed to update Powerwall settings: {result['error']}")
         updated = True
         retry_count += 1
         if verify:
-            settings = api_wrapper.get_powerwall_settings(
-                email=pyscript.app_config["email"],
-                refresh_token=pyscript.app_config["refresh_token"]
-            )
+            settings = _fetch_settings(site)
             if reserve_percentage is not None:
                 if settings["reserve_percentage"] == reserve_percentage:
                     reserve_percentage = None
@@ -413,12 +1031,12 @@ def set_settings(reserve_percentage=None, mode=None, allow_grid_charging=None, a
 
 
 @service("powerwall.get_settings", supports_response="only")
-def get_settings():
+def get_settings(site=None):
     """yaml
     name: Get Powerwall settings
     description: Gets Powerwall settings
+    fields:
+        site:
+            description: name of the site (defaults to the first site)
     """
-    return api_wrapper.get_powerwall_settings(
-        email=pyscript.app_config["email"],
-        refresh_token=pyscript.app_config["refresh_token"]
-    )
+    return _get_settings(get_site(site), allow_stale=True)
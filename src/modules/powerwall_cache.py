@@ -0,0 +1,71 @@
+import time
+
+
+FRESH = "fresh"
+STALE = "stale"
+MISSING = "missing"
+
+
+class RemoteCache:
+    """
+    Last known value of remote (Powerwall) state.
+    Values older than the TTL are stale but still available to callers that can tolerate them.
+    """
+    def __init__(self, ttl, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.value = None
+        self.timestamp = None
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def get_state(self):
+        if self.timestamp is None:
+            return MISSING
+        elif self.clock() - self.timestamp > self.ttl:
+            return STALE
+        else:
+            return FRESH
+
+    def get(self, allow_stale=False):
+        """
+        Returns the cached value and its state, or None if a fetch is required.
+        """
+        state = self.get_state()
+        if state == FRESH:
+            self.hits += 1
+            return self.value, state
+        elif state == STALE and allow_stale:
+            self.stale_hits += 1
+            return self.value, state
+        else:
+            self.misses += 1
+            return None, state
+
+    def put(self, value):
+        self.value = value
+        self.timestamp = self.clock()
+
+    def update(self, changes):
+        """
+        Applies a partial write to the cached value, if there is one.
+        The age of the value is unchanged as the rest of it is no more recent.
+        """
+        if self.timestamp is not None and self.value is not None:
+            value = dict(self.value)
+            for key, v in changes.items():
+                if v is not None:
+                    value[key] = v
+            self.value = value
+
+    def invalidate(self):
+        self.value = None
+        self.timestamp = None
+
+    def get_stats(self):
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses
+        }
@@ -0,0 +1,69 @@
+import re
+
+import powerwall_tariff as tariff
+
+
+BREAKS_KEYS = ["import_tariff_breaks", "export_tariff_breaks", "plunge_pricing_tariff_breaks"]
+PRICING_KEYS = ["import_tariff_pricing", "export_tariff_pricing", "plunge_pricing_tariff_pricing"]
+
+
+class TariffSettings:
+    """
+    The settings for a tariff code: those of the first tariffs entry matching it, else the top-level ones,
+    with break and pricing expressions already parsed.
+    """
+    def __init__(self, values):
+        self.values = values
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+
+def compile_settings(config, tariff_config):
+    """
+    Resolves and validates the settings of a tariffs entry, raising ValueError if they are invalid.
+    """
+    values = dict(config)
+    values.update(tariff_config)
+    for key in BREAKS_KEYS:
+        if key in values:
+            values[key] = tariff.compile_breaks(values[key])
+    for key in PRICING_KEYS:
+        if key in values:
+            values[key] = tariff.compile_pricing(values[key])
+    for breaks_key, pricing_key in zip(BREAKS_KEYS, PRICING_KEYS):
+        breaks = values.get(breaks_key)
+        pricing = values.get(pricing_key)
+        if type(breaks) == list and type(pricing) == list and len(breaks) + 1 != len(pricing):
+            raise ValueError(f"The number of breaks ({breaks_key}) is inconsistent with the number of pricing functions ({pricing_key}).")
+    return TariffSettings(values)
+
+
+class AppConfig:
+    """
+    The app config, compiled once: the settings of every tariffs entry are resolved and validated up front,
+    and the entry for each tariff code is matched on first use.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.tariffs = []
+        for tariff_config in config.get("tariffs", []):
+            self.tariffs.append((re.compile(tariff_config["tariff_code"]), compile_settings(config, tariff_config)))
+        self.default_settings = compile_settings(config, {})
+        # tariff code -> TariffSettings
+        self._settings = {}
+
+    def get_settings(self, tariff_code):
+        settings = self._settings.get(tariff_code)
+        if settings is None:
+            settings = self.default_settings
+            if tariff_code is not None:
+                for pattern, tariff_settings in self.tariffs:
+                    if pattern.match(tariff_code):
+                        settings = tariff_settings
+                        break
+            self._settings[tariff_code] = settings
+        return settings
+
+    def get(self, tariff_code, key, default=None):
+        return self.get_settings(tariff_code).get(key, default)
@@ -0,0 +1,213 @@
+import bisect
+from collections import deque
+import time
+
+
+DEFAULT_WINDOW = 50
+
+# seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, round(p/100.0*len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class UpdateInstrumentation:
+    """
+    Durations of the stages of a tariff update, with rolling statistics over recent updates,
+    together with the API activity (counted by the API wrapper) during each update.
+    """
+    def __init__(self, window=DEFAULT_WINDOW, clock=time.perf_counter):
+        self.window = window
+        self.clock = clock
+        self.history = {}
+        self.current = None
+        self.current_values = None
+        self.last = {}
+        self.last_counts = {}
+        self.run_count = 0
+        self._run_start = None
+        self._start_counts = {}
+
+    def begin_run(self, counts=None):
+        if self.current is None:
+            self.current = {}
+            self.current_values = {}
+            self._run_start = self.clock()
+            self._start_counts = dict(counts) if counts else {}
+
+    def start(self):
+        return self.clock()
+
+    def record(self, stage, start_time):
+        """
+        Adds the time since start_time to the stage, if an update is in progress.
+        """
+        duration = self.clock() - start_time
+        if self.current is not None:
+            self.current[stage] = self.current.get(stage, 0.0) + duration
+        return duration
+
+    def set_value(self, name, value):
+        if self.current is not None:
+            self.current_values[name] = value
+
+    def end_run(self, counts=None):
+        if self.current is None:
+            return
+        self.current["total"] = self.clock() - self._run_start
+        for stage, duration in self.current.items():
+            stage_history = self.history.get(stage)
+            if stage_history is None:
+                stage_history = deque(maxlen=self.window)
+                self.history[stage] = stage_history
+            stage_history.append(duration)
+        self.last = self.current
+        self.last_counts = {}
+        if counts:
+            for name, count in counts.items():
+                self.last_counts[name] = count - self._start_counts.get(name, 0)
+        self.last_counts.update(self.current_values)
+        self.run_count += 1
+        self.current = None
+
+    def get_attributes(self):
+        attrs = {"updates": self.run_count}
+        for stage, duration in self.last.items():
+            attrs[f"{stage}_ms"] = round(1000.0*duration, 1)
+        for stage, stage_history in self.history.items():
+            attrs[f"{stage}_p50_ms"] = round(1000.0*percentile(stage_history, 50), 1)
+            attrs[f"{stage}_p95_ms"] = round(1000.0*percentile(stage_history, 95), 1)
+        attrs.update(self.last_counts)
+        return attrs
+
+
+def _format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels)
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    parts = []
+    for name, value in pairs:
+        parts.append(f'{name}="{_escape_label(value)}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _label_key(labels):
+    # values as strings, as rendered, so that samples sort whatever the values' types (e.g. None)
+    items = []
+    for name, value in labels.items():
+        items.append((name, str(value)))
+    return tuple(sorted(items))
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms, optionally labelled, rendered in the Prometheus text exposition format.
+    Counters may also be set outright, to export totals that are counted elsewhere.
+    """
+    def __init__(self, namespace="powerwall"):
+        self.namespace = namespace
+        # name -> {"type", "help", "buckets", "samples": {labels: value, or [bucket counts, sum, count] for histograms}}
+        self.metrics = {}
+
+    def _define(self, name, metric_type, help_text, buckets=None):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = {"type": metric_type, "help": help_text, "buckets": buckets, "samples": {}}
+            self.metrics[name] = metric
+        elif metric["type"] != metric_type:
+            raise ValueError(f"Metric {name} is a {metric['type']}")
+        return metric
+
+    def counter(self, name, help_text):
+        self._define(name, COUNTER, help_text)
+
+    def gauge(self, name, help_text):
+        self._define(name, GAUGE, help_text)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self._define(name, HISTOGRAM, help_text, tuple(sorted(buckets)))
+
+    def _get_metric(self, name):
+        metric = self.metrics.get(name)
+        if metric is None:
+            raise ValueError(f"Unknown metric: {name}")
+        return metric
+
+    def inc(self, name, amount=1, **labels):
+        metric = self._get_metric(name)
+        key = _label_key(labels)
+        metric["samples"][key] = metric["samples"].get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        metric = self._get_metric(name)
+        metric["samples"][_label_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        metric = self._get_metric(name)
+        key = _label_key(labels)
+        sample = metric["samples"].get(key)
+        if sample is None:
+            # the last bucket is +Inf
+            sample = [[0]*(len(metric["buckets"]) + 1), 0.0, 0]
+            metric["samples"][key] = sample
+        sample[0][bisect.bisect_left(metric["buckets"], value)] += 1
+        sample[1] += value
+        sample[2] += 1
+
+    def get_value(self, name, **labels):
+        """
+        The value of a counter or gauge, or the number of observations of a histogram.
+        """
+        sample = self._get_metric(name)["samples"].get(_label_key(labels))
+        if sample is None:
+            return None
+        return sample[2] if type(sample) == list else sample
+
+    def render(self):
+        lines = []
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            full_name = f"{self.namespace}_{name}" if self.namespace else name
+            lines.append(f"# HELP {full_name} {metric['help']}")
+            lines.append(f"# TYPE {full_name} {metric['type']}")
+            for labels, sample in sorted(metric["samples"].items()):
+                if metric["type"] == HISTOGRAM:
+                    bucket_counts, total, count = sample
+                    cumulative = 0
+                    bounds = list(metric["buckets"]) + [float("inf")]
+                    for bound, bucket_count in zip(bounds, bucket_counts):
+                        cumulative += bucket_count
+                        lines.append(f"{full_name}_bucket{_format_labels(labels, ('le', _format_number(bound)))} {cumulative}")
+                    lines.append(f"{full_name}_sum{_format_labels(labels)} {_format_number(total)}")
+                    lines.append(f"{full_name}_count{_format_labels(labels)} {count}")
+                else:
+                    lines.append(f"{full_name}{_format_labels(labels)} {_format_number(sample)}")
+        return "\n".join(lines) + "\n"
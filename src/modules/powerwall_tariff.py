@@ -1,18 +1,30 @@
-from collections import defaultdict
+from array import array
+import bisect
+from collections import OrderedDict, defaultdict
 import datetime as dt
-import itertools
+import hashlib
+import json
+import operator
 import sys
 
 
 if "/config/pyscript_packages" not in sys.path:
     sys.path.append("/config/pyscript_packages")
-#import jenkspy
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 EXCLUSIVE_OFFSET = 0.000001
 
 ONE_DAY_INCREMENT = dt.timedelta(days=1)
 SLOT_TIME_INCREMENT = dt.timedelta(minutes=30)
+SLOT_SECONDS = int(SLOT_TIME_INCREMENT.total_seconds())
+
+MINUTES_PER_DAY = 24*60
+FULL_WEEK = (0, 6)
+WHOLE_DAY = (0, MINUTES_PER_DAY)
 
 DEFAULT_CHARGE_NAMES = [
     ["OFF_PEAK"],
@@ -22,16 +34,53 @@ DEFAULT_CHARGE_NAMES = [
 ]
 
 PRICE_KEY = "value_inc_vat"
+CAPPED_KEY = "is_capped"
+# fields held as columns by RateTimeline, any others are kept as extras
+RATE_KEYS = frozenset(["start", "end", PRICE_KEY, CAPPED_KEY])
 PRICE_CAP = 1.00
 
+FREE_SESSION = "free"
+SAVING_SESSION = "saving"
+MANUAL_OVERRIDE = "manual"
+# where overlays overlap the highest priority applies
+OVERLAY_PRIORITIES = {SAVING_SESSION: 1, FREE_SESSION: 2, MANUAL_OVERRIDE: 3}
+
 INDIVIDUAL_BREAKS = "individual"
 JENKS_BREAKS = "jenks"
+JENKS_CACHE_SIZE = 16
+# use numpy for larger inputs, if available
+JENKS_NUMPY_THRESHOLD = 100
+OPTIMIZE_BREAKS = "optimize"
+OPTIMIZE_PRICING = "optimize"
+# pricing functions the optimizer chooses between for each band
+OPTIMIZE_PRICING_CANDIDATES = ["average", "nonNegativeAverage", "minimum", "maximum"]
+# cost of moving a break from the previous day's, per unit price per hour of the day,
+# relative to the cost of an hour's price error
+OPTIMIZE_STABILITY_WEIGHT = 0.1
+OPTIMIZE_NUMPY_THRESHOLD = 16
 
 DEFAULT_BREAKS = INDIVIDUAL_BREAKS
 DEFAULT_PRICING = "average"
 
 DAYS_IN_WEEK = 7
 
+# decimal places that matter when comparing tariffs
+TARIFF_PRECISION = 4
+# the fields we set, as nested dicts and single item lists, ANY_KEY standing for names we choose (seasons, charges)
+# and None for any value
+ANY_KEY = "*"
+TOU_PERIOD_SCHEMA = dict.fromkeys(["fromDayOfWeek", "fromHour", "fromMinute", "toDayOfWeek", "toHour", "toMinute"])
+SEASON_SCHEMA = dict.fromkeys(["fromMonth", "fromDay", "toMonth", "toDay"])
+SEASON_SCHEMA["tou_periods"] = {ANY_KEY: [TOU_PERIOD_SCHEMA]}
+TARIFF_SCHEMA = {
+    "name": None,
+    "utility": None,
+    "daily_charges": [{"name": None, "amount": None}],
+    "demand_charges": {ANY_KEY: {ANY_KEY: None}},
+    "seasons": {ANY_KEY: SEASON_SCHEMA},
+    "energy_charges": {ANY_KEY: {ANY_KEY: None}}
+}
+
 
 def get_day_bounds(day_date):
     day_start = dt.datetime.combine(day_date, dt.time.min).astimezone(dt.timezone.utc)
@@ -41,12 +90,16 @@ def get_day_bounds(day_date):
 
 def extend_from(rates, start_time):
     first = rates[0]
+    padding = []
     while first["start"] > start_time:
         new_first = first.copy()
         new_first["start"] = first["start"] - SLOT_TIME_INCREMENT
         new_first["end"] = first["start"]
-        rates.insert(0, new_first)
+        padding.append(new_first)
         first = new_first
+    if padding:
+        padding.reverse()
+        rates[:0] = padding
 
 
 def extend_to(rates, end_time):
@@ -67,6 +120,391 @@ def _safe_less_than(x, y):
     return y is not None and x < y
 
 
+def _to_epoch(t):
+    return int(t.timestamp())
+
+
+def _from_epoch(t):
+    return dt.datetime.fromtimestamp(t, dt.timezone.utc)
+
+
+class RateTimeline:
+    """
+    Rates held as compact parallel columns (epoch seconds, prices and capped flags) rather than a dict per rate,
+    so a time range can be located by bisection.
+    Rate dicts are only created for the ranges asked for.
+    """
+    def __init__(self, rates=None):
+        self.starts = array('q')
+        self.ends = array('q')
+        self.prices = array('d')
+        # 1/0, or -1 if not given
+        self.capped = array('b')
+        # index -> any other fields of the rate
+        self.extras = {}
+        self._ranges = {}
+        # epoch -> datetime, as each rate's end is usually the next one's start
+        self._datetimes = {}
+        if rates:
+            for r in rates:
+                self.append(r)
+
+    def append(self, rate):
+        capped = rate.get(CAPPED_KEY)
+        extra_keys = rate.keys() - RATE_KEYS
+        if extra_keys:
+            extra = {}
+            for key in extra_keys:
+                extra[key] = rate[key]
+            self.extras[len(self.starts)] = extra
+        self.starts.append(_to_epoch(rate["start"]))
+        self.ends.append(_to_epoch(rate["end"]))
+        self.prices.append(rate[PRICE_KEY])
+        self.capped.append(-1 if capped is None else int(capped))
+
+    def get_count(self):
+        return len(self.starts)
+
+    def get_rate(self, i):
+        """
+        The rate as a dict, for code that expects the same shape as the integration events.
+        """
+        rate = {"start": self._to_datetime(self.starts[i]), "end": self._to_datetime(self.ends[i]), PRICE_KEY: self.prices[i]}
+        if self.capped[i] >= 0:
+            rate[CAPPED_KEY] = self.capped[i] == 1
+        extra = self.extras.get(i)
+        if extra:
+            rate.update(extra)
+        return rate
+
+    def _to_datetime(self, t):
+        v = self._datetimes.get(t)
+        if v is None:
+            v = _from_epoch(t)
+            self._datetimes[t] = v
+        return v
+
+    def get_rates(self, lo, hi):
+        """
+        Rate dicts for the index range, created once and shared, so callers get a new list of them.
+        """
+        key = (lo, hi)
+        rates = self._ranges.get(key)
+        if rates is None:
+            rates = []
+            for i in range(lo, hi):
+                rates.append(self.get_rate(i))
+            self._ranges[key] = rates
+        return list(rates)
+
+    def index_range(self, start, end):
+        lo = bisect.bisect_left(self.starts, _to_epoch(start))
+        hi = bisect.bisect_right(self.ends, _to_epoch(end))
+        return lo, max(lo, hi)
+
+    def between(self, start, end):
+        lo, hi = self.index_range(start, end)
+        return self.get_rates(lo, hi)
+
+    def prices_between(self, start, end):
+        lo, hi = self.index_range(start, end)
+        return self.prices[lo:hi]
+
+
+class DayRates:
+    """
+    A day's rates as a view of a timeline's index range, padded to 24 hours by repeating the first and last prices
+    in whole slots. Padding slots are located by index arithmetic, so nothing is copied.
+    Prices may be overridden slot by slot (e.g. for free sessions) without changing the timeline.
+    """
+    def __init__(self, timeline, lo, hi, start, end):
+        self.timeline = timeline
+        self.lo = lo
+        self.hi = hi
+        # whole slots needed to reach the day's (epoch) bounds
+        self.pad_before = max(0, -((start - timeline.starts[lo]) // SLOT_SECONDS))
+        self.pad_after = max(0, -((timeline.ends[hi - 1] - end) // SLOT_SECONDS))
+        # slot index -> (price, session)
+        self.overrides = {}
+        # incremented by each override, so that anything derived from the prices can tell they changed
+        self.version = 0
+        self._prices = None
+        self._starts = None
+        self._ends = None
+
+    def get_count(self):
+        return self.pad_before + (self.hi - self.lo) + self.pad_after
+
+    def _offset(self, i):
+        """
+        The slot's offset into the timeline's range, negative in the padding before and beyond the range after.
+        """
+        return i - self.pad_before
+
+    def get_start(self, i):
+        j = self._offset(i)
+        n = self.hi - self.lo
+        if j < 0:
+            return self.timeline.starts[self.lo] + j*SLOT_SECONDS
+        elif j < n:
+            return self.timeline.starts[self.lo + j]
+        else:
+            return self.timeline.ends[self.hi - 1] + (j - n)*SLOT_SECONDS
+
+    def get_end(self, i):
+        j = self._offset(i)
+        n = self.hi - self.lo
+        if j < 0:
+            return self.timeline.starts[self.lo] + (j + 1)*SLOT_SECONDS
+        elif j < n:
+            return self.timeline.ends[self.lo + j]
+        else:
+            return self.timeline.ends[self.hi - 1] + (j - n + 1)*SLOT_SECONDS
+
+    def get_start_time(self, i):
+        return self.timeline._to_datetime(self.get_start(i))
+
+    def get_end_time(self, i):
+        return self.timeline._to_datetime(self.get_end(i))
+
+    def _get_times(self, times, offset):
+        """
+        The given timeline column for every slot, with the padding's times stepped out from the boundary rates.
+        """
+        timeline = self.timeline
+        first = timeline.starts[self.lo] + offset
+        last = timeline.ends[self.hi - 1] + offset - SLOT_SECONDS
+        slot_times = array('q')
+        for k in range(self.pad_before, 0, -1):
+            slot_times.append(first - k*SLOT_SECONDS)
+        slot_times.extend(times[self.lo:self.hi])
+        for k in range(1, self.pad_after + 1):
+            slot_times.append(last + k*SLOT_SECONDS)
+        return slot_times
+
+    def get_starts(self):
+        """
+        The (epoch) start of every slot.
+        """
+        if self._starts is None:
+            self._starts = self._get_times(self.timeline.starts, 0)
+        return self._starts
+
+    def get_ends(self):
+        """
+        The (epoch) end of every slot.
+        """
+        if self._ends is None:
+            self._ends = self._get_times(self.timeline.ends, SLOT_SECONDS)
+        return self._ends
+
+    def get_start_times(self):
+        times = []
+        for t in self.get_starts():
+            times.append(self.timeline._to_datetime(t))
+        return times
+
+    def get_end_times(self):
+        times = []
+        for t in self.get_ends():
+            times.append(self.timeline._to_datetime(t))
+        return times
+
+    def _timeline_index(self, i):
+        return min(max(self.lo + self._offset(i), self.lo), self.hi - 1)
+
+    def get_price(self, i):
+        override = self.overrides.get(i)
+        if override is not None:
+            return override[0]
+        return self.timeline.prices[self._timeline_index(i)]
+
+    def get_prices(self):
+        """
+        The price of every slot, including the padding and any overrides.
+        """
+        if self._prices is None:
+            timeline = self.timeline
+            prices = array('d', [timeline.prices[self.lo]])*self.pad_before
+            prices.extend(timeline.prices[self.lo:self.hi])
+            prices.extend(array('d', [timeline.prices[self.hi - 1]])*self.pad_after)
+            for i, override in self.overrides.items():
+                prices[i] = override[0]
+            self._prices = prices
+        return self._prices
+
+    def set_price(self, i, price, session=None):
+        self.overrides[i] = (price, session)
+        self.version += 1
+        self._prices = None
+
+    def get_rate(self, i):
+        """
+        The slot as a rate dict, for code that expects the same shape as the integration events.
+        """
+        rate = self.timeline.get_rate(self._timeline_index(i))
+        rate["start"] = self.get_start_time(i)
+        rate["end"] = self.get_end_time(i)
+        override = self.overrides.get(i)
+        if override is not None:
+            rate[PRICE_KEY] = override[0]
+            if override[1] is not None:
+                rate["session"] = override[1]
+        return rate
+
+    def to_list(self):
+        rates = []
+        for i in range(self.get_count()):
+            rates.append(self.get_rate(i))
+        return rates
+
+
+# (start, end, priority, price, adjustment, session)
+OVERLAY_ORDER = operator.itemgetter(0, 1)
+
+
+class PriceOverlays:
+    """
+    Price overrides over time intervals, such as free sessions, saving sessions and manual overrides,
+    each either a fixed price or an adjustment to the rate's price.
+    They are applied to a day's rates in one sweep, in start order, and only the slots they overlap are touched.
+    Where overlays overlap the highest priority applies, and a slot only partly covered gets
+    the time-weighted average of its overridden and original prices.
+    """
+    def __init__(self):
+        self.overlays = []
+
+    def add(self, session, start, end, price=None, adjustment=0.0):
+        self.overlays.append((_to_epoch(start), _to_epoch(end), OVERLAY_PRIORITIES.get(session, 0), price, adjustment, session))
+        self.overlays.sort(key=OVERLAY_ORDER)
+
+    def clear(self, session=None):
+        if session is None:
+            self.overlays = []
+        else:
+            overlays = []
+            for overlay in self.overlays:
+                if overlay[5] != session:
+                    overlays.append(overlay)
+            self.overlays = overlays
+
+    def expire(self, before):
+        """
+        Removes overlays that end by the given time.
+        """
+        t = _to_epoch(before)
+        overlays = []
+        for overlay in self.overlays:
+            if overlay[1] > t:
+                overlays.append(overlay)
+        self.overlays = overlays
+
+    def overlaps(self, start, end):
+        """
+        Whether any overlay overlaps the given time interval.
+        """
+        start = _to_epoch(start)
+        end = _to_epoch(end)
+        for overlay in self.overlays:
+            if overlay[0] < end and overlay[1] > start:
+                return True
+        return False
+
+    def get_sessions(self):
+        sessions = []
+        for overlay in self.overlays:
+            if overlay[5] not in sessions:
+                sessions.append(overlay[5])
+        return sessions
+
+    def apply(self, day_rates):
+        """
+        Overrides the prices of the slots of the day's rates (as given by Rates.cover_day) covered by overlays.
+        """
+        overlays = self.overlays
+        if not overlays or not day_rates:
+            return day_rates
+        k = 0
+        active = []
+        for i, (start, end) in enumerate(zip(day_rates.get_starts(), day_rates.get_ends())):
+            while k < len(overlays) and overlays[k][0] < end:
+                active.append(overlays[k])
+                k += 1
+            overlapping = []
+            for overlay in active:
+                if overlay[1] > start:
+                    overlapping.append(overlay)
+            active = overlapping
+            if active:
+                self._apply_slot(day_rates, i, start, end, active)
+        return day_rates
+
+    def _apply_slot(self, day_rates, i, start, end, overlays):
+        base_price = day_rates.get_price(i)
+        points = set([start, end])
+        for overlay in overlays:
+            points.add(min(max(overlay[0], start), end))
+            points.add(min(max(overlay[1], start), end))
+        points = sorted(points)
+        total = 0.0
+        session = None
+        session_priority = None
+        for a, b in zip(points[:-1], points[1:]):
+            # the highest priority overlay covering [a, b)
+            top = None
+            for overlay in overlays:
+                if overlay[0] <= a and overlay[1] >= b and (top is None or overlay[2] > top[2]):
+                    top = overlay
+            if top is None:
+                total += (b - a)*base_price
+            else:
+                total += (b - a)*(top[3] if top[3] is not None else base_price + top[4])
+                if session_priority is None or top[2] > session_priority:
+                    session = top[5]
+                    session_priority = top[2]
+        if session_priority is not None:
+            day_rates.set_price(i, total/(end - start), session=session)
+
+
+def _as_timeline(rates):
+    if isinstance(rates, RateTimeline):
+        return rates
+    return RateTimeline(rates)
+
+
+def _merge_timelines(timelines):
+    """
+    A single timeline of all the rates, in start order.
+    """
+    if len(timelines) == 1:
+        return timelines[0]
+    starts = []
+    for timeline_index, timeline in enumerate(timelines):
+        for i in range(timeline.get_count()):
+            starts.append((timeline.starts[i], timeline_index, i))
+    starts.sort()
+    merged = RateTimeline()
+    for _, timeline_index, i in starts:
+        timeline = timelines[timeline_index]
+        extra = timeline.extras.get(i)
+        if extra:
+            merged.extras[merged.get_count()] = extra
+        merged.starts.append(timeline.starts[i])
+        merged.ends.append(timeline.ends[i])
+        merged.prices.append(timeline.prices[i])
+        merged.capped.append(timeline.capped[i])
+    return merged
+
+
+def _contiguity_error(day_rates, next_day_rates, description):
+    if day_rates.get_count() > 0 and next_day_rates.get_count() > 0:
+        day_end = day_rates.ends[-1]
+        next_day_start = next_day_rates.starts[0]
+        if next_day_start != day_end:
+            return f"{description} rates are not contiguous: {_from_epoch(day_end)} {_from_epoch(next_day_start)}"
+    return None
+
+
 class Rates:
     def __init__(self):
         self.previous_tariff = None
@@ -78,21 +516,43 @@ class Rates:
         self.next_tariff = None
         self.next_day = []
         self._next_day_updated = None
+        self._timeline = None
+        self._contiguity_error = None
+        self._price_rankings = {}
+
+    # rates are converted to timelines as they arrive, but lists of rate dicts may also be assigned directly
 
     def update_previous_day(self, tariff_code, rates):
         self.previous_tariff = tariff_code
-        self.previous_day = rates
+        self.previous_day = RateTimeline(rates)
         self._previous_day_updated = dt.date.today()
+        self._update_timeline()
 
     def update_current_day(self, tariff_code, rates):
         self.current_tariff = tariff_code
-        self.current_day = rates
+        self.current_day = RateTimeline(rates)
         self._current_day_updated = dt.date.today()
+        self._update_timeline()
 
     def update_next_day(self, tariff_code, rates):
         self.next_tariff = tariff_code
-        self.next_day = rates
+        self.next_day = RateTimeline(rates)
         self._next_day_updated = dt.date.today()
+        self._update_timeline()
+
+    def _update_timeline(self):
+        previous_day = _as_timeline(self.previous_day)
+        current_day = _as_timeline(self.current_day)
+        next_day = _as_timeline(self.next_day)
+        self._contiguity_error = _contiguity_error(previous_day, current_day, "Previous to current day") \
+            or _contiguity_error(current_day, next_day, "Current to next day")
+        self._timeline = _merge_timelines([previous_day, current_day, next_day])
+        self._price_rankings = {}
+
+    def get_timeline(self):
+        if self._timeline is None:
+            self._update_timeline()
+        return self._timeline
 
     def is_valid(self):
         if self._current_day_updated is None or self._previous_day_updated != self._current_day_updated or self._next_day_updated != self._current_day_updated:
@@ -105,33 +565,49 @@ class Rates:
                 pending.append("next day")
             raise ValueError(f"Waiting for rate data: {', '.join(pending)}")
 
-        if len(self.previous_day) > 0 and len(self.current_day) > 0:
-            previous_day_end = self.previous_day[-1]["end"]
-            current_day_start = self.current_day[0]["start"]
-            if current_day_start != previous_day_end:
-                raise ValueError(f"Previous to current day rates are not contiguous: {previous_day_end} {current_day_start}")
+        if self._contiguity_error:
+            raise ValueError(self._contiguity_error)
 
-        if len(self.current_day) > 0 and len(self.next_day) > 0:
-            current_day_end = self.current_day[-1]["end"]
-            next_day_start = self.next_day[0]["start"]
-            if next_day_start != current_day_end:
-                raise ValueError(f"Current to next day rates are not contiguous: {current_day_end} {next_day_start}")
+    def has_updates(self):
+        """
+        Whether any rates have arrived since the last reset.
+        """
+        return self._previous_day_updated is not None or self._current_day_updated is not None or self._next_day_updated is not None
 
     def between(self, start, end):
-        if self.previous_day or self.current_day or self.next_day:  # pyscript doesn't like empty list comprehensions
-            all_rates = itertools.chain(self.previous_day, self.current_day, self.next_day)
-            return [rate for rate in all_rates if rate["start"] >= start and rate["end"] <= end]
-        else:
-            return []
+        return self.get_timeline().between(start, end)
+
+    def get_price_ranking(self, day_date, num_days, overlays=None):
+        """
+        The prices of the days ranked, with any price overlays applied.
+        Only rankings without overlays are cached (until the rates are updated), as overlays change independently.
+        """
+        start, _ = get_day_bounds(day_date)
+        _, end = get_day_bounds(day_date + (num_days - 1) * ONE_DAY_INCREMENT)
+        if overlays is not None and overlays.overlaps(start, end):
+            timeline = self.get_timeline()
+            lo, hi = timeline.index_range(start, end)
+            if lo < hi:
+                # a view of just the published rates, so nothing is padded
+                days_rates = DayRates(timeline, lo, hi, timeline.starts[lo], timeline.ends[hi - 1])
+                return PriceRanking(overlays.apply(days_rates).get_prices())
+        key = (day_date, num_days)
+        ranking = self._price_rankings.get(key)
+        if ranking is None:
+            ranking = PriceRanking(self.get_timeline().prices_between(start, end))
+            self._price_rankings[key] = ranking
+        return ranking
 
     def cover_day(self, day_date):
+        """
+        A view of the day's rates padded to cover 24 hours, or an empty list if there are none.
+        """
         day_start, day_end = get_day_bounds(day_date)
-        day_rates = self.between(day_start, day_end)
-        if day_rates:
-            # pad rates to cover 24 hours
-            extend_from(day_rates, day_start)
-            extend_to(day_rates, day_end)
-        return day_rates
+        timeline = self.get_timeline()
+        lo, hi = timeline.index_range(day_start, day_end)
+        if lo == hi:
+            return []
+        return DayRates(timeline, lo, hi, _to_epoch(day_start), _to_epoch(day_end))
 
     def reset(self):
         self._previous_day_updated = None
@@ -149,25 +625,36 @@ class Schedule:
         self._value = None
         self._start = None
         self._end = None
+        # converts the times given to add_slot (e.g. epoch seconds) to those of the periods
+        self.to_time = None
 
     def is_in(self, rate):
         return self.assigner_func.is_in(rate)
 
     def add(self, rate):
+        self.add_slot(rate["start"], rate["end"], rate[self.pricing_key])
+
+    def add_slot(self, start, end, price):
         if self._start is None:
-            self._start = rate["start"]
-            self._end = rate["end"]
-        elif rate['start'] == self._end:
-            self._end = rate["end"]
+            self._start = start
+            self._end = end
+        elif start == self._end:
+            self._end = end
         else:
+            self._add_period()
+            self._start = start
+            self._end = end
+        self.pricing_func.add(price)
+
+    def _add_period(self):
+        if self.to_time is None:
             self._periods.append((self._start, self._end))
-            self._start = rate["start"]
-            self._end = rate["end"]
-        self.pricing_func.add(rate[self.pricing_key])
+        else:
+            self._periods.append((self.to_time(self._start), self.to_time(self._end)))
 
     def get_periods(self):
         if self._start is not None:
-            self._periods.append((self._start, self._end))
+            self._add_period()
             self._start = None
             self._end = None
         return self._periods
@@ -193,6 +680,12 @@ class WeekSchedules:
     def get_schedules(self, weekday, export=False):
         return self.export_schedules[weekday] if export else self.import_schedules[weekday]
 
+    def copy(self):
+        week_schedules = WeekSchedules()
+        week_schedules.import_schedules = list(self.import_schedules)
+        week_schedules.export_schedules = list(self.export_schedules)
+        return week_schedules
+
     def reset(self, export=False):
         schedules = self.export_schedules if export else self.import_schedules
         for i in range(DAYS_IN_WEEK):
@@ -211,6 +704,82 @@ class WeekSchedules:
         return self._str("Import", self.import_schedules) + self._str("Export", self.export_schedules)
 
 
+def get_prices(rates):
+    if isinstance(rates, DayRates):
+        return rates.get_prices()
+    prices = []
+    for r in rates:
+        prices.append(r[PRICE_KEY])
+    return prices
+
+
+class PriceRanking:
+    """
+    Prices of a set of rates in ascending order,
+    shared by all the computed thresholds evaluated over those rates.
+    """
+    def __init__(self, prices):
+        self.prices = sorted(prices)
+
+    def lowest(self, n):
+        prices = self.prices
+        return prices[n-1] if n <= len(prices) else prices[-1]
+
+    def highest(self, n):
+        prices = self.prices
+        return prices[-n] if 0 < n <= len(prices) else prices[0]
+
+
+class BreakHistory:
+    """
+    The optimized breaks used for each day, so that the next day's can be kept close to them
+    without optimizing the previous day again.
+    """
+    def __init__(self):
+        # (day, break config, pricing config) -> breaks
+        self.breaks = {}
+
+    def _key(self, day_date, break_config, pricing_config):
+        if type(pricing_config) == list:
+            pricing_config = tuple(pricing_config)
+        return (day_date, break_config, pricing_config)
+
+    def get(self, day_date, break_config, pricing_config):
+        return self.breaks.get(self._key(day_date, break_config, pricing_config))
+
+    def put(self, day_date, break_config, pricing_config, breaks):
+        # only the previous day's breaks are needed from here on
+        expired = []
+        for key in self.breaks:
+            if key[0] < day_date - ONE_DAY_INCREMENT:
+                expired.append(key)
+        for key in expired:
+            del self.breaks[key]
+        self.breaks[self._key(day_date, break_config, pricing_config)] = breaks
+
+
+class RateWindow:
+    """
+    Published rates from a given day onwards, for computed thresholds spanning several days,
+    with any price overlays applied as they are to the day's rates,
+    and the history of optimized breaks, if any.
+    """
+    def __init__(self, rates, day_date, overlays=None, break_history=None):
+        self.rates = rates
+        self.day_date = day_date
+        self.overlays = overlays
+        self.break_history = break_history
+        # num_days -> PriceRanking, as the overlays don't change whilst the day's schedules are computed
+        self._price_rankings = {}
+
+    def get_price_ranking(self, num_days):
+        ranking = self._price_rankings.get(num_days)
+        if ranking is None:
+            ranking = self.rates.get_price_ranking(self.day_date, num_days, self.overlays)
+            self._price_rankings[num_days] = ranking
+        return ranking
+
+
 class RateFunctions:
     def __init__(self):
         self.funcs = {
@@ -219,32 +788,43 @@ class RateFunctions:
             "states": self.state_value,
             "state_attr": self.state_attribute
         }
+        self._ranked_rates = None
+        self._ranked_version = None
+        self._ranking = None
 
     def set_helpers(self, state_getter, state_attr_getter):
         self.get_state = state_getter
         self.get_state_attr = state_attr_getter
 
-    def apply(self, name, rates, *args):
-        return self.funcs[name](rates, *args)
-
-    def lowest_rates(self, rates, hrs):
-        prices = [r[PRICE_KEY] for r in rates]
-        prices.sort()
+    def apply(self, name, rates, window, *args):
+        return self.funcs[name](rates, window, *args)
+
+    def get_price_ranking(self, rates, window=None, days=1):
+        num_days = int(days)
+        if num_days > 1 and window is not None:
+            return window.get_price_ranking(num_days)
+        # the same rates may have had prices overridden since they were ranked
+        version = getattr(rates, "version", None)
+        if rates is not self._ranked_rates or version != self._ranked_version:
+            self._ranking = PriceRanking(get_prices(rates))
+            self._ranked_rates = rates
+            self._ranked_version = version
+        return self._ranking
+
+    def lowest_rates(self, rates, window, hrs, days=1):
         n = round(2.0*float(hrs))
-        limit = prices[n-1] if n <= len(prices) else prices[-1]
+        limit = self.get_price_ranking(rates, window, days).lowest(n)
         return limit + EXCLUSIVE_OFFSET
 
-    def highest_rates(self, rates, hrs):
-        prices = [r[PRICE_KEY] for r in rates]
-        prices.sort(reverse=True)
+    def highest_rates(self, rates, window, hrs, days=1):
         n = round(2.0*float(hrs))
-        limit = prices[n-1] if n <= len(prices) else prices[-1]
+        limit = self.get_price_ranking(rates, window, days).highest(n)
         return limit
 
-    def state_value(self, rates, sensor_name):
+    def state_value(self, rates, window, sensor_name):
         return float(self.get_state(sensor_name))
     
-    def state_attribute(self, rates, sensor_name, attr_name):
+    def state_attribute(self, rates, window, sensor_name, attr_name):
         return float(self.get_state_attr(sensor_name)[attr_name])
 
 
@@ -264,9 +844,11 @@ class PriceAssigner:
 
 
 class PriceBandAssigner:
-    def __init__(self, lower_bound, upper_bound):
+    def __init__(self, lower_bound, upper_bound, pricing=None):
         self.lower_bound = lower_bound
         self.upper_bound = upper_bound
+        # pricing function chosen for the band, if any
+        self.pricing = pricing
 
     def is_in(self, rate):
         cost = rate[PRICE_KEY]
@@ -363,38 +945,517 @@ PRICING_FUNCS = {
 }
 
 
-def create_pricing(pricing_expr):
-    if '(' in pricing_expr and pricing_expr[-1] == ')':
-        sep = pricing_expr.index('(')
-        func_name = pricing_expr[:sep]
-        func_args = [arg.strip() for arg in pricing_expr[sep+1:-1].split(',')]
+def parse_function_expr(expr):
+    """
+    Splits an expression such as lowest(2) into its function name and arguments, else returns None.
+    """
+    if isinstance(expr, str) and '(' in expr and expr[-1] == ')':
+        sep = expr.index('(')
+        return expr[:sep], tuple([arg.strip() for arg in expr[sep+1:-1].split(',')])
+    return None
+
+
+def _is_positive_number(value):
+    try:
+        return float(value) > 0.0
+    except ValueError:
+        return False
+
+
+def _is_positive_integer(value):
+    return value.isdigit() and int(value) > 0
+
+
+def _is_number(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+def _is_name(value):
+    return len(value) > 0
+
+
+# function name -> usage, checks of its arguments, and the number of them required
+THRESHOLD_ARGS = {
+    "lowest": ("lowest(num_hours) or lowest(num_hours, num_days), with num_hours a positive number and num_days a positive whole number", [_is_positive_number, _is_positive_integer], 1),
+    "highest": ("highest(num_hours) or highest(num_hours, num_days), with num_hours a positive number and num_days a positive whole number", [_is_positive_number, _is_positive_integer], 1),
+    "states": ("states(sensor_name)", [_is_name], 1),
+    "state_attr": ("state_attr(sensor_name, attr_name)", [_is_name, _is_name], 2),
+}
+
+PRICING_ARGS = {
+    "fixed": ("fixed(price), with price a number", [_is_number], 1),
+}
+
+
+def _check_args(description, expr, func, func_args):
+    """
+    Raises ValueError if the arguments of a parsed expression don't suit its function.
+    """
+    name, args = func
+    usage, checks, required = func_args.get(name, (f"{name} without arguments", [], 0))
+    valid = required <= len(args) <= len(checks)
+    if valid:
+        for check, arg in zip(checks, args):
+            if not check(arg):
+                valid = False
+    if not valid:
+        raise ValueError(f"Invalid {description}: {expr} (expected {usage})")
+
+
+def _compile_pricing_expr(pricing_expr):
+    if isinstance(pricing_expr, tuple):
+        return pricing_expr
+    func = parse_function_expr(pricing_expr)
+    if func is None:
+        func = (pricing_expr, ())
+    if func[0] not in PRICING_FUNCS:
+        raise ValueError(f"Invalid pricing: {pricing_expr}")
+    _check_args("pricing", pricing_expr, func, PRICING_ARGS)
+    return func
+
+
+def _compile_pricing_config_expr(pricing_expr):
+    func = _compile_pricing_expr(pricing_expr)
+    # functions without arguments are kept as their names, which the optimizer prices bands by directly
+    return func if func[1] else func[0]
+
+
+def compile_pricing(pricing_config):
+    """
+    Parses the pricing expressions of a pricing config, so that they needn't be parsed on every update.
+    """
+    if pricing_config is None or pricing_config == OPTIMIZE_PRICING:
+        return pricing_config
+    elif type(pricing_config) == list:
+        compiled = []
+        for pricing_expr in pricing_config:
+            compiled.append(_compile_pricing_config_expr(pricing_expr))
+        return compiled
     else:
-        func_name = pricing_expr
-        func_args = []
+        return _compile_pricing_config_expr(pricing_config)
+
+
+def create_pricing(pricing_expr):
+    func_name, func_args = _compile_pricing_expr(pricing_expr)
     pricing_type = PRICING_FUNCS[func_name]
     return pricing_type(*func_args)
 
 
-def get_tariff_assigners(break_config, rates):
+# least recently used first
+JENKS_CACHE = OrderedDict()
+
+
+def _jenks_classes(values, n_classes):
+    """
+    Fisher's exact optimal partition of sorted values into contiguous classes, minimising the total within-class sum of squared deviations.
+    Returns the end index (exclusive) of each class.
+    """
+    n = len(values)
+    s1 = [0.0]
+    s2 = [0.0]
+    for v in values:
+        s1.append(s1[-1] + v)
+        s2.append(s2[-1] + v*v)
+
+    # costs[i] is the lowest total for values[:i] using the current number of classes
+    costs = [0.0]
+    for i in range(1, n+1):
+        costs.append(s2[i] - s1[i]*s1[i]/i)
+    back_refs = []
+    for c in range(2, n_classes+1):
+        new_costs = [None] * (n+1)
+        starts = [None] * (n+1)
+        for i in range(c, n+1):
+            best_cost = None
+            best_j = None
+            for j in range(c-1, i):
+                s = s1[i] - s1[j]
+                cost = costs[j] + s2[i] - s2[j] - s*s/(i-j)
+                if best_cost is None or cost < best_cost:
+                    best_cost = cost
+                    best_j = j
+            new_costs[i] = best_cost
+            starts[i] = best_j
+        costs = new_costs
+        back_refs.append(starts)
+    return _backtrack_classes(back_refs, n)
+
+
+def _jenks_classes_numpy(values, n_classes):
+    n = len(values)
+    x = np.asarray(values, dtype=float)
+    s1 = np.concatenate(([0.0], np.cumsum(x)))
+    s2 = np.concatenate(([0.0], np.cumsum(x*x)))
+    j = np.arange(n+1)[:, None]
+    i = np.arange(n+1)[None, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        segment_costs = s2[i] - s2[j] - (s1[i] - s1[j])**2/(i - j)
+    segment_costs[i <= j] = np.inf
+    costs = segment_costs[0]
+    back_refs = []
+    for c in range(2, n_classes+1):
+        totals = costs[:, None] + segment_costs
+        totals[:c-1, :] = np.inf
+        starts = np.argmin(totals, axis=0)
+        costs = totals[starts, np.arange(n+1)]
+        back_refs.append([int(start) for start in starts])
+    return _backtrack_classes(back_refs, n)
+
+
+def _backtrack_classes(back_refs, n):
+    ends = [n]
+    end = n
+    for starts in reversed(back_refs):
+        end = starts[end]
+        ends.append(end)
+    ends.reverse()
+    return ends
+
+
+def jenks_breaks(values, n_classes):
+    """
+    Natural breaks of the values as [min, class 1 max, ..., class n-1 max, max].
+    Results are memoised on the sorted values, keeping the most recently used.
+    """
+    sorted_values = tuple(sorted(values))
+    n_classes = min(n_classes, len(sorted_values))
+    key = (sorted_values, n_classes)
+    bounds = JENKS_CACHE.get(key)
+    if bounds is not None:
+        JENKS_CACHE.move_to_end(key)
+    else:
+        if np is not None and len(sorted_values) >= JENKS_NUMPY_THRESHOLD:
+            ends = _jenks_classes_numpy(sorted_values, n_classes)
+        else:
+            ends = _jenks_classes(sorted_values, n_classes)
+        bounds = [sorted_values[0]]
+        for end in ends:
+            bounds.append(sorted_values[end-1])
+        if len(JENKS_CACHE) >= JENKS_CACHE_SIZE:
+            JENKS_CACHE.popitem(last=False)
+        JENKS_CACHE[key] = bounds
+    return list(bounds)
+
+
+def _get_class_count(break_config, name):
+    if break_config == name:
+        return len(DEFAULT_CHARGE_NAMES)
+    elif isinstance(break_config, str) and break_config.startswith(name + "(") and break_config[-1] == ')':
+        count = break_config[len(name)+1:-1].strip()
+        if not _is_positive_integer(count):
+            raise ValueError(f"Invalid breaks: {break_config} (expected {name}(num_levels), with num_levels a positive whole number)")
+        return int(count)
+    else:
+        return None
+
+
+def get_jenks_class_count(break_config):
+    """
+    Returns the number of classes for a jenks break config, e.g. jenks or jenks(3), else None.
+    """
+    return _get_class_count(break_config, JENKS_BREAKS)
+
+
+def get_optimize_class_count(break_config):
+    """
+    Returns the number of classes for an optimize break config, e.g. optimize or optimize(3), else None.
+    """
+    return _get_class_count(break_config, OPTIMIZE_BREAKS)
+
+
+def _rate_hours(rate):
+    if "start" in rate and "end" in rate:
+        return (rate["end"] - rate["start"]).total_seconds()/3600.0
+    else:
+        return SLOT_TIME_INCREMENT.total_seconds()/3600.0
+
+
+def get_rate_hours(rates):
+    hours = []
+    if isinstance(rates, DayRates):
+        for start, end in zip(rates.get_starts(), rates.get_ends()):
+            hours.append((end - start)/3600.0)
+    else:
+        for r in rates:
+            hours.append(_rate_hours(r))
+    return hours
+
+
+class PriceDistribution:
+    """
+    The distinct prices of a set of rates in ascending order, with the number of rates and hours at each price,
+    and the prefix sums needed to evaluate a band of consecutive prices in constant time.
+    """
+    def __init__(self, rates):
+        counts = defaultdict(int)
+        hours = defaultdict(float)
+        for price, h in zip(get_prices(rates), get_rate_hours(rates)):
+            counts[price] += 1
+            hours[price] += h
+        self.values = sorted(counts)
+        self.counts = []
+        self.hours = []
+        for v in self.values:
+            self.counts.append(counts[v])
+            self.hours.append(hours[v])
+        self.count_sums = [0]
+        self.price_sums = [0.0]
+        self.non_negative_price_sums = [0.0]
+        self.hour_sums = [0.0]
+        self.hour_price_sums = [0.0]
+        for v, c, h in zip(self.values, self.counts, self.hours):
+            self.count_sums.append(self.count_sums[-1] + c)
+            self.price_sums.append(self.price_sums[-1] + c*v)
+            self.non_negative_price_sums.append(self.non_negative_price_sums[-1] + c*max(v, 0.0))
+            self.hour_sums.append(self.hour_sums[-1] + h)
+            self.hour_price_sums.append(self.hour_price_sums[-1] + h*v)
+
+    def get_band_price(self, pricing_expr, i, j):
+        """
+        The price the pricing function gives the rates with the i-th to (j-1)-th prices.
+        """
+        if pricing_expr == "average":
+            return max((self.price_sums[j] - self.price_sums[i])/(self.count_sums[j] - self.count_sums[i]), 0.0)
+        elif pricing_expr == "nonNegativeAverage":
+            return (self.non_negative_price_sums[j] - self.non_negative_price_sums[i])/(self.count_sums[j] - self.count_sums[i])
+        elif pricing_expr == "minimum":
+            return max(min(self.values[i], PRICE_CAP), 0.0)
+        elif pricing_expr == "maximum":
+            return max(self.values[j-1], 0.0)
+        else:
+            pricing_func = create_pricing(pricing_expr)
+            for k in range(i, j):
+                for _ in range(self.counts[k]):
+                    pricing_func.add(self.values[k])
+            return pricing_func.get_value()
+
+    def get_band_error(self, price, i, j):
+        """
+        The hour weighted absolute difference between the price and the i-th to (j-1)-th prices.
+        """
+        m = bisect.bisect_left(self.values, price, i, j)
+        below = price*(self.hour_sums[m] - self.hour_sums[i]) - (self.hour_price_sums[m] - self.hour_price_sums[i])
+        above = (self.hour_price_sums[j] - self.hour_price_sums[m]) - price*(self.hour_sums[j] - self.hour_sums[m])
+        return below + above
+
+    def get_band_cost(self, pricing_exprs, i, j):
+        """
+        The lowest error of the candidate pricing functions for the band, and the pricing function giving it.
+        """
+        best_cost = None
+        best_expr = None
+        for pricing_expr in pricing_exprs:
+            cost = self.get_band_error(self.get_band_price(pricing_expr, i, j), i, j)
+            if best_cost is None or cost < best_cost:
+                best_cost = cost
+                best_expr = pricing_expr
+        return best_cost, best_expr
+
+    def get_band_costs_numpy(self, pricing_exprs):
+        """
+        As get_band_cost for all bands at once, as matrices indexed by [i, j].
+        """
+        n = len(self.values)
+        values = np.asarray(self.values, dtype=float)
+        count_sums = np.asarray(self.count_sums, dtype=float)
+        price_sums = np.asarray(self.price_sums)
+        non_negative_price_sums = np.asarray(self.non_negative_price_sums)
+        hour_sums = np.asarray(self.hour_sums)
+        hour_price_sums = np.asarray(self.hour_price_sums)
+        i = np.arange(n+1)[:, None]
+        j = np.arange(n+1)[None, :]
+        valid = i < j
+        ii = np.broadcast_to(i, (n+1, n+1))
+        jj = np.broadcast_to(j, (n+1, n+1))
+        padded_values = np.append(values, values[-1])
+        costs = []
+        for pricing_expr in pricing_exprs:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                if pricing_expr == "average":
+                    prices = np.maximum((price_sums[j] - price_sums[i])/(count_sums[j] - count_sums[i]), 0.0)
+                elif pricing_expr == "nonNegativeAverage":
+                    prices = (non_negative_price_sums[j] - non_negative_price_sums[i])/(count_sums[j] - count_sums[i])
+                elif pricing_expr == "minimum":
+                    prices = np.broadcast_to(np.maximum(np.minimum(padded_values[i], PRICE_CAP), 0.0), (n+1, n+1))
+                elif pricing_expr == "maximum":
+                    prices = np.broadcast_to(np.maximum(padded_values[j-1], 0.0), (n+1, n+1))
+                else:
+                    prices = np.zeros((n+1, n+1))
+                    for a, b in zip(*np.nonzero(valid)):
+                        prices[a, b] = self.get_band_price(pricing_expr, int(a), int(b))
+            prices = np.where(valid, prices, 0.0)
+            m = np.clip(np.searchsorted(values, prices, side="left"), ii, jj)
+            below = prices*(hour_sums[m] - hour_sums[ii]) - (hour_price_sums[m] - hour_price_sums[ii])
+            above = (hour_price_sums[jj] - hour_price_sums[m]) - prices*(hour_sums[jj] - hour_sums[m])
+            costs.append(np.where(valid, below + above, np.inf))
+        costs = np.stack(costs)
+        best = np.argmin(costs, axis=0)
+        return np.take_along_axis(costs, best[None], axis=0)[0], best
+
+
+def _get_stability_cost(distribution, previous_breaks, break_index, i):
+    if previous_breaks is None or break_index >= len(previous_breaks):
+        return 0.0
+    return OPTIMIZE_STABILITY_WEIGHT*distribution.hour_sums[-1]*abs(distribution.values[i] - previous_breaks[break_index])
+
+
+def _optimize_classes(distribution, class_pricing, previous_breaks):
+    """
+    Partition of the distinct prices into contiguous classes, minimising the total band error plus the cost of moving breaks.
+    Returns the end index (exclusive) of each class.
+    """
+    n = len(distribution.values)
+    n_classes = len(class_pricing)
+    costs = [None] * (n+1)
+    for j in range(1, n+1):
+        costs[j] = distribution.get_band_cost(class_pricing[0], 0, j)[0]
+    back_refs = []
+    for c in range(1, n_classes):
+        new_costs = [None] * (n+1)
+        starts = [None] * (n+1)
+        for j in range(c+1, n+1):
+            best_cost = None
+            best_i = None
+            for i in range(j-1, c-1, -1):
+                cost = costs[i] + _get_stability_cost(distribution, previous_breaks, c-1, i)
+                # band costs are non-negative, so this cannot beat the best found
+                if best_cost is not None and cost >= best_cost:
+                    continue
+                cost += distribution.get_band_cost(class_pricing[c], i, j)[0]
+                if best_cost is None or cost < best_cost:
+                    best_cost = cost
+                    best_i = i
+            new_costs[j] = best_cost
+            starts[j] = best_i
+        costs = new_costs
+        back_refs.append(starts)
+    return _backtrack_classes(back_refs, n)
+
+
+def _optimize_classes_numpy(distribution, class_pricing, previous_breaks):
+    n = len(distribution.values)
+    band_costs = {}
+    for pricing_exprs in class_pricing:
+        key = tuple(pricing_exprs)
+        if key not in band_costs:
+            band_costs[key] = distribution.get_band_costs_numpy(pricing_exprs)[0]
+    costs = band_costs[tuple(class_pricing[0])][0]
+    back_refs = []
+    for c in range(1, len(class_pricing)):
+        stability_costs = np.zeros(n+1)
+        for i in range(n):
+            stability_costs[i] = _get_stability_cost(distribution, previous_breaks, c-1, i)
+        totals = (costs + stability_costs)[:, None] + band_costs[tuple(class_pricing[c])]
+        totals[:c, :] = np.inf
+        starts = np.argmin(totals, axis=0)
+        costs = totals[starts, np.arange(n+1)]
+        back_refs.append([int(start) for start in starts])
+    return _backtrack_classes(back_refs, n)
+
+
+def _get_class_pricing(pricing_config, n_classes):
+    if pricing_config is None or pricing_config == OPTIMIZE_PRICING:
+        candidates = OPTIMIZE_PRICING_CANDIDATES
+    elif type(pricing_config) == list:
+        class_pricing = []
+        for pricing_expr in pricing_config[:n_classes]:
+            class_pricing.append([pricing_expr])
+        return class_pricing
+    else:
+        candidates = [pricing_config]
+    class_pricing = []
+    for _ in range(n_classes):
+        class_pricing.append(candidates)
+    return class_pricing
+
+
+def optimize_breaks(rates, n_classes, pricing_config=None, previous_breaks=None):
+    """
+    Breaks (as exclusive upper bounds) and pricing functions for at most n_classes bands,
+    minimising the difference between the band prices and the rates' prices (weighted by duration)
+    plus a penalty for moving the breaks from previous_breaks.
+    The pricing functions are chosen from OPTIMIZE_PRICING_CANDIDATES unless given by the pricing config.
+    """
+    if type(pricing_config) == list and len(pricing_config) != n_classes:
+        raise ValueError(f"The number of optimized breaks is inconsistent with the number of pricing functions.")
+    distribution = PriceDistribution(rates)
+    n_classes = min(n_classes, len(distribution.values))
+    class_pricing = _get_class_pricing(pricing_config, n_classes)
+    if np is not None and len(distribution.values) >= OPTIMIZE_NUMPY_THRESHOLD:
+        ends = _optimize_classes_numpy(distribution, class_pricing, previous_breaks)
+    else:
+        ends = _optimize_classes(distribution, class_pricing, previous_breaks)
+    breaks = []
+    pricing = []
+    start = 0
+    for c, end in enumerate(ends):
+        pricing.append(distribution.get_band_cost(class_pricing[c], start, end)[1])
+        if end < len(distribution.values):
+            breaks.append(distribution.values[end])
+        start = end
+    return breaks, pricing
+
+
+def compile_breaks(break_config):
+    """
+    Parses the computed thresholds of a break config, so that they needn't be parsed on every update.
+    """
+    if break_config is None:
+        return None
+    elif type(break_config) == list:
+        compiled = []
+        for br in break_config:
+            if isinstance(br, float) or isinstance(br, int) or isinstance(br, tuple):
+                compiled.append(br)
+            else:
+                func = parse_function_expr(br)
+                if func is None or func[0] not in RATE_FUNCS.funcs:
+                    raise ValueError(f"Invalid threshold: {br}")
+                _check_args("threshold", br, func, THRESHOLD_ARGS)
+                compiled.append(func)
+        return compiled
+    elif break_config == INDIVIDUAL_BREAKS or get_jenks_class_count(break_config) is not None or get_optimize_class_count(break_config) is not None:
+        return break_config
+    else:
+        raise ValueError(f"Invalid breaks: {break_config}")
+
+
+def get_tariff_assigners(break_config, rates, window=None, pricing_config=None):
     if break_config == INDIVIDUAL_BREAKS:
-        unique_prices = set([r[PRICE_KEY] for r in rates])
+        unique_prices = set(get_prices(rates))
         funcs = [PriceAssigner(price) for price in sorted(unique_prices)]
+    elif get_optimize_class_count(break_config) is not None:
+        n_classes = get_optimize_class_count(break_config)
+        history = window.break_history if window is not None else None
+        previous_breaks = None
+        if history is not None:
+            previous_breaks = history.get(window.day_date - ONE_DAY_INCREMENT, break_config, pricing_config)
+        breaks, pricing = optimize_breaks(rates, n_classes, pricing_config=pricing_config, previous_breaks=previous_breaks)
+        if history is not None:
+            history.put(window.day_date, break_config, pricing_config, breaks)
+        funcs = []
+        for i in range(len(breaks)+1):
+            lower_bound = breaks[i-1] if i > 0 else None
+            upper_bound = breaks[i] if i < len(breaks) else None
+            funcs.append(PriceBandAssigner(lower_bound, upper_bound, pricing=pricing[i]))
     else:
-        if break_config == JENKS_BREAKS:
-            bounds = jenkspy.jenks_breaks([r[PRICE_KEY] for r in rates], n_classes=len(DEFAULT_CHARGE_NAMES))
-            breaks = [b + EXCLUSIVE_OFFSET for b in bounds[1:-1]]
+        jenks_class_count = get_jenks_class_count(break_config)
+        if jenks_class_count is not None:
+            bounds = jenks_breaks(get_prices(rates), jenks_class_count)
+            breaks = []
+            for b in bounds[1:-1]:
+                breaks.append(b + EXCLUSIVE_OFFSET)
         else:
             breaks = []
-            for br in break_config:
-                if isinstance(br, float) or isinstance(br, int):
-                    v = br
-                elif isinstance(br, str) and '(' in br and br[-1] == ')':
-                    sep = br.index('(')
-                    func_name = br[:sep]
-                    func_args = [arg.strip() for arg in br[sep+1:-1].split(',')]
-                    v = RATE_FUNCS.apply(func_name, rates, *func_args)
+            for br in compile_breaks(break_config):
+                if isinstance(br, tuple):
+                    v = RATE_FUNCS.apply(br[0], rates, window, *br[1])
                 else:
-                    raise ValueError(f"Invalid threshold: {br}")
+                    v = br
                 breaks.append(v)
             # ensure ascending order
             breaks.sort()
@@ -408,20 +1469,62 @@ def get_tariff_assigners(break_config, rates):
     return funcs
 
 
+def _all_instances(items, cls):
+    for item in items:
+        if not isinstance(item, cls):
+            return False
+    return True
+
+
+def assign_bands(assigner_funcs, rates):
+    """
+    Returns the index of the assigner each rate belongs to.
+    """
+    prices = get_prices(rates)
+    indices = []
+    if _all_instances(assigner_funcs, PriceAssigner):
+        index_by_price = {}
+        for i, assigner_func in enumerate(assigner_funcs):
+            index_by_price[assigner_func.price] = i
+        for price in prices:
+            indices.append(index_by_price[price])
+    elif _all_instances(assigner_funcs, PriceBandAssigner):
+        # bands are contiguous and ascending, so the upper bounds locate the band
+        upper_bounds = []
+        for assigner_func in assigner_funcs[:-1]:
+            upper_bounds.append(assigner_func.upper_bound)
+        for price in prices:
+            indices.append(bisect.bisect_right(upper_bounds, price))
+    else:
+        for price in prices:
+            rate = {PRICE_KEY: price}
+            for i, assigner_func in enumerate(assigner_funcs):
+                if assigner_func.is_in(rate):
+                    indices.append(i)
+                    break
+    return indices
+
+
 def populate_schedules(schedules, day_rates):
-    for rate in day_rates:
-        schedule = None
-        for s in schedules:
-            if s.is_in(rate):
-                schedule = s
-                break
-        schedule.add(rate)
+    assigner_funcs = []
+    for schedule in schedules:
+        assigner_funcs.append(schedule.assigner_func)
+    band_indices = assign_bands(assigner_funcs, day_rates)
+    if isinstance(day_rates, DayRates):
+        # periods are only converted from epoch seconds once complete
+        for schedule in schedules:
+            schedule.to_time = day_rates.timeline._to_datetime
+        for start, end, price, i in zip(day_rates.get_starts(), day_rates.get_ends(), day_rates.get_prices(), band_indices):
+            schedules[i].add_slot(start, end, price)
+    else:
+        for rate, i in zip(day_rates, band_indices):
+            schedules[i].add(rate)
 
 
-def get_import_schedules(breaks_config, tariff_pricing_config, tariff_pricing_names, plunge_pricing_breaks_config, plunge_pricing_tariff_pricing_config, plunge_pricing_tariff_pricing_names, day_date, day_rates):
+def get_import_schedules(breaks_config, tariff_pricing_config, tariff_pricing_names, plunge_pricing_breaks_config, plunge_pricing_tariff_pricing_config, plunge_pricing_tariff_pricing_names, day_date, day_rates, window=None):
     plunge_pricing = False
-    for rate in day_rates:
-        if rate[PRICE_KEY] < 0.0:
+    for price in get_prices(day_rates):
+        if price < 0.0:
             plunge_pricing = True
             break
 
@@ -440,21 +1543,23 @@ def get_import_schedules(breaks_config, tariff_pricing_config, tariff_pricing_na
     else:
         configured_pricing_names = tariff_pricing_names
 
-    return get_schedules(configured_breaks, configured_pricing, configured_pricing_names, day_date, day_rates)
+    return get_schedules(configured_breaks, configured_pricing, configured_pricing_names, day_date, day_rates, window=window)
 
 
-def get_export_schedules(breaks_config, tariff_pricing_config, tariff_pricing_names, day_date, day_rates):
-    return get_schedules(breaks_config, tariff_pricing_config, tariff_pricing_names, day_date, day_rates)
+def get_export_schedules(breaks_config, tariff_pricing_config, tariff_pricing_names, day_date, day_rates, window=None):
+    return get_schedules(breaks_config, tariff_pricing_config, tariff_pricing_names, day_date, day_rates, window=window)
 
 
-def get_schedules(breaks_config, tariff_pricing_config, tariff_pricing_names, day_date, day_rates):
+def get_schedules(breaks_config, tariff_pricing_config, tariff_pricing_names, day_date, day_rates, window=None):
     if (breaks_config is not None) and (type(breaks_config) == list) and (tariff_pricing_config is not None) and (len(breaks_config) + 1 != len(tariff_pricing_config)):
         raise ValueError(f"The number of breaks is inconsistent with the number of pricing functions.")
+    if tariff_pricing_config == OPTIMIZE_PRICING and get_optimize_class_count(breaks_config) is None:
+        raise ValueError(f"Optimized pricing requires optimized breaks.")
 
     if not day_rates:
         return None
 
-    assigner_funcs = get_tariff_assigners(breaks_config, day_rates)
+    assigner_funcs = get_tariff_assigners(breaks_config, day_rates, window=window, pricing_config=tariff_pricing_config)
 
     charge_name_count = len(assigner_funcs)
     if tariff_pricing_names is None:
@@ -469,7 +1574,10 @@ def get_schedules(breaks_config, tariff_pricing_config, tariff_pricing_names, da
 
     schedules = []
     for i in range(charge_name_count):
-        pricing_expr = tariff_pricing_config[i] if type(tariff_pricing_config) == list else tariff_pricing_config
+        if tariff_pricing_config == OPTIMIZE_PRICING:
+            pricing_expr = assigner_funcs[i].pricing
+        else:
+            pricing_expr = tariff_pricing_config[i] if type(tariff_pricing_config) == list else tariff_pricing_config
         pricing_func = create_pricing(pricing_expr)
         schedules.append(Schedule(charge_names[i], assigner_funcs[i], pricing_func, PRICE_KEY))
 
@@ -478,29 +1586,127 @@ def get_schedules(breaks_config, tariff_pricing_config, tariff_pricing_names, da
     return schedules
 
 
-def to_charge_period_json(start_day_of_week, end_day_of_week, period, tz):
+def to_tou_window(period, tz):
+    """
+    Start and end minutes of the day, a period ending at midnight ending at MINUTES_PER_DAY.
+    """
     start_local = period[0].astimezone(tz)
     end_local = period[1].astimezone(tz)
+    end = 60*end_local.hour + end_local.minute
+    return (60*start_local.hour + start_local.minute, end if end else MINUTES_PER_DAY)
+
+
+def _tou_window_json(days, window):
     return {
-        "fromDayOfWeek": start_day_of_week,
-        "fromHour": start_local.hour,
-        "fromMinute": start_local.minute,
-        "toDayOfWeek": end_day_of_week,
-        "toHour": end_local.hour,
-        "toMinute": end_local.minute
+        "fromDayOfWeek": days[0],
+        "fromHour": window[0]//60,
+        "fromMinute": window[0] % 60,
+        "toDayOfWeek": days[1],
+        "toHour": (window[1]//60) % 24,
+        "toMinute": window[1] % 60
     }
 
 
-def populate_tou_periods(tou_periods, schedules, start_day_of_week, end_day_of_week, tz):
+def populate_tou_periods(tou_windows, schedules, start_day_of_week, end_day_of_week, tz):
+    days = (start_day_of_week, end_day_of_week)
     for schedule in schedules:
         periods = schedule.get_periods()
         if periods:
-            charge_periods = tou_periods[schedule.charge_name]
+            charge_windows = tou_windows[schedule.charge_name]
             for period in periods:
-                charge_periods.append(to_charge_period_json(start_day_of_week, end_day_of_week, period, tz))
+                charge_windows.append((days, to_tou_window(period, tz)))
+
+
+def _merge_ranges(ranges, gap=0):
+    """
+    Merges sorted (start, end) ranges that overlap or are no more than gap apart.
+    """
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + gap:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _compact_windows(windows):
+    """
+    Compacts [((fromDay, toDay), (start minute, end minute))] of a charge.
+    A single pass suffices as the day ranges of a tariff don't overlap.
+    """
+    # day range -> [(start, end)], for windows within the day
+    windows_by_days = defaultdict(list)
+    # window -> [day range]
+    days_by_window = defaultdict(list)
+    for days, window in windows:
+        if window[1] > window[0]:
+            windows_by_days[days].append(window)
+        else:
+            # already crosses midnight
+            days_by_window[window].append(days)
+    for days, day_windows in windows_by_days.items():
+        day_windows.sort()
+        for window in _merge_ranges(day_windows):
+            days_by_window[window].append(days)
+
+    compacted = []
+    for window, day_ranges in days_by_window.items():
+        day_ranges.sort()
+        for days in _merge_ranges(day_ranges, gap=1):
+            compacted.append((days, window))
+
+    # every day, so a window to midnight continues into the next day's window from midnight
+    to_midnight = None
+    from_midnight = None
+    for i, (days, window) in enumerate(compacted):
+        if days == FULL_WEEK and window[1] > window[0] and window != WHOLE_DAY:
+            if window[1] == MINUTES_PER_DAY:
+                to_midnight = i
+            elif window[0] == 0:
+                from_midnight = i
+    if to_midnight is not None and from_midnight is not None:
+        window = (compacted[to_midnight][1][0], compacted[from_midnight][1][1])
+        compacted[to_midnight] = (FULL_WEEK, window)
+        del compacted[from_midnight]
+    return compacted
+
+
+def _to_tou_periods(tou_windows):
+    tou_periods = {}
+    for charge_name, windows in tou_windows.items():
+        if len(windows) > 1:
+            windows = _compact_windows(windows)
+            # by day range then start time
+            windows.sort()
+        charge_periods = []
+        for days, window in windows:
+            charge_periods.append(_tou_window_json(days, window))
+        tou_periods[charge_name] = charge_periods
+    return tou_periods
+
+
+def compact_tou_periods(tou_periods):
+    """
+    Equivalent TOU periods with as few entries as possible: adjacent periods are merged,
+    as are identical periods on adjacent day ranges, and periods either side of midnight on every day.
+    """
+    tou_windows = {}
+    for charge_name, periods in tou_periods.items():
+        windows = []
+        for period in periods:
+            end = 60*period["toHour"] + period["toMinute"]
+            windows.append((
+                (period["fromDayOfWeek"], period["toDayOfWeek"]),
+                (60*period["fromHour"] + period["fromMinute"], end if end else MINUTES_PER_DAY)
+            ))
+        tou_windows[charge_name] = windows
+    return _to_tou_periods(tou_windows)
 
 
 def schedules_to_tariff(week_schedules, schedule_type, weekday, tz=None, export=False):
+    # charge name -> [(day range, window)]
     tou_periods = defaultdict(list)
 
     if schedule_type == "week":
@@ -550,6 +1756,7 @@ def schedules_to_tariff(week_schedules, schedule_type, weekday, tz=None, export=
         raise ValueError(f"Invalid schedule type: {schedule_type}")
 
     if tou_periods:
+        tou_periods = _to_tou_periods(tou_periods)
         seasons = {"Summer": {"fromMonth": 1, "fromDay": 1, "toDay": 31,
                               "toMonth": 12, "tou_periods": tou_periods},
                    "Winter": {"fromMonth": 0, "fromDay": 0, "toDay": 0,
@@ -603,3 +1810,56 @@ def to_tariff_data(provider_name, import_plan, import_standing_charge, import_sc
                                         "Winter": {}}}
     }
     return tariff_data
+
+
+def _canonical_value(v, schema=None):
+    """
+    Normalised form of the value, keeping only the fields in the schema (if given) at every level.
+    """
+    if isinstance(v, dict):
+        canonical = {}
+        for key, value in v.items():
+            if value is None:
+                continue
+            if schema is None:
+                canonical[key] = _canonical_value(value)
+            elif key in schema:
+                canonical[key] = _canonical_value(value, schema[key])
+            elif ANY_KEY in schema:
+                canonical[key] = _canonical_value(value, schema[ANY_KEY])
+        return canonical
+    elif isinstance(v, list):
+        item_schema = schema[0] if schema else None
+        # ordering of periods/charges is not significant
+        keyed_items = []
+        for i, item in enumerate(v):
+            canonical_item = _canonical_value(item, item_schema)
+            keyed_items.append((json.dumps(canonical_item, sort_keys=True), i, canonical_item))
+        keyed_items.sort()
+        canonical = []
+        for keyed_item in keyed_items:
+            canonical.append(keyed_item[2])
+        return canonical
+    elif isinstance(v, (int, float)) and not isinstance(v, bool):
+        return round(float(v), TARIFF_PRECISION)
+    else:
+        return v
+
+
+def canonical_tariff(tariff_data):
+    """
+    Normalised form of tariff data with only the fields we set,
+    suitable for comparing generated tariffs with those read back from the Powerwall.
+    """
+    if not tariff_data:
+        return None
+    canonical = _canonical_value(tariff_data, TARIFF_SCHEMA)
+    sell_tariff = tariff_data.get("sell_tariff")
+    if sell_tariff:
+        canonical["sell_tariff"] = _canonical_value(sell_tariff, TARIFF_SCHEMA)
+    return canonical
+
+
+def tariff_fingerprint(tariff_data):
+    canonical_json = json.dumps(canonical_tariff(tariff_data), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical_json.encode("utf-8")).hexdigest()
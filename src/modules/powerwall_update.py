@@ -0,0 +1,146 @@
+import powerwall_cache as cache
+
+
+UPDATE = "update"
+CHECK = "check"
+
+
+class UpdateScheduler:
+    """
+    Single-flight tariff updates.
+    An update recomputes from newly arrived rates, a check recomputes and checks the Powerwalls with whatever rates are known.
+    Only one run is made at a time; requests made whilst it runs are picked up when it finishes, each kind at most once.
+    """
+    def __init__(self):
+        self.running = False
+        self.pending = {UPDATE: False, CHECK: False}
+
+    def request(self, kind):
+        """
+        Records a request, returning whether a runner needs starting as none is running.
+        """
+        self.pending[kind] = True
+        if self.running:
+            return False
+        # set before the runner starts, so that a request in the meantime doesn't start another
+        self.running = True
+        return True
+
+    def next_run(self):
+        """
+        The kind of run to make next, updates first, or None if there are none pending.
+        """
+        for kind in (UPDATE, CHECK):
+            if self.pending[kind]:
+                self.pending[kind] = False
+                return kind
+        return None
+
+    def checked(self):
+        """
+        An update checked the Powerwalls, which satisfies any pending check.
+        """
+        self.pending[CHECK] = False
+
+    def stop(self):
+        """
+        The runner has finished, so the next request starts another.
+        """
+        self.running = False
+
+
+class StagedTariff:
+    """
+    Tomorrow's schedules, staged when its rates arrive so that at midnight the tariff only has to be built and uploaded.
+    The tariff is built then, rather than when staged, so that it has the standing charges in effect at midnight.
+    """
+    def __init__(self):
+        self.day = None
+        self.week_schedules = None
+
+    def stage(self, day_date, week_schedules, import_schedule_type, export_schedule_type):
+        """
+        Stages a copy of the schedules for the day, returning whether they were staged.
+        A multiday tariff already switches to the day's schedules at midnight, so has nothing staged.
+        """
+        if import_schedule_type == "multiday" and export_schedule_type == "multiday":
+            self.clear()
+            return False
+        self.day = day_date
+        # later updates change the week's schedules in place
+        self.week_schedules = week_schedules.copy()
+        return True
+
+    def clear(self):
+        self.day = None
+        self.week_schedules = None
+
+    def get(self, day_date):
+        """
+        The schedules staged for the day, or None.
+        """
+        return self.week_schedules if self.day == day_date else None
+
+
+def split_cached(sites, caches):
+    """
+    The (site, value) of each site whose cached value is fresh, and the sites that need fetching.
+    """
+    site_values = []
+    sites_to_fetch = []
+    for site in sites:
+        value, cache_state = caches[site["name"]].get()
+        if cache_state == cache.FRESH:
+            site_values.append((site, value))
+        else:
+            sites_to_fetch.append(site)
+    return site_values, sites_to_fetch
+
+
+def add_fetched(site_values, sites, results, caches):
+    """
+    Adds the (site, value) of each site fetched successfully, caching its value.
+    """
+    for site, result in zip(sites, results):
+        if not result["error"]:
+            caches[site["name"]].put(result["value"])
+            site_values.append((site, result["value"]))
+
+
+def split_by_fingerprint(sites, fingerprints, fingerprint):
+    """
+    The sites whose Powerwall may not have the tariff with the fingerprint, and those known to have it.
+    """
+    changed_sites = []
+    unchanged_sites = []
+    for site in sites:
+        if fingerprints.get(site["name"]) != fingerprint:
+            changed_sites.append(site)
+        else:
+            unchanged_sites.append(site)
+    return changed_sites, unchanged_sites
+
+
+def record_site_results(site_results, results, duration_key):
+    """
+    Adds each site's API call duration (in ms) and any error to its results, returning the errors by site name.
+    """
+    errors = {}
+    for result in results:
+        site_result = site_results.get(result["name"])
+        if site_result is None:
+            site_result = {}
+            site_results[result["name"]] = site_result
+        site_result[duration_key] = round(1000.0*result["duration"], 1)
+        if result["error"]:
+            site_result["error"] = result["error"]
+            errors[result["name"]] = result["error"]
+    return errors
+
+
+def get_failed_sites(site_results):
+    failed_sites = []
+    for name, site_result in site_results.items():
+        if "error" in site_result:
+            failed_sites.append(name)
+    return failed_sites
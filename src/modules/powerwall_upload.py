@@ -0,0 +1,174 @@
+from collections import deque
+import time
+
+import powerwall_metrics as metrics
+
+
+TARIFF = "tariff"
+SETTINGS = "settings"
+
+# sustained writes per second, and the burst allowed, per Tesla account
+DEFAULT_RATE = 0.2
+DEFAULT_BURST = 3
+DEFAULT_WINDOW = 50
+
+
+class TokenBucket:
+    """
+    Allows bursts of up to capacity writes, refilled at rate per second,
+    and none at all until a Retry-After period has passed.
+    """
+    def __init__(self, rate=DEFAULT_RATE, capacity=DEFAULT_BURST, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = float(capacity)
+        self.updated = clock()
+        self.blocked_until = None
+
+    def _refill(self):
+        now = self.clock()
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated)*self.rate)
+            self.updated = now
+        return now
+
+    def get_wait(self):
+        """
+        Seconds until a write may be made.
+        """
+        now = self._refill()
+        wait = 0.0
+        if self.blocked_until is not None and self.blocked_until > now:
+            wait = self.blocked_until - now
+        if self.tokens < 1.0:
+            wait = max(wait, (1.0 - self.tokens)/self.rate)
+        return wait
+
+    def take(self):
+        """
+        Takes a token for a write, returning False (taking none) if the write must wait.
+        """
+        if self.get_wait() > 0.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+    def block(self, seconds):
+        """
+        Honours a Retry-After, after which writes resume at the sustained rate.
+        """
+        self.blocked_until = max(self.blocked_until or 0.0, self.clock() + seconds)
+        # nothing accrues whilst blocked
+        self.tokens = 1.0
+        self.updated = self.blocked_until
+
+
+def _merge_payload(payload, changes):
+    merged = dict(payload)
+    for key, v in changes.items():
+        if v is not None:
+            merged[key] = v
+    return merged
+
+
+def _with_followers(entry):
+    entries = [entry]
+    for follower in entry["followers"]:
+        entries.extend(_with_followers(follower))
+    return entries
+
+
+class UploadQueue:
+    """
+    Pending writes per site, at most one of each kind.
+    A newer write replaces a pending one of the same kind (last writer wins), or is merged into it for partial writes,
+    so superseded payloads are never sent; whoever is waiting on the pending write gets the result of the newer one.
+    Writes to a site are taken one at a time, in the order their kinds were first queued.
+    """
+    def __init__(self, clock=time.monotonic, window=DEFAULT_WINDOW):
+        self.clock = clock
+        # site -> [entry]
+        self.pending = {}
+        self.waits = deque(maxlen=window)
+        self.submitted = 0
+        self.superseded = 0
+        self.sent = 0
+        self.failed = 0
+
+    def submit(self, site, kind, payload, merge=False):
+        """
+        Queues a write, returning its entry (which is that of the pending write it replaced, if any).
+        """
+        self.submitted += 1
+        entries = self.pending.get(site)
+        if entries is None:
+            entries = []
+            self.pending[site] = entries
+        for entry in entries:
+            if entry["kind"] == kind:
+                entry["payload"] = _merge_payload(entry["payload"], payload) if merge else payload
+                self.superseded += 1
+                return entry
+        entry = {"site": site, "kind": kind, "payload": payload, "queued": self.clock(), "followers": []}
+        entries.append(entry)
+        return entry
+
+    def take(self, site):
+        """
+        The site's next write, or None if there are none pending.
+        """
+        entries = self.pending.get(site)
+        if not entries:
+            return None
+        entry = entries.pop(0)
+        self.waits.append(self.clock() - entry["queued"])
+        return entry
+
+    def requeue(self, entry, merge=False):
+        """
+        Puts back a write that could not be sent yet, ahead of the site's other writes.
+        If a newer write of the same kind has been queued meanwhile, that is sent instead,
+        and the entry is completed along with it. Returns whether the entry itself was requeued.
+        """
+        entries = self.pending.setdefault(entry["site"], [])
+        for newer in entries:
+            if newer["kind"] == entry["kind"]:
+                if merge:
+                    newer["payload"] = _merge_payload(entry["payload"], newer["payload"])
+                newer["followers"].append(entry)
+                self.superseded += 1
+                return False
+        entries.insert(0, entry)
+        return True
+
+    def complete(self, entry, error=None):
+        """
+        Records the outcome of a write, returning the entries to notify of it.
+        """
+        if error is None:
+            self.sent += 1
+        else:
+            self.failed += 1
+        return _with_followers(entry)
+
+    def get_depth(self, site=None):
+        if site is not None:
+            return len(self.pending.get(site, []))
+        depth = 0
+        for entries in self.pending.values():
+            depth += len(entries)
+        return depth
+
+    def get_stats(self):
+        stats = {
+            "upload_queue_depth": self.get_depth(),
+            "uploads_submitted": self.submitted,
+            "uploads_superseded": self.superseded,
+            "uploads_sent": self.sent,
+            "uploads_failed": self.failed,
+        }
+        if self.waits:
+            stats["upload_wait_p50_ms"] = round(1000.0*metrics.percentile(self.waits, 50), 1)
+            stats["upload_wait_p95_ms"] = round(1000.0*metrics.percentile(self.waits, 95), 1)
+        return stats
@@ -0,0 +1,336 @@
+import asyncio
+import contextvars
+from functools import partial
+import json
+import sys
+import time
+from urllib.parse import urljoin
+
+
+if "/config/pyscript_packages" not in sys.path:
+    sys.path.append("/config/pyscript_packages")
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import teslapy
+import teslapy_wrapper
+
+
+# Same operations as teslapy_wrapper, but the Tesla API requests are made with aiohttp on the event loop
+# rather than blocking an executor thread each.
+# Logging in (and refreshing tokens) is still done by teslapy on an executor thread, and the sessions are shared.
+
+DEFAULT_MAX_WORKERS = teslapy_wrapper.DEFAULT_MAX_WORKERS
+TOKEN_REFRESH_MARGIN = teslapy_wrapper.TOKEN_REFRESH_MARGIN
+get_api_stats = teslapy_wrapper.get_api_stats
+get_api_status_counts = teslapy_wrapper.get_api_status_counts
+get_backoff = teslapy_wrapper.get_backoff
+get_breaker_state = teslapy_wrapper.get_breaker_state
+invalidate_session = teslapy_wrapper.invalidate_session
+parse_retry_after = teslapy_wrapper.parse_retry_after
+set_cache_file = teslapy_wrapper.set_cache_file
+set_call_limits = teslapy_wrapper.set_call_limits
+CircuitOpenError = teslapy_wrapper.CircuitOpenError
+DeadlineExceededError = teslapy_wrapper.DeadlineExceededError
+
+# as teslapy_wrapper
+RETRY_TOTAL = teslapy_wrapper.RETRY_TOTAL
+RETRY_STATUSES = teslapy_wrapper.RETRY_STATUSES
+RETRY_AFTER_STATUSES = teslapy_wrapper.RETRY_AFTER_STATUSES
+REQUEST_TIMEOUT = teslapy_wrapper.REQUEST_TIMEOUT
+# refresh the access token this many seconds before it expires
+TOKEN_EXPIRY_MARGIN = teslapy_wrapper.TOKEN_EXPIRY_MARGIN
+
+ENDPOINTS = {
+    "SITE_CONFIG": ("GET", "api/1/energy_sites/{site_id}/site_info"),
+    "SITE_TARIFF": ("GET", "api/1/energy_sites/{site_id}/tariff_rate"),
+    "TIME_OF_USE_SETTINGS": ("POST", "api/1/energy_sites/{site_id}/time_of_use_settings"),
+    "OPERATION_MODE": ("POST", "api/1/energy_sites/{site_id}/operation"),
+    "BACKUP_RESERVE": ("POST", "api/1/energy_sites/{site_id}/backup"),
+    "ENERGY_SITE_IMPORT_EXPORT_CONFIG": ("POST", "api/1/energy_sites/{site_id}/grid_import_export"),
+}
+
+HTTP_SESSION = None
+# email -> asyncio.Lock
+TOKEN_LOCKS = {}
+# time.monotonic() by which the current operation must complete
+DEADLINE = contextvars.ContextVar("tesla_api_deadline", default=None)
+
+
+@pyscript_compile
+def is_available():
+    return aiohttp is not None
+
+
+@pyscript_compile
+def _get_http_session():
+    global HTTP_SESSION
+    if HTTP_SESSION is None or HTTP_SESSION.closed:
+        HTTP_SESSION = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+    return HTTP_SESSION
+
+
+@pyscript_compile
+def get_retry_after(err):
+    """
+    Seconds the API asked to wait if the error is due to rate limiting, else None.
+    """
+    if not isinstance(err, aiohttp.ClientResponseError) or err.status not in teslapy_wrapper.RATE_LIMIT_STATUSES:
+        return None
+    headers = err.headers or {}
+    return parse_retry_after(headers.get("Retry-After"), teslapy_wrapper.DEFAULT_RETRY_AFTER)
+
+
+@pyscript_compile
+def _get_reason(content, default):
+    try:
+        values = json.loads(content).values()
+    except (ValueError, AttributeError):
+        return default
+    reason = ". ".join(str(v).strip(".") for v in values if v)
+    return reason or default
+
+
+@pyscript_compile
+async def _ensure_token(tesla, email):
+    expires_at = tesla.expires_at
+    if expires_at is None or expires_at - TOKEN_EXPIRY_MARGIN > time.time():
+        return
+    lock = TOKEN_LOCKS.get(email)
+    if lock is None:
+        lock = asyncio.Lock()
+        TOKEN_LOCKS[email] = lock
+    async with lock:
+        # another request may have refreshed it whilst waiting
+        if tesla.expires_at - TOKEN_EXPIRY_MARGIN <= time.time():
+            await asyncio.get_running_loop().run_in_executor(None, tesla.refresh_token)
+
+
+@pyscript_compile
+async def _retry_wait(failures, retry_after, cause):
+    delay = get_backoff(failures, retry_after)
+    deadline = DEADLINE.get()
+    if deadline is not None and time.monotonic() + delay >= deadline:
+        raise DeadlineExceededError(f"Gave up after {failures} attempts: {cause}")
+    await asyncio.sleep(delay)
+
+
+@pyscript_compile
+async def _request(tesla, method, path, data=None):
+    url = urljoin(teslapy.BASE_URL, path)
+    body = json.dumps(data) if data is not None else None
+    http_session = _get_http_session()
+    deadline = DEADLINE.get()
+    failures = 0
+    while True:
+        headers = dict(tesla.headers)
+        headers["Authorization"] = f"Bearer {tesla.token['access_token']}"
+        kwargs = {}
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceededError(f"Gave up after {failures} attempts")
+            # don't let a single request outlast the operation
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=min(REQUEST_TIMEOUT, remaining))
+        try:
+            async with http_session.request(method, url, data=body, headers=headers, **kwargs) as response:
+                content = await response.read()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as err:
+            failures += 1
+            if failures > RETRY_TOTAL:
+                raise
+            await _retry_wait(failures, None, f"{type(err).__name__}: {err}")
+            continue
+
+        status = response.status
+        if status in RETRY_STATUSES and failures < RETRY_TOTAL:
+            failures += 1
+            retry_after = None
+            if status in RETRY_AFTER_STATUSES:
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            await _retry_wait(failures, retry_after, f"HTTP {status}")
+            continue
+
+        teslapy_wrapper.record_api_request(status, failures, len(body) if body else 0, len(content))
+        if status >= 400:
+            raise aiohttp.ClientResponseError(
+                response.request_info,
+                response.history,
+                status=status,
+                message=_get_reason(content, response.reason),
+                headers=response.headers
+            )
+        # some endpoints return an empty response
+        return json.loads(content) if content else None
+
+
+@pyscript_compile
+async def _api(pw, name, data=None):
+    method, path = ENDPOINTS[name]
+    await _ensure_token(pw.tesla, pw.tesla.email)
+    return await _request(pw.tesla, method, path.format(site_id=pw["energy_site_id"]), data)
+
+
+@pyscript_compile
+async def _command(pw, name, **data):
+    response = (await _api(pw, name, data))["response"]
+    if isinstance(response, str):
+        response = json.loads(response)
+    r = {k.lower(): v for k, v in response.items()}
+    if r.get("code") in (200, 201):
+        return r.get("message")
+    raise teslapy.ProductError(response)
+
+
+@pyscript_compile
+async def _get_battery(email, refresh_token, site_id=None):
+    pw = teslapy_wrapper.get_session_battery(email, site_id)
+    if pw is None:
+        pw = await asyncio.get_running_loop().run_in_executor(None, teslapy_wrapper.get_battery, email, refresh_token, site_id)
+    return pw
+
+
+@pyscript_compile
+async def prepare_sessions(sites, margin=TOKEN_REFRESH_MARGIN):
+    return await asyncio.get_running_loop().run_in_executor(None, teslapy_wrapper.warm_sessions, sites, margin)
+
+
+@pyscript_compile
+def is_outage(err):
+    """
+    Whether the error means the API is unreachable or failing, rather than rejecting the request.
+    """
+    if isinstance(err, aiohttp.ClientResponseError):
+        return err.status >= 500
+    if isinstance(err, (aiohttp.ClientConnectionError, asyncio.TimeoutError)):
+        return True
+    return teslapy_wrapper.is_outage(err)
+
+
+@pyscript_compile
+async def _call_once(email, refresh_token, func, site_id):
+    pw = await _get_battery(email, refresh_token, site_id)
+    try:
+        return await func(pw)
+    except aiohttp.ClientResponseError as err:
+        if err.status != 401:
+            raise
+    # credentials have gone stale, so log in afresh and try once more
+    invalidate_session(email)
+    pw = await _get_battery(email, refresh_token, site_id)
+    return await func(pw)
+
+
+@pyscript_compile
+async def _call(email, refresh_token, func, site_id=None, budget_key="read_budget"):
+    """
+    Calls func with the site's battery, retrying transient failures within the operation's budget,
+    and failing fast whilst the circuit breaker (shared with teslapy_wrapper) is open.
+    """
+    probe = teslapy_wrapper.check_circuit()
+    budget = teslapy_wrapper.LIMITS[budget_key]
+    deadline = time.monotonic() + budget
+    token = DEADLINE.set(deadline)
+    failed = True
+    try:
+        # logging in isn't bounded by the request timeouts
+        value = await asyncio.wait_for(_call_once(email, refresh_token, func, site_id), budget)
+        failed = False
+    except Exception as err:
+        failed = is_outage(err)
+        if isinstance(err, asyncio.TimeoutError) and time.monotonic() >= deadline:
+            raise DeadlineExceededError(f"Did not complete within {budget}s") from err
+        raise
+    finally:
+        DEADLINE.reset(token)
+        teslapy_wrapper.record_outcome(probe, failed)
+    return value
+
+
+@pyscript_compile
+async def _call_site(site, func, semaphore):
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            value = await _call(site["email"], site["refresh_token"], func, site_id=site.get("energy_site_id"))
+            error = None
+        except Exception as err:
+            value = None
+            error = f"{type(err).__name__}: {err}"
+        return {"name": site["name"], "value": value, "error": error, "duration": time.perf_counter() - start}
+
+
+@pyscript_compile
+async def _call_sites(sites, func, max_workers):
+    """
+    Calls func for each site, with at most max_workers in flight.
+    Returns a result per site, with any error reported rather than raised.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_workers))
+    return list(await asyncio.gather(*[_call_site(site, func, semaphore) for site in sites]))
+
+
+@pyscript_compile
+async def _get_tariff(pw):
+    return (await _api(pw, "SITE_TARIFF"))["response"]
+
+
+@pyscript_compile
+async def _set_tariff(pw, tariff_data):
+    return await _command(pw, "TIME_OF_USE_SETTINGS", tou_settings={"tariff_content": tariff_data})
+
+
+@pyscript_compile
+async def set_powerwall_tariff(email, refresh_token, tariff_data, site_id=None):
+    await _call(email, refresh_token, partial(_set_tariff, tariff_data=tariff_data), site_id=site_id, budget_key="write_budget")
+
+
+@pyscript_compile
+async def get_powerwall_tariff(email, refresh_token, site_id=None):
+    return await _call(email, refresh_token, _get_tariff, site_id=site_id)
+
+
+@pyscript_compile
+async def get_site_tariffs(sites, max_workers=DEFAULT_MAX_WORKERS):
+    return await _call_sites(sites, _get_tariff, max_workers)
+
+
+@pyscript_compile
+async def _set_settings(pw, reserve_percentage, mode, allow_grid_charging, allow_battery_export):
+    if reserve_percentage is not None:
+        await _command(pw, "BACKUP_RESERVE", backup_reserve_percent=int(reserve_percentage))
+    if mode is not None:
+        await _command(pw, "OPERATION_MODE", default_real_mode=mode)
+    if allow_grid_charging is not None or allow_battery_export is not None:
+        params = {}
+        if allow_grid_charging is not None:
+            params["disallow_charge_from_grid_with_solar_installed"] = not allow_grid_charging
+        if allow_battery_export is not None:
+            params["customer_preferred_export_rule"] = "battery_ok" if allow_battery_export else "pv_only"
+        # returns an empty response rather than a result code
+        await _api(pw, "ENERGY_SITE_IMPORT_EXPORT_CONFIG", params)
+
+
+@pyscript_compile
+async def set_powerwall_settings(email, refresh_token, reserve_percentage=None, mode=None, allow_grid_charging=None, allow_battery_export=None, site_id=None):
+    await _call(email, refresh_token, partial(
+        _set_settings,
+        reserve_percentage=reserve_percentage,
+        mode=mode,
+        allow_grid_charging=allow_grid_charging,
+        allow_battery_export=allow_battery_export
+    ), site_id=site_id, budget_key="write_budget")
+
+
+@pyscript_compile
+async def _get_settings(pw):
+    info = (await _api(pw, "SITE_CONFIG"))["response"]
+    return teslapy_wrapper.site_info_to_settings(info)
+
+
+@pyscript_compile
+async def get_powerwall_settings(email, refresh_token, site_id=None):
+    return await _call(email, refresh_token, _get_settings, site_id=site_id)
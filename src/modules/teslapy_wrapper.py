@@ -1,57 +1,603 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import math
+import os
 import sys
+import tempfile
+import threading
+import time
 
 
 if "/config/pyscript_packages" not in sys.path:
     sys.path.append("/config/pyscript_packages")
 
+import requests
 import teslapy
 
 
+DEFAULT_MAX_WORKERS = 4
+
+DEFAULT_CACHE_FILE = "/config/.powerwall_tesla_cache.json"
+# tokens are refreshed in the background when they expire within this many seconds
+TOKEN_REFRESH_MARGIN = 3600
+# cached tokens expiring sooner than this are refreshed before use
+TOKEN_EXPIRY_MARGIN = 60
+# the energy products of each account are cached under this key, alongside teslapy's token per account
+PRODUCTS_KEY = "_products"
+
+# statuses for which the API may ask (with Retry-After) for requests to be slowed down
+RATE_LIMIT_STATUSES = (429, 503)
+# seconds to wait if it doesn't say how long
+DEFAULT_RETRY_AFTER = 60
+
+# transient failures are retried as urllib3 would: no wait for the first retry, then doubling
+RETRY_TOTAL = 5
+RETRY_BACKOFF_FACTOR = 1
+RETRY_BACKOFF_MAX = 120
+RETRY_STATUSES = (503, 504)
+RETRY_AFTER_STATUSES = (413, 429, 503)
+REQUEST_TIMEOUT = 10
+
+# seconds within which an operation must complete, retries included (a request in flight may overrun by up to REQUEST_TIMEOUT)
+READ_BUDGET = 30
+WRITE_BUDGET = 60
+# the circuit opens after this many consecutive operations fail because the API is unreachable or erroring,
+# and lets a single probe through once it has been open for this many seconds
+BREAKER_THRESHOLD = 3
+BREAKER_RESET_TIMEOUT = 120
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+LIMITS = {"read_budget": READ_BUDGET, "write_budget": WRITE_BUDGET, "breaker_threshold": BREAKER_THRESHOLD, "breaker_reset_timeout": BREAKER_RESET_TIMEOUT}
+# shared by all operations, as an outage affects them all
+BREAKER = {"state": CLOSED, "failures": 0, "opened_at": None, "rejected": 0}
+BREAKER_LOCK = threading.Lock()
+
+# tokens (as rotated) and products persisted across restarts, in teslapy's cache format
+CACHE = {"file": DEFAULT_CACHE_FILE, "data": None}
+CACHE_LOCK = threading.RLock()
+
+# email -> {"tesla": Tesla, "batteries": [Battery]}
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+# email -> Lock, so that different accounts can log in concurrently
+SESSION_LOCKS = {}
+
+# cumulative counts of requests made to the Tesla API
+API_STATS = {"api_requests": 0, "api_retries": 0, "api_errors": 0, "api_request_bytes": 0, "api_response_bytes": 0}
+API_STATS_LOCK = threading.Lock()
+# HTTP status -> count of responses
+API_STATUS_COUNTS = {}
+
+
+@pyscript_compile
+def record_api_request(status, retries, request_bytes, response_bytes):
+    with API_STATS_LOCK:
+        API_STATS["api_requests"] += 1
+        API_STATS["api_retries"] += retries
+        if status >= 400:
+            API_STATS["api_errors"] += 1
+        API_STATUS_COUNTS[status] = API_STATUS_COUNTS.get(status, 0) + 1
+        API_STATS["api_request_bytes"] += request_bytes
+        API_STATS["api_response_bytes"] += response_bytes
+
+
+@pyscript_compile
+def _record_response(response, *args, **kwargs):
+    retries = getattr(response.raw, "retries", None)
+    body = response.request.body if response.request is not None else None
+    record_api_request(
+        response.status_code,
+        len(retries.history) if retries is not None else 0,
+        len(body) if body else 0,
+        len(response.content or b"")
+    )
+
+
+@pyscript_compile
+def record_api_retry():
+    with API_STATS_LOCK:
+        API_STATS["api_retries"] += 1
+
+
+@pyscript_compile
+def get_api_stats():
+    with API_STATS_LOCK:
+        return dict(API_STATS)
+
+
+@pyscript_compile
+def get_api_status_counts():
+    with API_STATS_LOCK:
+        return dict(API_STATUS_COUNTS)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised without calling the API whilst it is considered unavailable.
+    """
+
+
+class DeadlineExceededError(Exception):
+    """
+    Raised when an operation could not be completed within its budget.
+    """
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+@pyscript_compile
+def set_cache_file(path):
+    """
+    Where tokens and products are persisted, or None to only hold them in memory.
+    """
+    with CACHE_LOCK:
+        CACHE["file"] = path
+        CACHE["data"] = None
+
+
+@pyscript_compile
+def _read_cache_file(path):
+    if path is None:
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError):
+        LOGGER.warning("Ignoring unreadable Tesla cache %s", path, exc_info=True)
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+@pyscript_compile
+def _write_cache_file(path, data):
+    """
+    Replaces the file atomically, so that a crash mid-write leaves the previous contents.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp_tesla_cache")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+@pyscript_compile
+def _load_cache():
+    with CACHE_LOCK:
+        if CACHE["data"] is None:
+            CACHE["data"] = _read_cache_file(CACHE["file"])
+        # callers (e.g. teslapy) modify what they load
+        return json.loads(json.dumps(CACHE["data"]))
+
+
+@pyscript_compile
+def _dump_cache(data):
+    with CACHE_LOCK:
+        CACHE["data"] = json.loads(json.dumps(data))
+        if CACHE["file"] is not None:
+            try:
+                _write_cache_file(CACHE["file"], data)
+            except OSError:
+                LOGGER.warning("Cannot write Tesla cache %s", CACHE["file"], exc_info=True)
+
+
+@pyscript_compile
+def _get_cached_products(email):
+    return _load_cache().get(PRODUCTS_KEY, {}).get(email)
+
+
+@pyscript_compile
+def _set_cached_products(email, products):
+    with CACHE_LOCK:
+        data = _load_cache()
+        data.setdefault(PRODUCTS_KEY, {})[email] = products
+        _dump_cache(data)
+
+
+@pyscript_compile
+def _expire_cached_token(email):
+    with CACHE_LOCK:
+        data = _load_cache()
+        token = data.get(email, {}).get("sso")
+        if token:
+            token["expires_at"] = 0
+            _dump_cache(data)
+
+
+@pyscript_compile
+def _authorize(tesla, refresh_token):
+    """
+    Uses the cached token if it is current, else refreshes it, falling back to the configured refresh token.
+    """
+    if tesla.authorized:
+        if (tesla.expires_at or 0) - TOKEN_EXPIRY_MARGIN > time.time():
+            return
+        try:
+            # the cached refresh token supersedes the configured one if it has been rotated
+            tesla.refresh_token()
+            return
+        except Exception:
+            LOGGER.warning("Cannot refresh cached Tesla token for %s, using the configured refresh token", tesla.email, exc_info=True)
+            tesla.token = {}
+    tesla.refresh_token(refresh_token=refresh_token)
+
+
+@pyscript_compile
+def _fetch_batteries(email, tesla):
+    batteries = tesla.battery_list()
+    _set_cached_products(email, [dict(pw) for pw in batteries])
+    return batteries
+
+
+@pyscript_compile
+def parse_retry_after(value, default=None):
+    if value is None:
+        return default
+    try:
+        return max(0, int(value))
+    except ValueError:
+        return default
+
+
+@pyscript_compile
+def get_retry_after(err):
+    """
+    Seconds the API asked to wait if the error is due to rate limiting, else None.
+    """
+    response = getattr(err, "response", None)
+    if response is None or response.status_code not in RATE_LIMIT_STATUSES:
+        return None
+    return parse_retry_after(response.headers.get("Retry-After"), DEFAULT_RETRY_AFTER)
+
+
+@pyscript_compile
+def _create_session(email, refresh_token):
+    # retries are made by _call, within the operation's budget
+    tesla = teslapy.Tesla(email, timeout=REQUEST_TIMEOUT, cache_loader=_load_cache, cache_dumper=_dump_cache)
+    tesla.hooks["response"].append(_record_response)
+    try:
+        _authorize(tesla, refresh_token)
+        products = _get_cached_products(email)
+        if products:
+            batteries = [teslapy.Battery(product, tesla) for product in products]
+        else:
+            batteries = _fetch_batteries(email, tesla)
+    except:
+        tesla.close()
+        raise
+    return {"tesla": tesla, "batteries": batteries, "cached_products": bool(products)}
+
+
+@pyscript_compile
+def _get_session_lock(email):
+    with SESSIONS_LOCK:
+        lock = SESSION_LOCKS.get(email)
+        if lock is None:
+            lock = threading.Lock()
+            SESSION_LOCKS[email] = lock
+        return lock
+
+
+@pyscript_compile
+def get_battery(email, refresh_token, site_id=None):
+    """
+    Blocking, as it logs in if there is no session for the account.
+    """
+    with _get_session_lock(email):
+        session = SESSIONS.get(email)
+        if session is None:
+            session = _create_session(email, refresh_token)
+            SESSIONS[email] = session
+        if session["cached_products"] and not _has_battery(session["batteries"], site_id):
+            # the site may have been added since the products were cached
+            session["batteries"] = _fetch_batteries(email, session["tesla"])
+            session["cached_products"] = False
+    return _find_battery(session["batteries"], email, site_id)
+
+
+@pyscript_compile
+def get_session_battery(email, site_id=None):
+    """
+    The battery from an existing session, or None if there is no session for the account.
+    """
+    session = SESSIONS.get(email)
+    if session is None:
+        return None
+    return _find_battery(session["batteries"], email, site_id)
+
+
+@pyscript_compile
+def _has_battery(batteries, site_id):
+    if site_id is None:
+        return len(batteries) > 0
+    for pw in batteries:
+        if str(pw["energy_site_id"]) == str(site_id):
+            return True
+    return False
+
+
+@pyscript_compile
+def _find_battery(batteries, email, site_id):
+    if site_id is None:
+        return batteries[0]
+    for pw in batteries:
+        if str(pw["energy_site_id"]) == str(site_id):
+            return pw
+    raise ValueError(f"Energy site {site_id} not found for {email}")
+
+
+@pyscript_compile
+def invalidate_session(email):
+    """
+    Drops the account's session, and its cached token so that the next session logs in afresh.
+    """
+    with _get_session_lock(email):
+        session = SESSIONS.pop(email, None)
+        _expire_cached_token(email)
+    if session is not None:
+        session["tesla"].close()
+
+
+@pyscript_compile
+def warm_sessions(sites, margin=TOKEN_REFRESH_MARGIN):
+    """
+    Blocking. Opens a session for each site's account (from the cache where possible),
+    and refreshes tokens that expire within margin seconds, so that updates needn't wait for either.
+    Returns the error, if any, for each site by name.
+    """
+    errors = {}
+    for site in sites:
+        email = site["email"]
+        try:
+            get_battery(email, site["refresh_token"], site.get("energy_site_id"))
+            with _get_session_lock(email):
+                session = SESSIONS.get(email)
+                if session is not None:
+                    tesla = session["tesla"]
+                    if (tesla.expires_at or 0) - margin <= time.time():
+                        tesla.refresh_token()
+        except Exception as err:
+            errors[site["name"]] = f"{type(err).__name__}: {err}"
+    return errors
+
+
 @pyscript_executor
-def set_powerwall_tariff(email, refresh_token, tariff_data):
-    retry = teslapy.Retry(total=5, allowed_methods=None, backoff_factor=1, status_forcelist=(503, 504))
-    with teslapy.Tesla(email, retry=retry) as tesla:
-        if not tesla.authorized:
-            tesla.refresh_token(refresh_token=refresh_token)
-        pw = tesla.battery_list()[0]
-        pw.set_tariff(tariff_data)
+def prepare_sessions(sites, margin=TOKEN_REFRESH_MARGIN):
+    return warm_sessions(sites, margin)
+
+
+@pyscript_compile
+def _is_auth_error(err):
+    if isinstance(err, teslapy.HTTPError):
+        return err.response is not None and err.response.status_code == 401
+    return isinstance(err, teslapy.TokenExpiredError)
+
+
+@pyscript_compile
+def set_call_limits(read_budget=None, write_budget=None, breaker_threshold=None, breaker_reset_timeout=None):
+    with BREAKER_LOCK:
+        for key, v in (("read_budget", read_budget), ("write_budget", write_budget), ("breaker_threshold", breaker_threshold), ("breaker_reset_timeout", breaker_reset_timeout)):
+            if v is not None:
+                LIMITS[key] = v
+
+
+@pyscript_compile
+def get_breaker_state():
+    with BREAKER_LOCK:
+        state = {"api_circuit": BREAKER["state"], "api_consecutive_failures": BREAKER["failures"], "api_calls_rejected": BREAKER["rejected"]}
+        if BREAKER["state"] != CLOSED:
+            state["api_circuit_retry_in"] = max(0, math.ceil(BREAKER["opened_at"] + LIMITS["breaker_reset_timeout"] - time.monotonic()))
+        return state
+
+
+@pyscript_compile
+def _open_circuit():
+    BREAKER["state"] = OPEN
+    BREAKER["opened_at"] = time.monotonic()
+    LOGGER.warning("Tesla API unavailable after %d consecutive failures, failing fast for %ss", BREAKER["failures"], LIMITS["breaker_reset_timeout"])
+
+
+@pyscript_compile
+def check_circuit():
+    """
+    Raises CircuitOpenError whilst the circuit is open, except for a single (half-open) probe
+    once it has been open for the reset timeout. Returns whether the call is that probe.
+    """
+    with BREAKER_LOCK:
+        if BREAKER["state"] == CLOSED:
+            return False
+        retry_in = BREAKER["opened_at"] + LIMITS["breaker_reset_timeout"] - time.monotonic()
+        if BREAKER["state"] == OPEN and retry_in <= 0:
+            BREAKER["state"] = HALF_OPEN
+            return True
+        BREAKER["rejected"] += 1
+        when = f"in {math.ceil(retry_in)}s" if retry_in > 0 else "now"
+        raise CircuitOpenError(f"Tesla API unavailable after {BREAKER['failures']} consecutive failures, retrying {when}")
+
+
+@pyscript_compile
+def record_outcome(probe, failed):
+    with BREAKER_LOCK:
+        if not failed:
+            BREAKER["state"] = CLOSED
+            BREAKER["failures"] = 0
+            return
+        BREAKER["failures"] += 1
+        if probe or (BREAKER["state"] == CLOSED and BREAKER["failures"] >= LIMITS["breaker_threshold"]):
+            _open_circuit()
+
+
+@pyscript_compile
+def _get_status(err):
+    response = getattr(err, "response", None)
+    return response.status_code if response is not None else None
+
+
+@pyscript_compile
+def _is_transient(err):
+    if isinstance(err, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return isinstance(err, teslapy.HTTPError) and _get_status(err) in RETRY_STATUSES
+
+
+@pyscript_compile
+def is_outage(err):
+    """
+    Whether the error means the API is unreachable or failing, rather than rejecting the request.
+    """
+    if isinstance(err, (DeadlineExceededError, requests.ConnectionError, requests.Timeout)):
+        return True
+    status = _get_status(err)
+    return status is not None and status >= 500
+
+
+@pyscript_compile
+def get_backoff(failures, retry_after=None):
+    """
+    Seconds to wait before retrying after the given number of consecutive failures.
+    """
+    if retry_after is not None:
+        return retry_after
+    if failures <= 1:
+        return 0
+    return min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_FACTOR*(2**(failures - 1)))
+
+
+@pyscript_compile
+def _call_once(email, refresh_token, func, site_id):
+    pw = get_battery(email, refresh_token, site_id)
+    try:
+        return func(pw)
+    except (teslapy.HTTPError, teslapy.TokenExpiredError) as err:
+        if not _is_auth_error(err):
+            raise
+    # credentials have gone stale, so log in afresh and try once more
+    invalidate_session(email)
+    pw = get_battery(email, refresh_token, site_id)
+    return func(pw)
+
+
+@pyscript_compile
+def _call_with_retries(email, refresh_token, func, site_id, budget):
+    deadline = time.monotonic() + budget
+    failures = 0
+    while True:
+        try:
+            return _call_once(email, refresh_token, func, site_id)
+        except Exception as err:
+            if not _is_transient(err) or failures >= RETRY_TOTAL:
+                raise
+            failures += 1
+            retry_after = None
+            if _get_status(err) in RETRY_AFTER_STATUSES:
+                retry_after = parse_retry_after(err.response.headers.get("Retry-After"))
+            delay = get_backoff(failures, retry_after)
+            if time.monotonic() + delay >= deadline:
+                raise DeadlineExceededError(f"Gave up after {failures} attempts within {budget}s: {type(err).__name__}: {err}") from err
+            record_api_retry()
+            time.sleep(delay)
+
+
+@pyscript_compile
+def _call(email, refresh_token, func, site_id=None, budget_key="read_budget"):
+    """
+    Calls func with the site's battery, retrying transient failures within the operation's budget,
+    and failing fast whilst the circuit breaker is open.
+    """
+    probe = check_circuit()
+    # anything that stops the call short (even being cancelled) counts against it, so a probe is never left outstanding
+    failed = True
+    try:
+        value = _call_with_retries(email, refresh_token, func, site_id, LIMITS[budget_key])
+        failed = False
+    except Exception as err:
+        failed = is_outage(err)
+        raise
+    finally:
+        record_outcome(probe, failed)
+    return value
+
+
+@pyscript_compile
+def _call_site(site, func):
+    start = time.perf_counter()
+    try:
+        value = _call(site["email"], site["refresh_token"], func, site_id=site.get("energy_site_id"))
+        error = None
+    except Exception as err:
+        value = None
+        error = f"{type(err).__name__}: {err}"
+    return {"name": site["name"], "value": value, "error": error, "duration": time.perf_counter() - start}
+
+
+@pyscript_compile
+def _call_sites(sites, func, max_workers):
+    """
+    Calls func for each site, concurrently across at most max_workers threads.
+    Returns a result per site, with any error reported rather than raised.
+    """
+    if len(sites) <= 1 or max_workers <= 1:
+        return [_call_site(site, func) for site in sites]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(sites))) as pool:
+        return list(pool.map(lambda site: _call_site(site, func), sites))
 
 
 @pyscript_executor
-def get_powerwall_tariff(email, refresh_token):
-    retry = teslapy.Retry(total=5, allowed_methods=None, backoff_factor=1, status_forcelist=(503, 504))
-    with teslapy.Tesla(email, retry=retry) as tesla:
-        if not tesla.authorized:
-            tesla.refresh_token(refresh_token=refresh_token)
-        pw = tesla.battery_list()[0]
-        return pw.get_tariff()
+def set_powerwall_tariff(email, refresh_token, tariff_data, site_id=None):
+    _call(email, refresh_token, lambda pw: pw.set_tariff(tariff_data), site_id=site_id, budget_key="write_budget")
 
 
 @pyscript_executor
-def set_powerwall_settings(email, refresh_token, reserve_percentage=None, mode=None, allow_grid_charging=None, allow_battery_export=None):
-    retry = teslapy.Retry(total=5, allowed_methods=None, backoff_factor=1, status_forcelist=(503, 504))
-    with teslapy.Tesla(email, retry=retry) as tesla:
-        if not tesla.authorized:
-            tesla.refresh_token(refresh_token=refresh_token)
-        pw = tesla.battery_list()[0]
-        if reserve_percentage is not None:
-            pw.set_backup_reserve_percent(reserve_percentage)
-        if mode is not None:
-            pw.set_operation(mode=mode)
-        if allow_grid_charging is not None or allow_battery_export is not None:
-            pw.set_import_export(allow_grid_charging=allow_grid_charging, allow_battery_export=allow_battery_export)
+def get_powerwall_tariff(email, refresh_token, site_id=None):
+    return _call(email, refresh_token, lambda pw: pw.get_tariff(), site_id=site_id)
+
+
+@pyscript_executor
+def get_site_tariffs(sites, max_workers=DEFAULT_MAX_WORKERS):
+    return _call_sites(sites, lambda pw: pw.get_tariff(), max_workers)
+
+
+@pyscript_compile
+def _set_settings(pw, reserve_percentage, mode, allow_grid_charging, allow_battery_export):
+    if reserve_percentage is not None:
+        pw.set_backup_reserve_percent(reserve_percentage)
+    if mode is not None:
+        pw.set_operation(mode=mode)
+    if allow_grid_charging is not None or allow_battery_export is not None:
+        pw.set_import_export(allow_grid_charging=allow_grid_charging, allow_battery_export=allow_battery_export)
+
+
+@pyscript_executor
+def set_powerwall_settings(email, refresh_token, reserve_percentage=None, mode=None, allow_grid_charging=None, allow_battery_export=None, site_id=None):
+    _call(email, refresh_token, lambda pw: _set_settings(pw, reserve_percentage, mode, allow_grid_charging, allow_battery_export), site_id=site_id, budget_key="write_budget")
+
+
+@pyscript_compile
+def site_info_to_settings(info):
+    return {
+        "reserve_percentage": info["backup_reserve_percent"],
+        "mode": info["default_real_mode"],
+        "allow_grid_charging": not info["components"].get("disallow_charge_from_grid_with_solar_installed", False),
+        "allow_battery_export": info["components"]["customer_preferred_export_rule"] == "battery_ok"
+    }
+
+
+@pyscript_compile
+def _get_settings(pw):
+    return site_info_to_settings(pw.get_site_info())
+
 
 @pyscript_executor
-def get_powerwall_settings(email, refresh_token):
-    retry = teslapy.Retry(total=5, allowed_methods=None, backoff_factor=1, status_forcelist=(503, 504))
-    with teslapy.Tesla(email, retry=retry) as tesla:
-        if not tesla.authorized:
-            tesla.refresh_token(refresh_token=refresh_token)
-        pw = tesla.battery_list()[0]
-        info = pw.get_site_info()
-        return {
-            "reserve_percentage": info["backup_reserve_percent"],
-            "mode": info["default_real_mode"],
-            "allow_grid_charging": not info["components"].get("disallow_charge_from_grid_with_solar_installed", False),
-            "allow_battery_export": info["components"]["customer_preferred_export_rule"] == "battery_ok"
-        }
+def get_powerwall_settings(email, refresh_token, site_id=None):
+    return _call(email, refresh_token, _get_settings, site_id=site_id)
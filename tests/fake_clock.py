@@ -0,0 +1,9 @@
+class FakeClock:
+    """
+    Stands in for time.monotonic, returning t, which tests advance.
+    """
+    def __init__(self):
+        self.t = 0.0
+
+    def __call__(self):
+        return self.t
@@ -0,0 +1,176 @@
+import asyncio
+import builtins
+import json
+import os
+import tempfile
+import time
+import unittest
+
+import sys
+sys.path.append("../src/modules")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+# outside pyscript, the wrappers' decorators have nothing to do
+builtins.pyscript_compile = lambda f: f
+builtins.pyscript_executor = lambda f: f
+import mock_tesla_api as mock
+import teslapy
+import teslapy_wrapper as api_wrapper
+import teslapy_async_wrapper as async_api_wrapper
+
+
+EMAIL = "test@example.com"
+REFRESH_TOKEN = "refresh"
+
+
+class TestAPI(unittest.TestCase):
+    def setUp(self):
+        self.api = mock.MockTeslaAPI(num_sites=2).start()
+        mock.configure_teslapy(self.api.base_url)
+        api_wrapper.invalidate_session(EMAIL)
+        api_wrapper.set_cache_file(None)
+        api_wrapper.set_call_limits(read_budget=api_wrapper.READ_BUDGET, write_budget=api_wrapper.WRITE_BUDGET, breaker_threshold=api_wrapper.BREAKER_THRESHOLD, breaker_reset_timeout=api_wrapper.BREAKER_RESET_TIMEOUT)
+        api_wrapper.BREAKER.update({"state": api_wrapper.CLOSED, "failures": 0, "opened_at": None, "rejected": 0})
+        self.site_id = self.api.site_ids[1]
+
+    def tearDown(self):
+        self.api.stop()
+        api_wrapper.set_cache_file(None)
+
+    def restart(self, cache_file):
+        # as the app would find things after a restart: no sessions, and only what is in the cache file
+        session = api_wrapper.SESSIONS.pop(EMAIL, None)
+        if session is not None:
+            session["tesla"].close()
+        api_wrapper.set_cache_file(cache_file)
+
+    def test_cache_file(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_file = os.path.join(cache_dir, "cache.json")
+            api_wrapper.set_cache_file(cache_file)
+            self.assertEqual({}, api_wrapper._load_cache())
+            data = {EMAIL: {"url": "https://auth", "sso": {"access_token": "access", "refresh_token": "refresh", "expires_at": 2e9}}}
+            api_wrapper._dump_cache(data)
+            api_wrapper._set_cached_products(EMAIL, [{"energy_site_id": self.site_id}])
+            # replaced atomically, so nothing else is left behind
+            self.assertEqual(["cache.json"], os.listdir(cache_dir))
+
+            api_wrapper.set_cache_file(cache_file)
+            self.assertEqual(data[EMAIL], api_wrapper._load_cache()[EMAIL])
+            self.assertEqual([{"energy_site_id": self.site_id}], api_wrapper._get_cached_products(EMAIL))
+            # what is loaded may be modified without changing the cache
+            api_wrapper._load_cache()[EMAIL]["sso"]["expires_at"] = 0
+            api_wrapper._expire_cached_token(EMAIL)
+            with open(cache_file, "r", encoding="utf-8") as f:
+                self.assertEqual(0, json.load(f)[EMAIL]["sso"]["expires_at"])
+
+            with open(cache_file, "w", encoding="utf-8") as f:
+                f.write("{")
+            api_wrapper.set_cache_file(cache_file)
+            with self.assertLogs(api_wrapper.LOGGER, "WARNING"):
+                self.assertEqual({}, api_wrapper._load_cache())
+
+    def test_warm_sessions(self):
+        sites = [{"name": "home", "email": EMAIL, "refresh_token": REFRESH_TOKEN, "energy_site_id": self.site_id}]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_file = os.path.join(cache_dir, "cache.json")
+            self.restart(cache_file)
+            self.assertEqual({}, api_wrapper.warm_sessions(sites))
+            self.assertEqual(1, self.api.count(mock.TOKEN))
+            self.assertEqual(1, self.api.count("PRODUCT_LIST"))
+
+            # a current token and the products are taken from the cache, without any requests
+            self.restart(cache_file)
+            self.assertEqual({}, api_wrapper.warm_sessions(sites))
+            self.assertEqual(2, self.api.count())
+
+            # a token expiring within the margin is refreshed ahead of time
+            data = api_wrapper._load_cache()
+            data[EMAIL]["sso"]["expires_at"] = time.time() + api_wrapper.TOKEN_REFRESH_MARGIN/2
+            api_wrapper._dump_cache(data)
+            self.restart(cache_file)
+            self.assertEqual({}, api_wrapper.warm_sessions(sites))
+            self.assertEqual(2, self.api.count(mock.TOKEN))
+            self.assertEqual(1, self.api.count("PRODUCT_LIST"))
+            with open(cache_file, "r", encoding="utf-8") as f:
+                token = json.load(f)[EMAIL]["sso"]
+            self.assertGreater(token["expires_at"], time.time() + api_wrapper.TOKEN_REFRESH_MARGIN)
+            self.assertEqual({}, api_wrapper.get_powerwall_tariff(EMAIL, REFRESH_TOKEN, site_id=self.site_id))
+
+    def test_tariff_and_settings(self):
+        tariff_data = {"name": "Agile", "utility": "Octopus"}
+        api_wrapper.set_powerwall_tariff(EMAIL, REFRESH_TOKEN, tariff_data, site_id=self.site_id)
+        self.assertEqual(tariff_data, api_wrapper.get_powerwall_tariff(EMAIL, REFRESH_TOKEN, site_id=self.site_id))
+        self.assertEqual({}, api_wrapper.get_powerwall_tariff(EMAIL, REFRESH_TOKEN))
+
+        api_wrapper.set_powerwall_settings(EMAIL, REFRESH_TOKEN, reserve_percentage=50, mode="backup", allow_grid_charging=False, allow_battery_export=True, site_id=self.site_id)
+        expected = {"reserve_percentage": 50, "mode": "backup", "allow_grid_charging": False, "allow_battery_export": True}
+        self.assertEqual(expected, api_wrapper.get_powerwall_settings(EMAIL, REFRESH_TOKEN, site_id=self.site_id))
+        # logged in and listed the batteries once
+        self.assertEqual(1, self.api.count(mock.TOKEN))
+        self.assertEqual(1, self.api.count("PRODUCT_LIST"))
+
+    def test_retries(self):
+        api_wrapper.get_powerwall_tariff(EMAIL, REFRESH_TOKEN, site_id=self.site_id)
+        retries = api_wrapper.get_api_stats()["api_retries"]
+        self.api.inject(503, endpoint="SITE_TARIFF", count=2, retry_after=0)
+        self.assertEqual({}, api_wrapper.get_powerwall_tariff(EMAIL, REFRESH_TOKEN, site_id=self.site_id))
+        self.assertEqual(2, self.api.count("SITE_TARIFF", 503))
+        self.assertEqual(retries + 2, api_wrapper.get_api_stats()["api_retries"])
+
+        # not retried, nor an outage
+        self.api.inject(429, retry_after=30)
+        with self.assertRaises(teslapy.HTTPError) as cm:
+            api_wrapper.get_powerwall_tariff(EMAIL, REFRESH_TOKEN, site_id=self.site_id)
+        self.assertEqual(30, api_wrapper.get_retry_after(cm.exception))
+        self.assertEqual(api_wrapper.CLOSED, api_wrapper.get_breaker_state()["api_circuit"])
+
+    def test_expired_token(self):
+        api_wrapper.get_powerwall_tariff(EMAIL, REFRESH_TOKEN, site_id=self.site_id)
+        self.api.expire_tokens()
+        self.assertEqual({}, api_wrapper.get_powerwall_tariff(EMAIL, REFRESH_TOKEN, site_id=self.site_id))
+        self.assertEqual(1, self.api.count("SITE_TARIFF", 401))
+        self.assertEqual(2, self.api.count(mock.TOKEN))
+
+    def test_circuit_breaker(self):
+        api_wrapper.get_powerwall_tariff(EMAIL, REFRESH_TOKEN, site_id=self.site_id)
+        # the second retry would wait beyond the budget
+        api_wrapper.set_call_limits(read_budget=1, breaker_threshold=2)
+        self.api.inject(503, endpoint="SITE_TARIFF", probability=1.0)
+        for _ in range(2):
+            with self.assertRaises(api_wrapper.DeadlineExceededError):
+                api_wrapper.get_powerwall_tariff(EMAIL, REFRESH_TOKEN, site_id=self.site_id)
+        self.assertEqual(api_wrapper.OPEN, api_wrapper.get_breaker_state()["api_circuit"])
+        requests = self.api.count()
+        with self.assertRaises(api_wrapper.CircuitOpenError):
+            api_wrapper.get_powerwall_tariff(EMAIL, REFRESH_TOKEN, site_id=self.site_id)
+        self.assertEqual(requests, self.api.count())
+
+        # a successful probe closes it
+        self.api.clear_faults()
+        api_wrapper.set_call_limits(breaker_reset_timeout=0)
+        self.assertEqual({}, api_wrapper.get_powerwall_tariff(EMAIL, REFRESH_TOKEN, site_id=self.site_id))
+        self.assertEqual(api_wrapper.CLOSED, api_wrapper.get_breaker_state()["api_circuit"])
+
+    @unittest.skipUnless(async_api_wrapper.is_available(), "requires aiohttp")
+    def test_async(self):
+        sites = [{"name": "home", "email": EMAIL, "refresh_token": REFRESH_TOKEN, "energy_site_id": self.site_id}]
+        tariff_data = {"name": "Agile"}
+
+        async def run():
+            try:
+                await async_api_wrapper.set_powerwall_tariff(EMAIL, REFRESH_TOKEN, tariff_data, site_id=self.site_id)
+                self.api.inject(504, endpoint="SITE_TARIFF", retry_after=0)
+                self.api.expire_tokens()
+                return await async_api_wrapper.get_site_tariffs(sites)
+            finally:
+                await async_api_wrapper.HTTP_SESSION.close()
+
+        results = asyncio.run(run())
+        self.assertEqual(tariff_data, results[0]["value"])
+        self.assertEqual(1, self.api.count("SITE_TARIFF", 504))
+        self.assertEqual(1, self.api.count("SITE_TARIFF", 401))
+        self.assertEqual(2, self.api.count(mock.TOKEN))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+import sys
+sys.path.append("../src/modules")
+import powerwall_cache as cache
+
+from fake_clock import FakeClock
+
+
+class TestCache(unittest.TestCase):
+    def test_get(self):
+        clock = FakeClock()
+        remote_cache = cache.RemoteCache(10, clock=clock)
+        self.assertEqual((None, cache.MISSING), remote_cache.get(allow_stale=True))
+        remote_cache.put({"mode": "backup"})
+        clock.t = 10
+        self.assertEqual(({"mode": "backup"}, cache.FRESH), remote_cache.get())
+        clock.t = 11
+        self.assertEqual((None, cache.STALE), remote_cache.get())
+        self.assertEqual(({"mode": "backup"}, cache.STALE), remote_cache.get(allow_stale=True))
+        self.assertEqual({"hits": 1, "stale_hits": 1, "misses": 2}, remote_cache.get_stats())
+
+    def test_update(self):
+        clock = FakeClock()
+        remote_cache = cache.RemoteCache(10, clock=clock)
+        remote_cache.update({"mode": "backup"})
+        self.assertEqual(cache.MISSING, remote_cache.get_state())
+        remote_cache.put({"mode": "backup", "reserve_percentage": 20})
+        clock.t = 5
+        remote_cache.update({"mode": "self_consumption", "reserve_percentage": None})
+        self.assertEqual({"mode": "self_consumption", "reserve_percentage": 20}, remote_cache.value)
+        clock.t = 11
+        self.assertEqual(cache.STALE, remote_cache.get_state())
+
+    def test_invalidate(self):
+        remote_cache = cache.RemoteCache(10, clock=FakeClock())
+        remote_cache.put({})
+        remote_cache.invalidate()
+        self.assertEqual(cache.MISSING, remote_cache.get_state())
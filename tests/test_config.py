@@ -0,0 +1,57 @@
+import unittest
+
+import sys
+sys.path.append("../src/modules")
+import powerwall_config
+
+
+CONFIG = {
+    "import_tariff_breaks": [0.1, "lowest(2)"],
+    "import_tariff_pricing": ["average", "fixed(0.1)", "maximum"],
+    "schedule_type": "week",
+    "tariffs": [
+        {"tariff_code": "E-1R-AGILE-.*", "import_tariff_breaks": "jenks(3)", "import_tariff_pricing": "average"},
+        {"tariff_code": "E-1R-.*", "schedule_type": "weekend"}
+    ]
+}
+
+
+class TestConfig(unittest.TestCase):
+    def test_settings(self):
+        app_config = powerwall_config.AppConfig(CONFIG)
+        self.assertEqual([0.1, ("lowest", ("2",))], app_config.get("E-1R-GO-1", "import_tariff_breaks"))
+        self.assertEqual(["average", "fixed(0.1)", "maximum"], CONFIG["import_tariff_pricing"])
+        self.assertEqual(["average", ("fixed", ("0.1",)), "maximum"], app_config.get("E-1R-GO-1", "import_tariff_pricing"))
+        self.assertEqual("weekend", app_config.get("E-1R-GO-1", "schedule_type"))
+        # only the first matching entry applies
+        self.assertEqual("jenks(3)", app_config.get("E-1R-AGILE-1", "import_tariff_breaks"))
+        self.assertEqual("week", app_config.get("E-1R-AGILE-1", "schedule_type"))
+        self.assertEqual("week", app_config.get(None, "schedule_type"))
+        self.assertEqual(300, app_config.get("E-1R-GO-1", "cache_ttl", 300))
+        self.assertIs(app_config.get_settings("E-1R-GO-1"), app_config.get_settings("E-1R-GO-1"))
+
+    def test_invalid(self):
+        with self.assertRaisesRegex(ValueError, "Invalid threshold: median"):
+            powerwall_config.AppConfig({"export_tariff_breaks": [0.1, "median"]})
+        with self.assertRaisesRegex(ValueError, "Invalid threshold: mean\\(2\\)"):
+            powerwall_config.AppConfig({"tariffs": [{"tariff_code": ".*", "import_tariff_breaks": ["mean(2)"]}]})
+        with self.assertRaisesRegex(ValueError, "Invalid breaks: natural"):
+            powerwall_config.AppConfig({"import_tariff_breaks": "natural"})
+        with self.assertRaisesRegex(ValueError, "Invalid pricing: median"):
+            powerwall_config.AppConfig({"import_tariff_pricing": ["average", "median"]})
+        with self.assertRaisesRegex(ValueError, "Invalid pricing: fixed\\(abc\\)"):
+            powerwall_config.AppConfig({"import_tariff_pricing": ["average", "fixed(abc)"]})
+        with self.assertRaisesRegex(ValueError, "Invalid pricing: maximum\\(2\\)"):
+            powerwall_config.AppConfig({"import_tariff_pricing": "maximum(2)"})
+        with self.assertRaisesRegex(ValueError, "Invalid breaks: optimize\\(0\\)"):
+            powerwall_config.AppConfig({"import_tariff_breaks": "optimize(0)"})
+        with self.assertRaisesRegex(ValueError, "Invalid breaks: jenks\\(x\\)"):
+            powerwall_config.AppConfig({"import_tariff_breaks": "jenks(x)"})
+        with self.assertRaisesRegex(ValueError, "Invalid threshold: lowest\\(2, 0\\)"):
+            powerwall_config.AppConfig({"import_tariff_breaks": ["lowest(2, 0)"]})
+        with self.assertRaisesRegex(ValueError, "Invalid threshold: highest\\(\\)"):
+            powerwall_config.AppConfig({"import_tariff_breaks": ["highest()"]})
+        with self.assertRaisesRegex(ValueError, "Invalid threshold: state_attr\\(sensor.x\\)"):
+            powerwall_config.AppConfig({"import_tariff_breaks": ["state_attr(sensor.x)"]})
+        with self.assertRaisesRegex(ValueError, "inconsistent"):
+            powerwall_config.AppConfig({"import_tariff_breaks": [0.1], "import_tariff_pricing": ["average"]})
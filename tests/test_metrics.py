@@ -0,0 +1,78 @@
+import unittest
+
+import sys
+sys.path.append("../src/modules")
+import powerwall_metrics as metrics
+
+from fake_clock import FakeClock
+
+
+class TestMetrics(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, metrics.percentile(values, 50))
+        self.assertEqual(95, metrics.percentile(values, 95))
+        self.assertEqual(7, metrics.percentile([7], 95))
+        self.assertIsNone(metrics.percentile([], 50))
+
+    def test_update_instrumentation(self):
+        clock = FakeClock()
+        instrumentation = metrics.UpdateInstrumentation(window=2, clock=clock)
+        for i, fetch_time in enumerate([0.1, 0.2, 0.3]):
+            instrumentation.begin_run({"api_requests": i})
+            t = instrumentation.start()
+            clock.t += fetch_time
+            instrumentation.record("fetch", t)
+            instrumentation.set_value("payload_bytes", 100)
+            instrumentation.end_run({"api_requests": i + 2})
+        # outside of an update
+        instrumentation.record("fetch", instrumentation.start())
+
+        attrs = instrumentation.get_attributes()
+        self.assertEqual(3, attrs["updates"])
+        self.assertEqual(300.0, attrs["fetch_ms"])
+        self.assertEqual(200.0, attrs["fetch_p50_ms"])
+        self.assertEqual(300.0, attrs["fetch_p95_ms"])
+        self.assertEqual(300.0, attrs["total_ms"])
+        self.assertEqual(2, attrs["api_requests"])
+        self.assertEqual(100, attrs["payload_bytes"])
+
+    def test_metrics_registry(self):
+        registry = metrics.MetricsRegistry()
+        registry.counter("events_received_total", "Events received.")
+        registry.gauge("upload_queue_depth", "Writes queued.")
+        registry.histogram("stage_seconds", "Stage durations.", buckets=[0.1, 1.0])
+        registry.inc("events_received_total", event="next_day_rates")
+        registry.inc("events_received_total", 2, event="current_day_rates")
+        registry.inc("events_received_total", event="next_day_rates")
+        registry.set("upload_queue_depth", 3)
+        for duration in [0.05, 0.5, 0.5, 5.0]:
+            registry.observe("stage_seconds", duration, stage='to "tariff"')
+        self.assertEqual(2, registry.get_value("events_received_total", event="next_day_rates"))
+        self.assertEqual(4, registry.get_value("stage_seconds", stage='to "tariff"'))
+        self.assertIsNone(registry.get_value("upload_queue_depth", site="home"))
+        # e.g. an event without an event type
+        registry.inc("events_received_total", event=None)
+        self.assertEqual(1, registry.get_value("events_received_total", event="None"))
+        with self.assertRaises(ValueError):
+            registry.inc("unknown_total")
+        with self.assertRaises(ValueError):
+            registry.gauge("events_received_total", "Events received.")
+
+        self.assertEqual([
+            "# HELP powerwall_events_received_total Events received.",
+            "# TYPE powerwall_events_received_total counter",
+            'powerwall_events_received_total{event="None"} 1',
+            'powerwall_events_received_total{event="current_day_rates"} 2',
+            'powerwall_events_received_total{event="next_day_rates"} 2',
+            "# HELP powerwall_stage_seconds Stage durations.",
+            "# TYPE powerwall_stage_seconds histogram",
+            'powerwall_stage_seconds_bucket{stage="to \\"tariff\\"",le="0.1"} 1',
+            'powerwall_stage_seconds_bucket{stage="to \\"tariff\\"",le="1"} 3',
+            'powerwall_stage_seconds_bucket{stage="to \\"tariff\\"",le="+Inf"} 4',
+            'powerwall_stage_seconds_sum{stage="to \\"tariff\\""} 6.05',
+            'powerwall_stage_seconds_count{stage="to \\"tariff\\""} 4',
+            "# HELP powerwall_upload_queue_depth Writes queued.",
+            "# TYPE powerwall_upload_queue_depth gauge",
+            "powerwall_upload_queue_depth 3",
+        ], registry.render().splitlines())
@@ -3,6 +3,7 @@ import itertools
 import json
 from jsondiff import diff
 import unittest
+import unittest.mock
 
 import sys
 sys.path.append("../src/modules")
@@ -40,65 +41,290 @@ class TestTariff(unittest.TestCase):
         ]
         self.assertEqual(expected, rates)
 
+    def test_between(self):
+        rates = tariff.Rates()
+        rates.update_previous_day("T", prev_rates)
+        rates.update_current_day("T", today_rates)
+        rates.update_next_day("T", next_rates)
+        start = datetime.datetime(2023, 12, 26, 23, 0, tzinfo=datetime.timezone.utc)
+        end = datetime.datetime(2023, 12, 27, 1, 0, tzinfo=datetime.timezone.utc)
+        expected = [r for r in itertools.chain(prev_rates, today_rates) if r["start"] >= start and r["end"] <= end]
+        self.assertEqual(4, len(expected))
+        self.assertEqual(expected, rates.between(start, end))
+
+    def test_timeline(self):
+        rates = [dict(today_rates[0], session="free"), {k: v for k, v in today_rates[1].items() if k != "is_capped"}] + today_rates[2:]
+        timeline = tariff.RateTimeline(rates)
+        self.assertEqual(len(rates), timeline.get_count())
+        self.assertEqual(rates, timeline.get_rates(0, timeline.get_count()))
+        self.assertEqual([r["value_inc_vat"] for r in rates[1:3]], list(timeline.prices_between(rates[1]["start"], rates[2]["end"])))
+
+    def test_day_rates(self):
+        rates = tariff.Rates()
+        rates.update_current_day("T", today_rates[2:-3])
+        day = datetime.date(2023, 12, 27)
+        day_start, day_end = tariff.get_day_bounds(day)
+        expected = rates.between(day_start, day_end)
+        tariff.extend_from(expected, day_start)
+        tariff.extend_to(expected, day_end)
+        day_rates = rates.cover_day(day)
+        self.assertEqual(expected, day_rates.to_list())
+        self.assertEqual([r["value_inc_vat"] for r in expected], list(day_rates.get_prices()))
+        self.assertEqual([r["start"] for r in expected], day_rates.get_start_times())
+        self.assertEqual([r["end"] for r in expected], day_rates.get_end_times())
+
+        day_rates.set_price(0, 0.0, session="free")
+        self.assertEqual(0.0, day_rates.get_prices()[0])
+        self.assertEqual("free", day_rates.get_rate(0)["session"])
+        self.assertEqual(expected[0]["value_inc_vat"], rates.cover_day(day).get_price(0))
+        self.assertEqual([], rates.cover_day(datetime.date(2024, 1, 1)))
+
+    def test_price_overlays(self):
+        rates = tariff.Rates()
+        rates.update_current_day("T", today_rates)
+        day = datetime.date(2023, 12, 27)
+        original = rates.cover_day(day)
+        start = original.get_start_time(2)
+        overlays = tariff.PriceOverlays()
+        overlays.add(tariff.SAVING_SESSION, start, start + datetime.timedelta(hours=2), adjustment=1.0)
+        overlays.add(tariff.FREE_SESSION, start + datetime.timedelta(minutes=45), start + datetime.timedelta(hours=1), price=0.0)
+        overlays.add(tariff.MANUAL_OVERRIDE, start + datetime.timedelta(hours=1), start + datetime.timedelta(minutes=75), price=0.5)
+        day_rates = overlays.apply(rates.cover_day(day))
+
+        self.assertEqual(original.get_price(1), day_rates.get_price(1))
+        self.assertEqual(original.get_price(2) + 1.0, day_rates.get_price(2))
+        # half saving session, half free
+        self.assertAlmostEqual((original.get_price(3) + 1.0)/2.0, day_rates.get_price(3))
+        self.assertEqual("free", day_rates.get_rate(3)["session"])
+        self.assertAlmostEqual((0.5 + original.get_price(4) + 1.0)/2.0, day_rates.get_price(4))
+        self.assertEqual("manual", day_rates.get_rate(4)["session"])
+        self.assertEqual(original.get_price(5) + 1.0, day_rates.get_price(5))
+        self.assertEqual(original.get_price(6), day_rates.get_price(6))
+        self.assertEqual(4, len(day_rates.overrides))
+        self.assertEqual(["saving", "free", "manual"], overlays.get_sessions())
+
+        overlays.clear(tariff.MANUAL_OVERRIDE)
+        overlays.expire(start + datetime.timedelta(hours=1))
+        self.assertEqual(["saving"], overlays.get_sessions())
+
+    def test_not_contiguous(self):
+        rates = tariff.Rates()
+        rates.update_previous_day("T", prev_rates[:-1])
+        rates.update_current_day("T", today_rates)
+        rates.update_next_day("T", next_rates)
+        with self.assertRaisesRegex(ValueError, "Previous to current day rates are not contiguous"):
+            rates.is_valid()
+
+    def test_reset(self):
+        rates = tariff.Rates()
+        self.assertFalse(rates.has_updates())
+        rates.update_current_day("T", today_rates)
+        self.assertTrue(rates.has_updates())
+        rates.reset()
+        self.assertFalse(rates.has_updates())
+        with self.assertRaisesRegex(ValueError, "Waiting for rate data"):
+            rates.is_valid()
+
+    def test_lowest_highest(self):
+        rates = tariff.Rates()
+        rates.update_current_day("T", today_rates)
+        day_rates = rates.cover_day(datetime.date(2023, 12, 27))
+        prices = sorted(day_rates.get_prices())
+        self.assertEqual(prices[3] + tariff.EXCLUSIVE_OFFSET, tariff.RATE_FUNCS.apply("lowest", day_rates, None, "2"))
+        self.assertEqual(prices[-4], tariff.RATE_FUNCS.apply("highest", day_rates, None, "2"))
+        self.assertEqual(prices[-1] + tariff.EXCLUSIVE_OFFSET, tariff.RATE_FUNCS.apply("lowest", day_rates, None, "48"))
+        self.assertEqual(prices[0], tariff.RATE_FUNCS.apply("highest", day_rates, None, "48"))
+        # overridden prices are ranked afresh
+        day_rates.set_price(0, -1.0)
+        self.assertEqual(-1.0 + tariff.EXCLUSIVE_OFFSET, tariff.RATE_FUNCS.apply("lowest", day_rates, None, "0.5"))
+
+    def test_compiled_config(self):
+        rates = tariff.Rates()
+        rates.update_current_day("T", today_rates)
+        day = datetime.date(2023, 12, 27)
+        breaks = [0.1, "lowest(2)", "highest(4)"]
+        pricing = ["average", "minimum", "fixed(0.2)", "maximum"]
+        schedules = tariff.get_schedules(breaks, pricing, None, day, rates.cover_day(day))
+        compiled_schedules = tariff.get_schedules(tariff.compile_breaks(breaks), tariff.compile_pricing(pricing), None, day, rates.cover_day(day))
+        for schedule, compiled_schedule in zip(schedules, compiled_schedules):
+            self.assertEqual(schedule.get_periods(), compiled_schedule.get_periods())
+            self.assertEqual(schedule.get_value(), compiled_schedule.get_value())
+
+    def test_lowest_over_days(self):
+        rates = tariff.Rates()
+        rates.update_previous_day("T", prev_rates)
+        rates.update_current_day("T", today_rates)
+        day = datetime.date(2023, 12, 26)
+        window = tariff.RateWindow(rates, day)
+        day_rates = rates.cover_day(day)
+        prices = sorted(r["value_inc_vat"] for r in itertools.chain(prev_rates, today_rates))
+        self.assertEqual(prices[3] + tariff.EXCLUSIVE_OFFSET, tariff.RATE_FUNCS.apply("lowest", day_rates, window, "2", "2"))
+        self.assertEqual(prices[-4], tariff.RATE_FUNCS.apply("highest", day_rates, window, "2", "2"))
+        self.assertIs(rates.get_price_ranking(day, 2), window.get_price_ranking(2))
+
+        # overlays apply across the days, as they do to the day's rates
+        overlays = tariff.PriceOverlays()
+        start = today_rates[2]["start"]
+        overlays.add(tariff.MANUAL_OVERRIDE, start, start + datetime.timedelta(minutes=30), price=-1.0)
+        window = tariff.RateWindow(rates, day, overlays)
+        self.assertEqual(-1.0 + tariff.EXCLUSIVE_OFFSET, tariff.RATE_FUNCS.apply("lowest", day_rates, window, "0.5", "2"))
+        self.assertEqual(prices[-4], tariff.RATE_FUNCS.apply("highest", day_rates, window, "2", "2"))
+        self.assertEqual(prices[0] + tariff.EXCLUSIVE_OFFSET, tariff.RATE_FUNCS.apply("lowest", day_rates, tariff.RateWindow(rates, day), "0.5", "2"))
+
+    def test_assign_bands(self):
+        rates = [{"value_inc_vat": p} for p in [-0.05, 0.0, 0.1, 0.15, 0.2, 0.35]]
+        band_funcs = tariff.get_tariff_assigners([0.0, 0.2, 0.2], rates)
+        expected = [next(i for i, f in enumerate(band_funcs) if f.is_in(r)) for r in rates]
+        self.assertEqual(expected, tariff.assign_bands(band_funcs, rates))
+        individual_funcs = tariff.get_tariff_assigners(tariff.INDIVIDUAL_BREAKS, rates)
+        self.assertEqual(list(range(len(rates))), tariff.assign_bands(individual_funcs, rates))
+
+    def test_jenks_breaks(self):
+        values = [0.3, 0.01, 0.02, 0.28, 0.15, 0.14, 0.31, 0.16, 0.0, 0.29]
+        self.assertEqual([0.0, 0.02, 0.16, 0.31], tariff.jenks_breaks(values, 3))
+        self.assertEqual([0.0, 0.31], tariff.jenks_breaks(values, 1))
+        self.assertEqual([0.0, 0.0, 0.01], tariff.jenks_breaks([0.01, 0.0], 4))
+
+    def test_jenks_cache(self):
+        tariff.JENKS_CACHE.clear()
+        values = [0.3, 0.01, 0.02, 0.28, 0.15, 0.14, 0.31, 0.16, 0.0, 0.29]
+        tariff.jenks_breaks(values, 3)
+        for i in range(tariff.JENKS_CACHE_SIZE):
+            tariff.jenks_breaks(values, 4)
+            tariff.jenks_breaks([v + i for v in values], 3)
+        # still cached as it was used recently, whilst the least recently used was evicted
+        self.assertEqual(tariff.JENKS_CACHE_SIZE, len(tariff.JENKS_CACHE))
+        self.assertIn((tuple(sorted(values)), 4), tariff.JENKS_CACHE)
+        self.assertNotIn((tuple(sorted(values)), 3), tariff.JENKS_CACHE)
+
+    def test_jenks_assigners(self):
+        rates = [{"value_inc_vat": p} for p in [0.3, 0.01, 0.02, 0.28, 0.15, 0.14, 0.31, 0.16, 0.0, 0.29]]
+        self.assertEqual(4, len(tariff.get_tariff_assigners("jenks", rates)))
+        funcs = tariff.get_tariff_assigners("jenks(3)", rates)
+        self.assertEqual([0, 0, 0, 1, 1, 1, 2, 2, 2, 2], tariff.assign_bands(funcs, sorted(rates, key=lambda r: r["value_inc_vat"])))
+
+    def test_optimize_breaks(self):
+        rates = [{"value_inc_vat": p} for p in [0.3, 0.01, 0.02, 0.28, 0.15, 0.14, 0.31, 0.16, 0.0, 0.29]]
+        breaks, pricing = tariff.optimize_breaks(rates, 3, pricing_config="average")
+        self.assertEqual([0.14, 0.28], breaks)
+        self.assertEqual(["average", "average", "average"], pricing)
+        breaks, pricing = tariff.optimize_breaks(rates, 4)
+        self.assertEqual(3, len(breaks))
+        self.assertEqual(4, len(pricing))
+        self.assertEqual(([], ["maximum"]), tariff.optimize_breaks([{"value_inc_vat": 0.15}], 4, pricing_config=["maximum"] * 4))
+        # equally good fits are decided by the previous breaks
+        rates = [{"value_inc_vat": p} for p in [0.1, 0.15, 0.2]]
+        self.assertEqual([0.15], tariff.optimize_breaks(rates, 2, pricing_config="average", previous_breaks=[0.14])[0])
+        self.assertEqual([0.2], tariff.optimize_breaks(rates, 2, pricing_config="average", previous_breaks=[0.21])[0])
+
+    def test_optimize_break_history(self):
+        rates = tariff.Rates()
+        rates.update_previous_day("T", prev_rates)
+        rates.update_current_day("T", today_rates)
+        day = datetime.date(2023, 12, 27)
+        history = tariff.BreakHistory()
+        previous_day = day - datetime.timedelta(days=1)
+        funcs = tariff.get_tariff_assigners("optimize", rates.cover_day(previous_day), window=tariff.RateWindow(rates, previous_day, break_history=history), pricing_config="average")
+        previous_breaks = history.get(previous_day, "optimize", "average")
+        self.assertEqual([f.upper_bound for f in funcs[:-1]], previous_breaks)
+
+        # the breaks used the previous day are kept to, rather than optimizing it again
+        with unittest.mock.patch.object(tariff, "optimize_breaks", wraps=tariff.optimize_breaks) as optimize_breaks:
+            tariff.get_tariff_assigners("optimize", rates.cover_day(day), window=tariff.RateWindow(rates, day, break_history=history), pricing_config="average")
+        optimize_breaks.assert_called_once()
+        self.assertEqual(previous_breaks, optimize_breaks.call_args.kwargs["previous_breaks"])
+        self.assertIsNotNone(history.get(day, "optimize", "average"))
+        self.assertIsNone(history.get(day, "optimize(3)", "average"))
+
+        # only the previous day's are kept
+        history.put(day + datetime.timedelta(days=2), "optimize", "average", [0.1])
+        self.assertIsNone(history.get(previous_day, "optimize", "average"))
+
+    def test_optimize_compiled_pricing(self):
+        rates = [{"value_inc_vat": p/100.0} for p in range(40)]
+        pricing = ["average", "minimum", "maximum", "nonNegativeAverage"]
+        compiled_pricing = tariff.compile_pricing(pricing)
+        self.assertEqual(pricing, compiled_pricing)
+        self.assertEqual("average", tariff.compile_pricing("average"))
+        self.assertEqual(("fixed", ("0.2",)), tariff.compile_pricing("fixed(0.2)"))
+        # priced directly, rather than band by band through the pricing functions
+        with unittest.mock.patch.object(tariff, "create_pricing", side_effect=AssertionError):
+            self.assertEqual(tariff.optimize_breaks(rates, 4, pricing_config=pricing), tariff.optimize_breaks(rates, 4, pricing_config=compiled_pricing))
+            tariff.optimize_breaks(rates[:8], 4, pricing_config=compiled_pricing)
+        self.assertEqual(tariff.optimize_breaks(rates, 2, pricing_config=["fixed(0.1)", "maximum"])[0], tariff.optimize_breaks(rates, 2, pricing_config=tariff.compile_pricing(["fixed(0.1)", "maximum"]))[0])
+
+    def test_optimize_schedules(self):
+        day_date = datetime.date(2024, 3, 4)
+        start = datetime.datetime(2024, 3, 4, tzinfo=datetime.timezone.utc)
+        rates = []
+        for i, p in enumerate([0.3, 0.01, 0.02, 0.28, 0.15, 0.14, 0.31, 0.16, 0.0, 0.29]):
+            rates.append({"start": start + i*tariff.SLOT_TIME_INCREMENT, "end": start + (i+1)*tariff.SLOT_TIME_INCREMENT, "value_inc_vat": p})
+        schedules = tariff.get_schedules("optimize(3)", "optimize", None, day_date, rates)
+        self.assertEqual(3, len(schedules))
+        for schedule in schedules:
+            self.assertIsInstance(schedule.pricing_func, tariff.PRICING_FUNCS[schedule.assigner_func.pricing])
+        with self.assertRaises(ValueError):
+            tariff.get_schedules("jenks", "optimize", None, day_date, rates)
+
     def test_multiday_schedule_type_start_of_week(self):
         schedule1 = AllDaySchedule(datetime.date(2024, 3, 4))
-        schedule2 = AllDaySchedule(datetime.date(2024, 3, 5))
+        schedule2 = AllDaySchedule(datetime.date(2024, 3, 5), "ON_PEAK")
         week_schedules = tariff.WeekSchedules()
         week_schedules.update(0, [schedule1], None)
         week_schedules.update(1, [schedule2], None)
         data = tariff.schedules_to_tariff(week_schedules, "multiday", None)
         self.assertEqual(0, data["Summer"]["tou_periods"]["OFF_PEAK"][0]["fromDayOfWeek"])
         self.assertEqual(0, data["Summer"]["tou_periods"]["OFF_PEAK"][0]["toDayOfWeek"])
-        self.assertEqual(1, data["Summer"]["tou_periods"]["OFF_PEAK"][1]["fromDayOfWeek"])
-        self.assertEqual(6, data["Summer"]["tou_periods"]["OFF_PEAK"][1]["toDayOfWeek"])
+        self.assertEqual(1, data["Summer"]["tou_periods"]["ON_PEAK"][0]["fromDayOfWeek"])
+        self.assertEqual(6, data["Summer"]["tou_periods"]["ON_PEAK"][0]["toDayOfWeek"])
 
     def test_multiday_schedule_type_midweek(self):
         schedule1 = AllDaySchedule(datetime.date(2024, 3, 7))
-        schedule2 = AllDaySchedule(datetime.date(2024, 3, 8))
+        schedule2 = AllDaySchedule(datetime.date(2024, 3, 8), "ON_PEAK")
         week_schedules = tariff.WeekSchedules()
         week_schedules.update(3, [schedule1], None)
         week_schedules.update(4, [schedule2], None)
         data = tariff.schedules_to_tariff(week_schedules, "multiday", None)
         self.assertEqual(0, data["Summer"]["tou_periods"]["OFF_PEAK"][0]["fromDayOfWeek"])
         self.assertEqual(3, data["Summer"]["tou_periods"]["OFF_PEAK"][0]["toDayOfWeek"])
-        self.assertEqual(4, data["Summer"]["tou_periods"]["OFF_PEAK"][1]["fromDayOfWeek"])
-        self.assertEqual(6, data["Summer"]["tou_periods"]["OFF_PEAK"][1]["toDayOfWeek"])
+        self.assertEqual(4, data["Summer"]["tou_periods"]["ON_PEAK"][0]["fromDayOfWeek"])
+        self.assertEqual(6, data["Summer"]["tou_periods"]["ON_PEAK"][0]["toDayOfWeek"])
 
     def test_multiday_schedule_type_end_of_week(self):
         schedule1 = AllDaySchedule(datetime.date(2024, 3, 9))
-        schedule2 = AllDaySchedule(datetime.date(2024, 3, 10))
+        schedule2 = AllDaySchedule(datetime.date(2024, 3, 10), "ON_PEAK")
         week_schedules = tariff.WeekSchedules()
         week_schedules.update(5, [schedule1], None)
         week_schedules.update(6, [schedule2], None)
         data = tariff.schedules_to_tariff(week_schedules, "multiday", None)
         self.assertEqual(0, data["Summer"]["tou_periods"]["OFF_PEAK"][0]["fromDayOfWeek"])
         self.assertEqual(5, data["Summer"]["tou_periods"]["OFF_PEAK"][0]["toDayOfWeek"])
-        self.assertEqual(6, data["Summer"]["tou_periods"]["OFF_PEAK"][1]["fromDayOfWeek"])
-        self.assertEqual(6, data["Summer"]["tou_periods"]["OFF_PEAK"][1]["toDayOfWeek"])
+        self.assertEqual(6, data["Summer"]["tou_periods"]["ON_PEAK"][0]["fromDayOfWeek"])
+        self.assertEqual(6, data["Summer"]["tou_periods"]["ON_PEAK"][0]["toDayOfWeek"])
 
     def test_multiday_schedule_type_rollover(self):
         schedule1 = AllDaySchedule(datetime.date(2024, 3, 10))
-        schedule2 = AllDaySchedule(datetime.date(2024, 3, 11))
+        schedule2 = AllDaySchedule(datetime.date(2024, 3, 11), "ON_PEAK")
         week_schedules = tariff.WeekSchedules()
         week_schedules.update(6, [schedule1], None)
         week_schedules.update(0, [schedule2], None)
         data = tariff.schedules_to_tariff(week_schedules, "multiday", None)
-        self.assertEqual(0, data["Summer"]["tou_periods"]["OFF_PEAK"][0]["fromDayOfWeek"])
-        self.assertEqual(5, data["Summer"]["tou_periods"]["OFF_PEAK"][0]["toDayOfWeek"])
-        self.assertEqual(6, data["Summer"]["tou_periods"]["OFF_PEAK"][1]["fromDayOfWeek"])
-        self.assertEqual(6, data["Summer"]["tou_periods"]["OFF_PEAK"][1]["toDayOfWeek"])
+        self.assertEqual(0, data["Summer"]["tou_periods"]["ON_PEAK"][0]["fromDayOfWeek"])
+        self.assertEqual(5, data["Summer"]["tou_periods"]["ON_PEAK"][0]["toDayOfWeek"])
+        self.assertEqual(6, data["Summer"]["tou_periods"]["OFF_PEAK"][0]["fromDayOfWeek"])
+        self.assertEqual(6, data["Summer"]["tou_periods"]["OFF_PEAK"][0]["toDayOfWeek"])
 
     def test_multiday_schedule_type_roll_disjoint(self):
         schedule1 = AllDaySchedule(datetime.date(2024, 3, 7))
-        schedule2 = AllDaySchedule(datetime.date(2024, 3, 9))
+        schedule2 = AllDaySchedule(datetime.date(2024, 3, 9), "ON_PEAK")
         week_schedules = tariff.WeekSchedules()
         week_schedules.update(3, [schedule1], None)
         week_schedules.update(5, [schedule2], None)
         data = tariff.schedules_to_tariff(week_schedules, "multiday", None)
         self.assertEqual(0, data["Summer"]["tou_periods"]["OFF_PEAK"][0]["fromDayOfWeek"])
         self.assertEqual(4, data["Summer"]["tou_periods"]["OFF_PEAK"][0]["toDayOfWeek"])
-        self.assertEqual(5, data["Summer"]["tou_periods"]["OFF_PEAK"][1]["fromDayOfWeek"])
-        self.assertEqual(6, data["Summer"]["tou_periods"]["OFF_PEAK"][1]["toDayOfWeek"])
+        self.assertEqual(5, data["Summer"]["tou_periods"]["ON_PEAK"][0]["fromDayOfWeek"])
+        self.assertEqual(6, data["Summer"]["tou_periods"]["ON_PEAK"][0]["toDayOfWeek"])
 
     def test_calculate_tariff_3_breaks(self):
         tariff_breaks = [0.1, 0.2, 0.3]
@@ -156,9 +382,66 @@ class TestTariff(unittest.TestCase):
         self.assertFalse(diff(expected, data), msg=f"\nActual:\n{json.dumps(data)}")
 
 
+    def test_tariff_fingerprint(self):
+        tariff_breaks = [0.1, 0.2, 0.3]
+        tariff_pricing = ["average", "average", "average", "average"]
+        day = datetime.date(2023, 12, 27)
+        import_rates = tariff.Rates()
+        import_rates.update_previous_day("T", prev_rates)
+        import_rates.update_current_day("T", today_rates)
+        day_rates = import_rates.cover_day(day)
+        import_schedules = tariff.get_schedules(tariff_breaks, tariff_pricing, None, day, day_rates)
+        week_schedules = tariff.WeekSchedules()
+        week_schedules.update(day.weekday(), import_schedules, None)
+        data = tariff.to_tariff_data("Test", "Test plan", 0, "week", "Test plan", 0, "week", week_schedules, day)
+        fingerprint = tariff.tariff_fingerprint(data)
+
+        remote = json.loads(json.dumps(data))
+        remote["code"] = "SERVER:CODE"
+        remote["currency"] = "GBP"
+        remote["sell_tariff"]["code"] = "SERVER:CODE"
+        remote["seasons"]["Summer"]["id"] = 1
+        remote["daily_charges"][0]["currency"] = "GBP"
+        for periods in remote["seasons"]["Summer"]["tou_periods"].values():
+            periods.reverse()
+            for period in periods:
+                period["label"] = "server"
+        for charge_name, price in remote["energy_charges"]["Summer"].items():
+            remote["energy_charges"]["Summer"][charge_name] = price + 0.000001
+        self.assertEqual(fingerprint, tariff.tariff_fingerprint(remote))
+
+        remote["energy_charges"]["Summer"]["ON_PEAK"] += 0.01
+        self.assertNotEqual(fingerprint, tariff.tariff_fingerprint(remote))
+        self.assertNotEqual(fingerprint, tariff.tariff_fingerprint(None))
+
+    def test_compact_tou_periods(self):
+        def period(from_day, to_day, from_time, to_time):
+            return {"fromDayOfWeek": from_day, "fromHour": from_time[0], "fromMinute": from_time[1], "toDayOfWeek": to_day, "toHour": to_time[0], "toMinute": to_time[1]}
+
+        tou_periods = {
+            "ON_PEAK": [period(0, 6, (16, 0), (17, 30)), period(0, 6, (17, 30), (19, 0))],
+            "OFF_PEAK": [period(0, 6, (0, 0), (2, 0)), period(0, 6, (22, 0), (0, 0)), period(0, 6, (22, 0), (0, 0))],
+            "PARTIAL_PEAK": [period(0, 4, (13, 0), (14, 0)), period(5, 6, (13, 0), (14, 0)), period(5, 6, (14, 0), (15, 0))],
+            # only every day continues across midnight
+            "SUPER_OFF_PEAK": [period(0, 4, (23, 0), (0, 0)), period(0, 4, (0, 0), (1, 0))],
+        }
+        compacted = tariff.compact_tou_periods(tou_periods)
+        self.assertEqual([period(0, 6, (16, 0), (19, 0))], compacted["ON_PEAK"])
+        self.assertEqual([period(0, 6, (22, 0), (2, 0))], compacted["OFF_PEAK"])
+        self.assertEqual([period(0, 4, (13, 0), (14, 0)), period(5, 6, (13, 0), (15, 0))], compacted["PARTIAL_PEAK"])
+        self.assertEqual([period(0, 4, (0, 0), (1, 0)), period(0, 4, (23, 0), (0, 0))], compacted["SUPER_OFF_PEAK"])
+
+        week_schedules = tariff.WeekSchedules()
+        week_schedules.update(3, [AllDaySchedule(datetime.date(2024, 3, 7))], None)
+        week_schedules.update(5, [AllDaySchedule(datetime.date(2024, 3, 9))], None)
+        data = tariff.schedules_to_tariff(week_schedules, "weekend", 3)
+        self.assertEqual([period(0, 6, (0, 0), (0, 0))], data["Summer"]["tou_periods"]["OFF_PEAK"])
+        data = tariff.schedules_to_tariff(week_schedules, "multiday", None)
+        self.assertEqual([period(0, 6, (0, 0), (0, 0))], data["Summer"]["tou_periods"]["OFF_PEAK"])
+
 class AllDaySchedule:
-    def __init__(self, day_date):
-        self.charge_name = "OFF_PEAK"
+    def __init__(self, day_date, charge_name="OFF_PEAK"):
+        self.charge_name = charge_name
         self.periods = [(datetime.datetime.combine(day_date, datetime.time.min), datetime.datetime.combine(day_date + datetime.timedelta(days=1), datetime.time.min))]
 
     def get_periods(self):
@@ -0,0 +1,122 @@
+import datetime
+import unittest
+
+import sys
+sys.path.append("../src/modules")
+import powerwall_cache as cache
+import powerwall_tariff as tariff
+import powerwall_update as update
+
+
+class TestUpdate(unittest.TestCase):
+    def test_single_flight(self):
+        scheduler = update.UpdateScheduler()
+        self.assertTrue(scheduler.request(update.UPDATE))
+        # a burst of requests whilst the runner is starting or running doesn't start another
+        self.assertFalse(scheduler.request(update.UPDATE))
+        self.assertFalse(scheduler.request(update.CHECK))
+        self.assertEqual(update.UPDATE, scheduler.next_run())
+        self.assertFalse(scheduler.request(update.UPDATE))
+        self.assertEqual(update.UPDATE, scheduler.next_run())
+        self.assertEqual(update.CHECK, scheduler.next_run())
+        self.assertIsNone(scheduler.next_run())
+        scheduler.stop()
+        self.assertTrue(scheduler.request(update.CHECK))
+        self.assertEqual(update.CHECK, scheduler.next_run())
+        self.assertIsNone(scheduler.next_run())
+
+    def test_update_checked(self):
+        scheduler = update.UpdateScheduler()
+        self.assertTrue(scheduler.request(update.CHECK))
+        self.assertFalse(scheduler.request(update.UPDATE))
+        # updates come first, and one that checked the Powerwalls covers the check
+        self.assertEqual(update.UPDATE, scheduler.next_run())
+        scheduler.checked()
+        self.assertIsNone(scheduler.next_run())
+
+        scheduler.stop()
+        self.assertTrue(scheduler.request(update.CHECK))
+        self.assertFalse(scheduler.request(update.UPDATE))
+        # an update without new rates leaves the check to run
+        self.assertEqual(update.UPDATE, scheduler.next_run())
+        self.assertEqual(update.CHECK, scheduler.next_run())
+
+    def test_stop(self):
+        scheduler = update.UpdateScheduler()
+        self.assertTrue(scheduler.request(update.UPDATE))
+        self.assertEqual(update.UPDATE, scheduler.next_run())
+        self.assertFalse(scheduler.request(update.UPDATE))
+        # a runner that failed leaves the request for the next one
+        scheduler.stop()
+        self.assertTrue(scheduler.request(update.CHECK))
+        self.assertEqual(update.UPDATE, scheduler.next_run())
+        self.assertEqual(update.CHECK, scheduler.next_run())
+
+    def test_get_site_values(self):
+        sites = [{"name": "home"}, {"name": "barn"}, {"name": "shed"}]
+        caches = {site["name"]: cache.RemoteCache(300) for site in sites}
+        caches["barn"].put({"code": "barn"})
+        site_values, sites_to_fetch = update.split_cached(sites, caches)
+        self.assertEqual([(sites[1], {"code": "barn"})], site_values)
+        self.assertEqual([sites[0], sites[2]], sites_to_fetch)
+
+        results = [
+            {"name": "home", "value": {"code": "home"}, "error": None, "duration": 0.25},
+            {"name": "shed", "value": None, "error": "HTTPError: 500", "duration": 1.5}
+        ]
+        site_results = {}
+        self.assertEqual({"shed": "HTTPError: 500"}, update.record_site_results(site_results, results, "fetch_ms"))
+        update.add_fetched(site_values, sites_to_fetch, results, caches)
+        # sites that could not be fetched are omitted
+        self.assertEqual([(sites[1], {"code": "barn"}), (sites[0], {"code": "home"})], site_values)
+        self.assertEqual(({"code": "home"}, cache.FRESH), caches["home"].get())
+        self.assertEqual((None, cache.MISSING), caches["shed"].get())
+
+        results = [{"name": "home", "value": None, "error": None, "duration": 0.5}]
+        self.assertEqual({}, update.record_site_results(site_results, results, "upload_ms"))
+        self.assertEqual({
+            "home": {"fetch_ms": 250.0, "upload_ms": 500.0},
+            "shed": {"fetch_ms": 1500.0, "error": "HTTPError: 500"}
+        }, site_results)
+        self.assertEqual(["shed"], update.get_failed_sites(site_results))
+
+    def test_split_by_fingerprint(self):
+        sites = [{"name": "home"}, {"name": "barn"}, {"name": "shed"}]
+        fingerprints = {"home": "abc", "barn": "def"}
+        self.assertEqual(([sites[1], sites[2]], [sites[0]]), update.split_by_fingerprint(sites, fingerprints, "abc"))
+        self.assertEqual((sites, []), update.split_by_fingerprint(sites, {}, "abc"))
+
+    def test_staged_tariff(self):
+        day = datetime.date(2023, 12, 27)
+        start = datetime.datetime(2023, 12, 26, tzinfo=datetime.timezone.utc)
+        rates = []
+        for i in range(96):
+            rate_start = start + datetime.timedelta(minutes=30*i)
+            rates.append({"start": rate_start, "end": rate_start + datetime.timedelta(minutes=30), "value_inc_vat": 0.3 if i % 48 >= 32 else 0.1})
+        import_rates = tariff.Rates()
+        import_rates.update_previous_day("T", rates[:48])
+        import_rates.update_current_day("T", rates[48:])
+        week_schedules = tariff.WeekSchedules()
+        week_schedules.update(day.weekday(), tariff.get_schedules([0.2], ["average", "average"], None, day, import_rates.cover_day(day)), None)
+
+        staged = update.StagedTariff()
+        # a multiday tariff switches at midnight by itself
+        self.assertFalse(staged.stage(day, week_schedules, "multiday", "multiday"))
+        self.assertIsNone(staged.get(day))
+        self.assertTrue(staged.stage(day, week_schedules, "multiday", "week"))
+        self.assertIsNone(staged.get(day + tariff.ONE_DAY_INCREMENT))
+        staged_schedules = staged.get(day)
+        # unaffected by later updates
+        week_schedules.update(day.weekday(), None, None)
+        self.assertIsNotNone(staged_schedules.get_schedules(day.weekday()))
+        self.assertFalse(staged.stage(day, week_schedules, "multiday", "multiday"))
+        self.assertIsNone(staged.get(day))
+        self.assertTrue(staged.stage(day, staged_schedules, "week", "week"))
+
+        # built at midnight, so a change of standing charge since staging is uploaded too
+        tariff_data = tariff.to_tariff_data("Test", "Test plan", 0.5, "week", "Test plan", 0, "week", staged.get(day), day)
+        fingerprint = tariff.tariff_fingerprint(tariff_data)
+        sites = [{"name": "home"}, {"name": "barn"}]
+        self.assertEqual(([], sites), update.split_by_fingerprint(sites, {"home": fingerprint, "barn": fingerprint}, fingerprint))
+        tariff_data = tariff.to_tariff_data("Test", "Test plan", 0.6, "week", "Test plan", 0, "week", staged.get(day), day)
+        self.assertEqual((sites, []), update.split_by_fingerprint(sites, {"home": fingerprint, "barn": fingerprint}, tariff.tariff_fingerprint(tariff_data)))
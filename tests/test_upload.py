@@ -0,0 +1,67 @@
+import unittest
+
+import sys
+sys.path.append("../src/modules")
+import powerwall_upload as upload
+
+from fake_clock import FakeClock
+
+
+class TestUpload(unittest.TestCase):
+    def test_token_bucket(self):
+        clock = FakeClock()
+        bucket = upload.TokenBucket(rate=0.5, capacity=2, clock=clock)
+        self.assertTrue(bucket.take())
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+        self.assertAlmostEqual(2.0, bucket.get_wait())
+        clock.t += 2.0
+        self.assertTrue(bucket.take())
+
+        bucket.block(30)
+        clock.t += 10.0
+        self.assertAlmostEqual(20.0, bucket.get_wait())
+        clock.t += 20.0
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+
+    def test_last_writer_wins(self):
+        clock = FakeClock()
+        queue = upload.UploadQueue(clock=clock)
+        first = queue.submit("home", upload.TARIFF, "v1")
+        settings = queue.submit("home", upload.SETTINGS, {"mode": "backup", "reserve_percentage": None}, merge=True)
+        self.assertIs(first, queue.submit("home", upload.TARIFF, "v2"))
+        self.assertIs(settings, queue.submit("home", upload.SETTINGS, {"mode": None, "reserve_percentage": 20}, merge=True))
+        queue.submit("annex", upload.TARIFF, "v2")
+        self.assertEqual(3, queue.get_depth())
+
+        clock.t += 1.5
+        entry = queue.take("home")
+        self.assertEqual("v2", entry["payload"])
+        self.assertEqual({"mode": "backup", "reserve_percentage": 20}, queue.take("home")["payload"])
+        self.assertIsNone(queue.take("home"))
+        self.assertEqual([entry], queue.complete(entry))
+
+        stats = queue.get_stats()
+        self.assertEqual(1, stats["upload_queue_depth"])
+        self.assertEqual(5, stats["uploads_submitted"])
+        self.assertEqual(2, stats["uploads_superseded"])
+        self.assertEqual(1, stats["uploads_sent"])
+        self.assertEqual(1500.0, stats["upload_wait_p95_ms"])
+
+    def test_requeue(self):
+        queue = upload.UploadQueue(clock=FakeClock())
+        queue.submit("home", upload.SETTINGS, {"mode": "backup"}, merge=True)
+        queue.submit("home", upload.TARIFF, "v1")
+        entry = queue.take("home")
+        # rate limited, so back to the front of the queue
+        self.assertTrue(queue.requeue(entry, merge=True))
+        self.assertIs(entry, queue.take("home"))
+
+        newer = queue.submit("home", upload.SETTINGS, {"reserve_percentage": 20}, merge=True)
+        self.assertFalse(queue.requeue(entry, merge=True))
+        self.assertEqual({"mode": "backup", "reserve_percentage": 20}, newer["payload"])
+        self.assertEqual("v1", queue.take("home")["payload"])
+        self.assertIs(newer, queue.take("home"))
+        self.assertEqual([newer, entry], queue.complete(newer, "HTTPError: 500"))
+        self.assertEqual(1, queue.get_stats()["uploads_failed"])